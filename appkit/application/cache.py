@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2015 Luis López <luis@cuarentaydos.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+from appkit import (
+    application,
+    cache,
+    loggertools
+)
+from appkit.application import (
+    commands
+)
+
+import sys
+
+
+def _fetch_url(url):
+    # Module level so it can be pickled and sent to worker processes
+    from appkit import network
+
+    return network.UrllibFetcher().fetch(url)
+
+
+class Command(commands.Command):
+    __extension_name__ = 'cache'
+
+    HELP = 'Export, import and prewarm disk caches'
+    ARGUMENTS = (
+        application.cliargument(
+            'action',
+            choices=('export', 'import', 'prewarm'),
+            help=('Action to run')
+        ),
+        application.cliargument(
+            'path',
+            help=('Archive to export to or import from. For prewarm: file '
+                  'with one url per line, - for stdin')
+        ),
+        application.cliargument(
+            '-d', '--basedir',
+            dest='basedir',
+            required=True,
+            help=('Cache directory')
+        ),
+        application.cliargument(
+            '-j', '--jobs',
+            dest='jobs',
+            type=int,
+            default=None,
+            help=('Number of worker processes (default: number of CPUs)')
+        ),
+    )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.logger = loggertools.getLogger('cache')
+
+    def execute(self, app, arguments):
+        if arguments.jobs is not None and arguments.jobs < 1:
+            msg = "Invalid number of jobs: {jobs}"
+            msg = msg.format(jobs=arguments.jobs)
+            raise application.ArgumentsError(msg)
+
+        if arguments.action == 'export':
+            result = cache.export_disk_cache(arguments.basedir,
+                                             arguments.path,
+                                             jobs=arguments.jobs)
+
+        elif arguments.action == 'import':
+            result = cache.import_disk_cache(arguments.basedir,
+                                             arguments.path,
+                                             jobs=arguments.jobs)
+
+        else:
+            result = self._prewarm(arguments)
+
+        msg = ("{action}: {entries} entries, {mib:.2f} MiB in {elapsed:.2f}s "
+               "({eps:.1f} entries/s, {mibps:.2f} MiB/s)")
+        msg = msg.format(
+            action=arguments.action,
+            entries=result['entries'],
+            mib=result['bytes'] / 2 ** 20,
+            elapsed=result['elapsed'],
+            eps=result['entries_per_second'] or 0,
+            mibps=(result['bytes_per_second'] or 0) / 2 ** 20)
+        print(msg)
+
+        if arguments.action == 'prewarm':
+            msg = "prewarm: {cached} already cached, {errors} errors"
+            msg = msg.format(**result)
+            print(msg)
+
+            for (key, error) in result['failures']:
+                msg = "Failed to load «{key}»: {error}"
+                msg = msg.format(key=key, error=error)
+                print(msg, file=sys.stderr)
+
+            if result['errors'] > len(result['failures']):
+                msg = "… and {n} more errors"
+                msg = msg.format(n=result['errors'] - len(result['failures']))
+                print(msg, file=sys.stderr)
+
+    def _prewarm(self, arguments):
+        if arguments.path == '-':
+            lines = sys.stdin.readlines()
+        else:
+            try:
+                with open(arguments.path) as fh:
+                    lines = fh.readlines()
+            except OSError as e:
+                msg = "Unable to read keys from '{path}': {msg}"
+                msg = msg.format(path=arguments.path, msg=e)
+                raise application.ArgumentsError(msg) from e
+
+        keys = [x.strip() for x in lines]
+        keys = [x for x in keys if x and not x.startswith('#')]
+        self.logger.info("Prewarming {n} keys".format(n=len(keys)))
+
+        return cache.prewarm_disk_cache(arguments.basedir, keys, _fetch_url,
+                                        jobs=arguments.jobs)
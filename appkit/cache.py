@@ -21,24 +21,218 @@
 """Cache services"""
 
 import abc
+import asyncio
+import atexit
+import collections
+import concurrent.futures
+import functools
 import hashlib
+import inspect
+import io
+import itertools
+import json
+import lzma
+import mmap
 import os
 import pickle
 import shutil
+import struct
+import sys
+import tarfile
 import tempfile
+import threading
 import time
+import weakref
+import zlib
+
+
+_UNDEF = object()
 
 
 def hashfunc(key):
     """
-    Default hash function for appkit.cache.Disk
-    Uses hex-encoded sha1 algorithm to hash keys.
+    Default hash function for appkit.cache.DiskCache
+    Uses hex-encoded blake2b algorithm with a 16 bytes digest to hash keys.
     Parameters:
-      key - key to `stringify`.
+      key - key to `stringify`. Strings, bytes, tuples or any other object
+            supported by hash_args.
+    """
+    if isinstance(key, str):
+        buff = key.encode('utf-8')
+    else:
+        # Other keys are type-tagged so they never collide with strings
+        out = []
+        _encode_arg(key, out)
+        buff = b''.join(out)
+
+    return hashlib.blake2b(buff, digest_size=16).hexdigest()
+
+
+def sha1_hashfunc(key):
+    """
+    Hash function used by appkit.cache.DiskCache before hashfunc.
+    Uses hex-encoded sha1 algorithm to hash string keys.
     """
     return hashlib.sha1(key.encode('utf-8')).hexdigest()
 
 
+_perf_counter = time.perf_counter
+
+
+class LatencyHistogram:
+    """
+    Latency histogram with power of two buckets, in microseconds.
+    Updates are not locked, some samples may be lost under concurrency which
+    is acceptable for monitoring.
+    """
+    __slots__ = ('counts', 'total')
+
+    BUCKETS = 32
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.total = 0.0
+
+    def add(self, seconds):
+        # Bucket n holds samples in [2 ** (n - 1), 2 ** n) microseconds
+        idx = int(seconds * 1e6).bit_length()
+        if idx >= self.BUCKETS:
+            idx = self.BUCKETS - 1
+
+        self.counts[idx] += 1
+        self.total += seconds
+
+    def percentile(self, p):
+        """
+        Returns the upper bound in seconds of the bucket holding the p
+        percentile or None if there are no samples.
+        """
+        counts = list(self.counts)
+        n = sum(counts)
+        if not n:
+            return None
+
+        threshold = n * p / 100
+        acc = 0
+        for (idx, count) in enumerate(counts):
+            acc += count
+            if acc >= threshold:
+                break
+
+        return (2 ** idx) / 1e6
+
+    def snapshot(self):
+        counts = list(self.counts)
+        n = sum(counts)
+        return {
+            'count': n,
+            'mean': self.total / n if n else None,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'buckets': {2 ** idx: count
+                        for (idx, count) in enumerate(counts) if count},
+        }
+
+
+class CacheMetrics:
+    """
+    Counters and latency histograms of a cache.
+    Like LatencyHistogram, counters are not locked.
+    """
+    __slots__ = ('hits', 'misses', 'expirations', 'errors', 'bytes_read',
+                 'bytes_written', 'get_latency', 'set_latency')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.errors = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.get_latency = LatencyHistogram()
+        self.set_latency = LatencyHistogram()
+
+    def snapshot(self):
+        lookups = self.hits + self.misses + self.expirations
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'expirations': self.expirations,
+            'errors': self.errors,
+            'hit_ratio': self.hits / lookups if lookups else None,
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'get_latency': self.get_latency.snapshot(),
+            'set_latency': self.set_latency.snapshot(),
+        }
+
+
+def _instrumented_get(fn):
+    """
+    Records outcome and latency of BaseCache.get implementations
+    """
+    @functools.wraps(fn)
+    def get(self, key, *args, **kwargs):
+        try:
+            metrics = self._metrics
+        except AttributeError:
+            metrics = self.metrics
+
+        t0 = _perf_counter()
+        try:
+            ret = fn(self, key, *args, **kwargs)
+        except CacheKeyMissError:
+            metrics.misses += 1
+            metrics.get_latency.add(_perf_counter() - t0)
+            raise
+        except CacheKeyExpiredError:
+            metrics.expirations += 1
+            metrics.get_latency.add(_perf_counter() - t0)
+            raise
+        except Exception:
+            metrics.errors += 1
+            metrics.get_latency.add(_perf_counter() - t0)
+            raise
+
+        # Hot path, LatencyHistogram.add inlined
+        elapsed = _perf_counter() - t0
+        idx = int(elapsed * 1e6).bit_length()
+        latency = metrics.get_latency
+        latency.counts[idx if idx < 32 else 31] += 1
+        latency.total += elapsed
+        metrics.hits += 1
+        return ret
+
+    return get
+
+
+def _instrumented_set(fn):
+    """
+    Records errors and latency of BaseCache.set implementations
+    """
+    @functools.wraps(fn)
+    def set(self, key, value):
+        try:
+            metrics = self._metrics
+        except AttributeError:
+            metrics = self.metrics
+
+        t0 = _perf_counter()
+        try:
+            return fn(self, key, value)
+        except Exception:
+            metrics.errors += 1
+            raise
+        finally:
+            metrics.set_latency.add(_perf_counter() - t0)
+
+    return set
+
+
 class BaseCache:
     """
     Abstract base class for all appkit caches
@@ -49,6 +243,25 @@ class BaseCache:
         """
         pass
 
+    @property
+    def metrics(self):
+        """
+        CacheMetrics of this cache. Implementations don't need to call
+        BaseCache.__init__, it's created on first use.
+        """
+        try:
+            return self._metrics
+        except AttributeError:
+            self._metrics = CacheMetrics()
+            return self._metrics
+
+    def stats(self):
+        """
+        Returns a dict with cache counters and latencies. Implementations
+        add their own occupancy information.
+        """
+        return self.metrics.snapshot()
+
     @abc.abstractmethod
     def get(self, key):
         """
@@ -68,17 +281,450 @@ class BaseCache:
         """
         raise NotImplementedError()
 
+    def delete(self, key):
+        """
+        Deletes key from the cache.
+        Parameters:
+          key - Any hasheble object.
+        """
+        raise NotImplementedError()
+
+    def get_many(self, keys, delta=None):
+        """
+        Returns a tuple with a dict of found keys and their values and a set
+        of missing or expired keys. Misses are not raised.
+        Implementations should override this method if they can do better
+        than calling get for each key.
+        Parameters:
+          keys - Iterable of keys.
+          delta - Overrides cache delta, if supported by the implementation.
+        """
+        hits = {}
+        misses = set()
+
+        for key in keys:
+            try:
+                if delta is None:
+                    hits[key] = self.get(key)
+                else:
+                    hits[key] = self.get(key, delta=delta)
+            except CacheKeyError:
+                misses.add(key)
+
+        return (hits, misses)
+
+    def set_many(self, mapping):
+        """
+        Stores all key-value pairs from mapping.
+        Parameters:
+          mapping - A dict-like object.
+        """
+        for (key, value) in mapping.items():
+            self.set(key, value)
+
+    def delete_many(self, keys):
+        """
+        Deletes keys from the cache. Returns the set of keys not found.
+        Parameters:
+          keys - Iterable of keys.
+        """
+        misses = set()
+        for key in keys:
+            try:
+                self.delete(key)
+            except CacheKeyError:
+                misses.add(key)
+
+        return misses
+
 
 class NullCache(BaseCache):
-    def get(self, key):
+    @_instrumented_get
+    def get(self, key, delta=None):
         raise CacheKeyMissError(key)
 
+    @_instrumented_set
     def set(self, key, data):
         pass
 
+    def delete(self, key):
+        raise CacheKeyMissError(key)
+
+    def get_many(self, keys, delta=None):
+        misses = set(keys)
+        self.metrics.misses += len(misses)
+        return ({}, misses)
+
+    def set_many(self, mapping):
+        pass
+
+    def delete_many(self, keys):
+        return set(keys)
+
+
+class _LRUIndex:
+    """
+    Tracks key usage for least recently used eviction
+    """
+    def __init__(self):
+        self._keys = collections.OrderedDict()
+
+    def add(self, key):
+        self._keys[key] = None
+
+    def touch(self, key):
+        self._keys.move_to_end(key)
+
+    def remove(self, key):
+        del self._keys[key]
+
+    def victim(self):
+        return next(iter(self._keys))
+
+
+class _LFUIndex:
+    """
+    Tracks key usage for least frequently used eviction.
+    Keys with the same frequency are evicted in LRU order.
+    """
+    def __init__(self):
+        self._freqs = {}
+        self._buckets = {}
+        self._min_freq = 0
+
+    def _unlink(self, key):
+        freq = self._freqs.pop(key)
+        bucket = self._buckets[freq]
+        del bucket[key]
+        if not bucket:
+            del self._buckets[freq]
+
+        return freq
+
+    def _link(self, key, freq):
+        self._freqs[key] = freq
+        self._buckets.setdefault(freq, collections.OrderedDict())[key] = None
+
+    def add(self, key):
+        self._link(key, 1)
+        self._min_freq = 1
+
+    def touch(self, key):
+        freq = self._unlink(key)
+        self._link(key, freq + 1)
+        if self._min_freq == freq and freq not in self._buckets:
+            self._min_freq = freq + 1
+
+    def remove(self, key):
+        self._unlink(key)
+
+    def victim(self):
+        if self._min_freq not in self._buckets:
+            self._min_freq = min(self._buckets)
+
+        return next(iter(self._buckets[self._min_freq]))
+
+
+def approximate_size(value):
+    """
+    Default size function for appkit.cache.MemoryCache.
+    Returns length for bytes and strings, sys.getsizeof for other objects.
+    """
+    if isinstance(value, (bytes, bytearray, memoryview, str)):
+        return len(value)
+
+    return sys.getsizeof(value)
+
+
+class MemoryCache(BaseCache):
+    LRU = 'lru'
+    LFU = 'lfu'
+
+    def __init__(self, max_entries=0, max_size=0, policy=LRU, delta=-1,
+                 sizeof=approximate_size, grace=0):
+        """
+        In-process memory cache.
+        Values are stored as is, they are not copied.
+        Parameters:
+          max_entries - Maximum number of entries. Zero means no limit.
+          max_size - Maximum approximate size in bytes of all values. Zero
+                     means no limit.
+          policy - Eviction policy: MemoryCache.LRU (least recently used)
+                   or MemoryCache.LFU (least frequently used).
+          delta - Seconds needed before a entry is considered expired, like
+                  in DiskCache.
+          sizeof - A callable that returns the approximate size of a value.
+          grace - Seconds after expiration during which stale entries are
+                  served through CacheKeyStaleError, like in DiskCache.
+        """
+        if policy == self.LRU:
+            self._usage = _LRUIndex()
+        elif policy == self.LFU:
+            self._usage = _LFUIndex()
+        else:
+            raise ValueError(policy)
+
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.delta = delta
+        self.sizeof = sizeof
+        self.grace = grace
+
+        self._entries = {}
+        self._size = 0
+        self._lock = threading.Lock()
+
+        self.evictions = 0
+
+    def _remove(self, key):
+        (value, size, timestamp) = self._entries.pop(key)
+        self._usage.remove(key)
+        self._size -= size
+
+    @_instrumented_set
+    def set(self, key, value):
+        size = self.sizeof(value)
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            if self.max_size > 0 and size > self.max_size:
+                return
+
+            # Make room before adding the new entry, LFU would choose it
+            # as victim otherwise
+            while self._entries and (
+                    (self.max_entries > 0 and
+                     len(self._entries) >= self.max_entries) or
+                    (self.max_size > 0 and
+                     self._size + size > self.max_size)):
+                self._remove(self._usage.victim())
+                self.evictions += 1
+
+            self._entries[key] = (value, size, time.time())
+            self._usage.add(key)
+            self._size += size
+
+    @_instrumented_get
+    def get(self, key, delta=None):
+        with self._lock:
+            try:
+                (value, size, timestamp) = self._entries[key]
+            except KeyError as e:
+                raise CacheKeyMissError(key) from e
+
+            delta = delta or self.delta
+            age = time.time() - timestamp
+            if delta >= 0 and age > delta:
+                if age <= delta + self.grace:
+                    raise CacheKeyStaleError(key, value)
+
+                self._remove(key)
+                raise CacheKeyExpiredError(key)
+
+            self._usage.touch(key)
+            return value
+
+    def delete(self, key):
+        with self._lock:
+            try:
+                self._remove(key)
+            except KeyError as e:
+                raise CacheKeyMissError(key) from e
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                self._remove(key)
+
+    def stats(self):
+        """
+        Returns a dict with cache counters and occupancy
+        """
+        ret = super().stats()
+        with self._lock:
+            ret.update({
+                'entries': len(self._entries),
+                'size': self._size,
+                'evictions': self.evictions,
+            })
+
+        return ret
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+
+class PickleSerializer:
+    """
+    Serializes values with pickle
+    """
+    def __init__(self, protocol=pickle.HIGHEST_PROTOCOL):
+        self.protocol = protocol
+
+    def dumps(self, value):
+        return pickle.dumps(value, protocol=self.protocol)
+
+    def loads(self, buff):
+        return pickle.loads(buff)
+
+
+class RawSerializer:
+    """
+    Passthrough serializer, only accepts bytes-like values.
+    Values are returned as bytes.
+    """
+    def dumps(self, value):
+        if not isinstance(value, (bytes, bytearray, memoryview)):
+            raise TypeError(value)
+
+        return value
+
+    def loads(self, buff):
+        return bytes(buff)
+
+
+class JSONSerializer:
+    """
+    Serializes values as UTF-8 encoded JSON
+    """
+    def dumps(self, value):
+        return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+    def loads(self, buff):
+        return json.loads(bytes(buff).decode('utf-8'))
+
+
+class ZlibCodec:
+    def __init__(self, level=6):
+        self.level = level
+
+    def compress(self, buff):
+        return zlib.compress(buff, self.level)
+
+    def decompress(self, buff):
+        try:
+            return zlib.decompress(buff)
+        except zlib.error as e:
+            raise ValueError(e) from e
+
+
+class LZMACodec:
+    def __init__(self, preset=1):
+        self.preset = preset
+
+    def compress(self, buff):
+        return lzma.compress(buff, preset=self.preset)
+
+    def decompress(self, buff):
+        try:
+            return lzma.decompress(buff)
+        except lzma.LZMAError as e:
+            raise ValueError(e) from e
+
+
+def _umask_file_mode():
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+# Permissions of files created by open(), read once as umask can only be
+# read by changing it
+_FILE_MODE = _umask_file_mode()
+
+
+def _mkstemp(**kwargs):
+    """
+    tempfile.mkstemp creating files with the same permissions as open()
+    instead of owner-only ones, so they can be shared with other users
+    """
+    (fd, path) = tempfile.mkstemp(**kwargs)
+    if hasattr(os, 'fchmod'):
+        os.fchmod(fd, _FILE_MODE)
+
+    return (fd, path)
+
+
+def _close_cache(ref):
+    c = ref()
+    if c is not None:
+        c.close()
+
+
+def _tiered_cache_writer(ref):
+    # Holds a weak reference like _disk_cache_sweeper
+    while True:
+        c = ref()
+        if c is None:
+            return
+
+        with c._cond:
+            c._cond.wait_for(
+                lambda: c._closed or len(c._pending) >= c.batch_size,
+                timeout=c.flush_interval)
+            if c._closed:
+                return
+
+        # Taking and writing under the same lock keeps disk writes in
+        # order with flush()
+        with c._write_lock:
+            c._write(c._take(c.batch_size))
+
+        del c
+
+
+def _write_pending(disk, pending):
+    # Pending writes of a collected TieredCache
+    for (key, value) in list(pending.items()):
+        try:
+            disk.set(key, value)
+        except Exception:
+            pass
+
+
+def _disk_cache_sweeper(ref):
+    # Holds a weak reference so the cache can be collected while the
+    # sweeper is running
+    while True:
+        c = ref()
+        if c is None:
+            return
+
+        with c._cond:
+            c._cond.wait_for(
+                lambda: c._closed or c._over_limits(),
+                timeout=c.sweep_interval)
+            if c._closed:
+                return
+
+        c.sweep()
+        del c
+
 
 class DiskCache(BaseCache):
-    def __init__(self, basedir=None, delta=-1, hashfunc=hashfunc):
+    INDEX_FILENAME = '.index'
+
+    # Entry header: magic, payload length and payload crc32
+    _HEADER = struct.Struct('<4sII')
+    _MAGIC = b'APKC'
+
+    # Entry flags, used only if a codec is set
+    _PLAIN = b'\x00'
+    _COMPRESSED = b'\x01'
+
+    _TMP_PREFIX = '.tmp-'
+    # Temporary files older than this are leftovers from crashed writers
+    _TMP_MAX_AGE = 3600
+
+    def __init__(self, basedir=None, delta=-1, hashfunc=hashfunc,
+                 max_size=0, max_entries=0, sweep_interval=60,
+                 serializer=None, codec=None, codec_threshold=1024,
+                 zero_copy=False, grace=0, fanout=2, shared=False):
         """
         Disk-based cache.
         Parameters:
@@ -87,74 +733,2199 @@ class DiskCache(BaseCache):
                     will be used.
           delta - Seconds needed before a entry is considered expired. Zero or
                   negative values means that entries will never expire.
-          hashfun - A callable that will be use to transform keys into strings.
+          hashfunc - A callable that will be use to transform keys into
+                     strings, valid as file names.
+          fanout - Number of directory levels under basedir. Each level
+                   uses two characters of hashed keys, so with hex digests
+                   each directory holds at most 256 subdirectories and
+                   files are spread over 256 ** fanout directories.
+          shared - basedir is shared with other processes. Entries are
+                   always written atomically and checksummed so any number
+                   of processes can read and write the same basedir without
+                   locking; with shared set, sweeps also rescan basedir to
+                   account for entries written by other processes.
+          max_size - Maximum total size in bytes of cache files. Zero means
+                     no limit.
+          max_entries - Maximum number of cache files. Zero means no limit.
+          sweep_interval - Seconds between background sweeps when a limit is
+                           set. Least recently used entries over the limits
+                           and expired entries are deleted by the sweeper.
+          serializer - Object with dumps and loads methods used to convert
+                       values to bytes and back: PickleSerializer (default),
+                       RawSerializer or JSONSerializer.
+          codec - Object with compress and decompress methods, ZlibCodec or
+                  LZMACodec, or None for no compression. Changing codec
+                  on existing cache directories is not supported.
+          codec_threshold - Minimum serialized size in bytes for an entry to
+                            be compressed.
+          zero_copy - Raw bytes mode: values must be bytes-like and get
+                      returns a read-only memoryview over a mmap of the
+                      entry file. Implies RawSerializer and no codec.
+                      Entries are replaced atomically so views remain
+                      valid after the key is updated or deleted.
+          grace - Seconds after expiration during which entries are kept
+                  and get raises CacheKeyStaleError, carrying the stale
+                  value, instead of CacheKeyExpiredError.
         """
+        if zero_copy:
+            if not isinstance(serializer or RawSerializer(), RawSerializer) \
+               or codec is not None:
+                raise ValueError('zero_copy requires RawSerializer and no '
+                                 'codec')
+            serializer = RawSerializer()
+
         self.basedir = basedir
         self.delta = delta
+        self.serializer = serializer or PickleSerializer()
+        self.codec = codec
+        self.codec_threshold = codec_threshold
+        self.zero_copy = zero_copy
+        self.grace = grace
+        self.hashfunc = hashfunc
+        self.fanout = fanout
+        self.shared = shared
+        self.max_size = max_size
+        self.max_entries = max_entries
+        self.sweep_interval = sweep_interval
         self._is_tmp = False
 
         if not self.basedir:
             self.basedir = tempfile.mkdtemp()
             self._is_tmp = True
 
-    def _on_disk_path(self, key):
-        hashed = hashfunc(key)
+        # Size and access index, loaded on demand. Maps hashed keys to
+        # [size, mtime] in least recently used order
+        self._index = None
+        self._size = 0
+        self._evictions = 0
+        # Expired entries deleted by sweep, they aren't lookups
+        self._sweep_expirations = 0
+        self._lock = threading.RLock()
+        self._cond = threading.Condition(self._lock)
+        self._closed = False
+        self._sweeper = None
+
+        if self.max_size > 0 or self.max_entries > 0:
+            self._load_index()
+            self._sweeper = threading.Thread(
+                target=_disk_cache_sweeper, args=(weakref.ref(self),),
+                name='DiskCache sweeper', daemon=True)
+            self._sweeper.start()
+            atexit.register(_close_cache, weakref.ref(self))
+
+    def _hashed(self, key):
+        return self.hashfunc(key)
+
+    def _path(self, hashed):
         return os.path.join(
-            self.basedir, hashed[:0], hashed[:1], hashed[:2], hashed)
+            self.basedir,
+            *[hashed[idx:idx + 2] for idx in range(0, self.fanout * 2, 2)],
+            hashed)
 
-    def set(self, key, value):
-        p = self._on_disk_path(key)
-        dname = os.path.dirname(p)
+    def _on_disk_path(self, key):
+        return self._path(self._hashed(key))
 
-        os.makedirs(dname, exist_ok=True)
-        with open(p, 'wb') as fh:
-            fh.write(pickle.dumps(value))
+    def _load_index(self):
+        """
+        Loads the index file saved by close() or scans basedir if it's
+        missing, unreadable or wasn't saved on a clean close.
+        """
+        index_path = os.path.join(self.basedir, self.INDEX_FILENAME)
+        entries = None
 
-    def get(self, key, delta=None):
-        on_disk = self._on_disk_path(key)
         try:
-            s = os.stat(on_disk)
+            with open(index_path, 'rb') as fh:
+                data = pickle.loads(fh.read())
+        except (OSError, EOFError, pickle.UnpicklingError):
+            data = None
 
-        except (OSError, IOError) as e:
-            raise CacheKeyMissError(key) from e
+        if isinstance(data, dict) and data.get('clean'):
+            entries = data['entries']
 
-        delta = delta or self.delta
-        if delta >= 0 and \
-           (time.mktime(time.localtime()) - s.st_mtime > delta):
-            os.unlink(on_disk)
-            raise CacheKeyExpiredError(key)
+            # Entries written from now on are not in the saved index, it
+            # must not be trusted if this process dies before close()
+            try:
+                os.unlink(index_path)
+            except FileNotFoundError:
+                pass
+
+        if entries is None:
+            entries = self._scan()
+
+        entries.sort(key=lambda x: x[3])
+
+        with self._lock:
+            self._index = collections.OrderedDict(
+                (hashed, [size, mtime])
+                for (hashed, size, mtime, atime) in entries)
+            self._size = sum(x[0] for x in self._index.values())
+
+    def _scan(self):
+        """
+        Returns a (hashed, size, mtime, atime) tuple for each entry in
+        basedir. Temporary files left by crashed writers are deleted.
+        """
+        entries = []
+        now = time.time()
+        tmp_prefixes = (self._TMP_PREFIX, self.INDEX_FILENAME + '.')
+
+        for (dirpath, dirnames, filenames) in os.walk(self.basedir):
+            for name in filenames:
+                if not name.startswith('.'):
+                    path = os.path.join(dirpath, name)
+                elif name.startswith(tmp_prefixes):
+                    path = os.path.join(dirpath, name)
+                else:
+                    continue
+
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+
+                if name.startswith(tmp_prefixes):
+                    if now - st.st_mtime > self._TMP_MAX_AGE:
+                        try:
+                            os.unlink(path)
+                        except OSError:
+                            pass
+                    continue
+
+                entries.append((name, st.st_size, st.st_mtime, st.st_atime))
+
+        return entries
+
+    def _rescan(self):
+        """
+        Updates the index with entries written or deleted by other
+        processes. Entries used by this process keep their relative order
+        as the most recently used ones.
+        """
+        entries = self._scan()
+        entries.sort(key=lambda x: max(x[2], x[3]))
+
+        with self._lock:
+            index = collections.OrderedDict(
+                (hashed, [size, mtime])
+                for (hashed, size, mtime, atime) in entries)
+
+            for hashed in self._index:
+                if hashed in index:
+                    index.move_to_end(hashed)
+
+            self._index = index
+            self._size = sum(x[0] for x in index.values())
+
+    def _save_index(self):
+        """
+        Saves the index. Only done on close, the saved index is trusted by
+        the next _load_index.
+        """
+        with self._lock:
+            if self._index is None:
+                return
+
+            now = time.time()
+            n = len(self._index)
+            # Access order is what matters, make up increasing atimes
+            entries = [
+                (hashed, size, mtime, now - n + idx)
+                for (idx, (hashed, (size, mtime)))
+                in enumerate(self._index.items())]
+
+        # Other processes may save concurrently, use a unique temp file
+        (fd, tmp) = _mkstemp(dir=self.basedir,
+                             prefix=self.INDEX_FILENAME + '.')
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(pickle.dumps({'clean': True, 'entries': entries}))
+        os.replace(tmp, os.path.join(self.basedir, self.INDEX_FILENAME))
+
+    def _index_add(self, hashed, size, mtime):
+        with self._lock:
+            if self._index is None:
+                return
+
+            prev = self._index.pop(hashed, None)
+            if prev is not None:
+                self._size -= prev[0]
+
+            self._index[hashed] = [size, mtime]
+            self._size += size
+
+            if self._over_limits():
+                self._cond.notify()
 
+    def _index_touch(self, hashed, size, mtime):
+        with self._lock:
+            if self._index is None:
+                return
+
+            if hashed in self._index:
+                self._index.move_to_end(hashed)
+            else:
+                self._index_add(hashed, size, mtime)
+
+    def _index_remove(self, hashed):
+        with self._lock:
+            if self._index is None:
+                return
+
+            prev = self._index.pop(hashed, None)
+            if prev is not None:
+                self._size -= prev[0]
+
+    def _over_limits(self):
+        if self._index is None:
+            return False
+
+        return ((self.max_entries > 0 and
+                 len(self._index) > self.max_entries) or
+                (self.max_size > 0 and self._size > self.max_size))
+
+    def _unlink(self, hashed):
         try:
-            with open(on_disk, 'rb') as fh:
-                return pickle.loads(fh.read())
+            os.unlink(self._path(hashed))
+        except FileNotFoundError:
+            pass
 
-        except EOFError as e:
-            os.unlink(on_disk)
-            raise CacheKeyError(key) from e
+        self._index_remove(hashed)
 
-        except IOError as e:
-            raise CacheIOError() from e
+    def sweep(self):
+        """
+        Deletes expired entries and least recently used entries until cache
+        is within its limits. Run periodically in background if some limit
+        is set.
+        """
+        if self._index is None:
+            self._load_index()
+        elif self.shared:
+            self._rescan()
 
-        except OSError as e:
-            raise CacheOSError() from e
+        if self.delta >= 0:
+            now = time.time()
+            with self._lock:
+                expired = [hashed for (hashed, (size, mtime))
+                           in self._index.items()
+                           if now - mtime > self.delta + self.grace]
 
-    def __del__(self):
-        if self._is_tmp:
-            shutil.rmtree(self.basedir)
+            for hashed in expired:
+                with self._lock:
+                    if hashed in self._index:
+                        self._unlink(hashed)
+                        self._sweep_expirations += 1
 
+        # Files are deleted one by one, without holding the lock for the
+        # whole sweep
+        while True:
+            with self._lock:
+                if not self._over_limits() or not self._index:
+                    break
 
-class CacheKeyError(KeyError):
-    """
-    Base class for cache errors
-    """
-    pass
+                self._unlink(next(iter(self._index)))
+                self._evictions += 1
 
+    def stats(self):
+        """
+        Returns a dict with cache counters, occupancy and limits
+        """
+        if self._index is None:
+            self._load_index()
 
-class CacheKeyMissError(CacheKeyError):
-    """
-    Requested key is missing in cache
-    """
-    pass
+        ret = super().stats()
+        with self._lock:
+            ret.update({
+                'entries': len(self._index),
+                'size': self._size,
+                'max_entries': self.max_entries,
+                'max_size': self.max_size,
+                'evictions': self._evictions,
+                'sweep_expirations': self._sweep_expirations,
+            })
+
+        return ret
+
+    def close(self):
+        """
+        Stops background sweeper and saves index
+        """
+        with self._cond:
+            if self._closed:
+                return
+
+            self._closed = True
+            self._cond.notify()
+
+        if self._sweeper is not None and \
+           self._sweeper is not threading.current_thread():
+            self._sweeper.join()
+
+        # basedir may be already gone when closing at exit
+        if not self._is_tmp and os.path.isdir(self.basedir):
+            self._save_index()
+
+    def _write(self, hashed, buff, dirs=None):
+        header = self._HEADER.pack(self._MAGIC, len(buff), zlib.crc32(buff))
+        return self._write_file(hashed, (header, buff), dirs=dirs)
+
+    def _write_file(self, hashed, chunks, dirs=None, mtime=None):
+        p = self._path(hashed)
+        dname = os.path.dirname(p)
+
+        if dirs is None or dname not in dirs:
+            os.makedirs(dname, exist_ok=True)
+            if dirs is not None:
+                dirs.add(dname)
+
+        # Write a new file and rename it over the old one: readers, in this
+        # or other processes, see either the old or the new entry, never a
+        # partial one, and mmap'ed old entries are not truncated
+        (fd, tmp) = _mkstemp(dir=dname, prefix=self._TMP_PREFIX)
+        try:
+            size = 0
+            with os.fdopen(fd, 'wb') as fh:
+                for chunk in chunks:
+                    fh.write(chunk)
+                    size += len(chunk)
+
+            if mtime is not None:
+                os.utime(tmp, (mtime, mtime))
+
+            os.replace(tmp, p)
+            return size
+
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+
+    def _encode(self, value):
+        buff = self.serializer.dumps(value)
+        if self.codec is None:
+            return buff
+
+        if len(buff) >= self.codec_threshold:
+            return self._COMPRESSED + self.codec.compress(buff)
+
+        return self._PLAIN + buff
+
+    def _decode(self, buff):
+        if self.codec is not None:
+            if buff[:1] == self._COMPRESSED:
+                buff = self.codec.decompress(buff[1:])
+            elif buff[:1] == self._PLAIN:
+                buff = buff[1:]
+            else:
+                raise ValueError('Unknow entry flag')
+
+        return self.serializer.loads(buff)
+
+    @_instrumented_set
+    def set(self, key, value):
+        hashed = self._hashed(key)
+        size = self._write(hashed, self._encode(value))
+        self.metrics.bytes_written += size
+        self._index_add(hashed, size, time.time())
+
+    def set_many(self, mapping):
+        dirs = set()
+        written = []
+        for (key, value) in mapping.items():
+            hashed = self._hashed(key)
+            size = self._write(hashed, self._encode(value), dirs=dirs)
+            written.append((hashed, size))
+            self.metrics.bytes_written += size
+
+        now = time.time()
+        with self._lock:
+            for (hashed, size) in written:
+                self._index_add(hashed, size, now)
+
+    def _payload(self, buff):
+        """
+        Returns a memoryview of the payload of an entry or None if the entry
+        is torn or corrupt
+        """
+        hsize = self._HEADER.size
+        if len(buff) < hsize:
+            return None
+
+        (magic, length, crc) = self._HEADER.unpack_from(buff)
+        if magic != self._MAGIC or length != len(buff) - hsize:
+            return None
+
+        payload = memoryview(buff)[hsize:]
+        if zlib.crc32(payload) != crc:
+            return None
+
+        return payload
+
+    def hashed_keys(self):
+        """
+        Returns the hashed keys of all entries in basedir, including entries
+        written by other processes.
+        """
+        return [x[0] for x in self._scan()]
+
+    def load_raw(self, hashed):
+        """
+        Returns a (mtime, data) tuple with the contents of the entry file for
+        a hashed key, as stored on disk, or None if it's missing or broken.
+        Used to copy entries between caches with the same configuration.
+        """
+        try:
+            with open(self._path(hashed), 'rb') as fh:
+                mtime = os.fstat(fh.fileno()).st_mtime
+                buff = fh.read()
+        except FileNotFoundError:
+            return None
+
+        if self._payload(buff) is None:
+            return None
+
+        return (mtime, buff)
+
+    def store_raw(self, hashed, buff, mtime=None, dirs=None):
+        """
+        Stores data returned by load_raw for a hashed key.
+        Parameters:
+          hashed - Hashed key.
+          buff - Entry data.
+          mtime - Entry timestamp, now if None.
+          dirs - Optional set of directories known to exist, updated on
+                 return. Saves makedirs calls when storing many entries.
+        """
+        if not hashed.isalnum():
+            raise ValueError('Invalid hashed key')
+
+        if self._payload(buff) is None:
+            raise ValueError('Broken entry')
+
+        size = self._write_file(hashed, (buff,), dirs=dirs, mtime=mtime)
+        self.metrics.bytes_written += size
+        self._index_add(hashed, size,
+                        mtime if mtime is not None else time.time())
+
+    def _discard(self, hashed, st):
+        """
+        Deletes an entry if its file is still the one described by st.
+        Another process could have replaced it after we opened it.
+        """
+        try:
+            current = os.stat(self._path(hashed))
+        except FileNotFoundError:
+            self._index_remove(hashed)
+            return
+
+        if (current.st_ino, current.st_dev) == (st.st_ino, st.st_dev):
+            self._unlink(hashed)
+
+    def _read(self, hashed, delta, now):
+        """
+        Returns a (value, error) tuple. error is the CacheKeyError subclass
+        for a missing, expired, stale or broken entry or None. value is set
+        for stale entries too.
+        Misses are not raised so get_many doesn't pay for exceptions.
+        """
+        try:
+            fh = open(self._path(hashed), 'rb')
+        except OSError:
+            self._index_remove(hashed)
+            return (None, CacheKeyMissError)
+
+        buff = None
+        try:
+            with fh:
+                s = os.fstat(fh.fileno())
+                age = now - s.st_mtime
+                expired = delta >= 0 and age > delta
+                stale = expired and age <= delta + self.grace
+                if expired and not stale:
+                    pass
+                elif not self.zero_copy:
+                    buff = fh.read()
+                elif s.st_size >= self._HEADER.size:
+                    buff = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+        except (OSError, ValueError) as e:
+            raise CacheIOError() from e
+
+        if expired and not stale:
+            self._discard(hashed, s)
+            return (None, CacheKeyExpiredError)
+
+        self.metrics.bytes_read += s.st_size
+        payload = self._payload(buff) if buff is not None else None
+        if payload is None:
+            self._discard(hashed, s)
+            return (None, CacheKeyError)
+
+        if self.zero_copy:
+            value = payload
+        else:
+            try:
+                value = self._decode(payload)
+            except (EOFError, ValueError, pickle.UnpicklingError):
+                self._discard(hashed, s)
+                return (None, CacheKeyError)
+
+        if stale:
+            return (value, CacheKeyStaleError)
+
+        self._index_touch(hashed, s.st_size, s.st_mtime)
+        return (value, None)
+
+    @_instrumented_get
+    def get(self, key, delta=None):
+        delta = delta or self.delta
+        (value, error) = self._read(self._hashed(key), delta, time.time())
+        if error is CacheKeyStaleError:
+            raise CacheKeyStaleError(key, value)
+
+        if error is not None:
+            raise error(key)
+
+        return value
+
+    def get_many(self, keys, delta=None):
+        delta = delta or self.delta
+        now = time.time()
+        hits = {}
+        misses = set()
+
+        expirations = 0
+        for key in keys:
+            (value, error) = self._read(self._hashed(key), delta, now)
+            if error is None:
+                hits[key] = value
+            else:
+                misses.add(key)
+                if issubclass(error, CacheKeyExpiredError):
+                    expirations += 1
+
+        metrics = self.metrics
+        metrics.hits += len(hits)
+        metrics.misses += len(misses) - expirations
+        metrics.expirations += expirations
+        return (hits, misses)
+
+    def delete(self, key):
+        if self.delete_many([key]):
+            raise CacheKeyMissError(key)
+
+    def delete_many(self, keys):
+        misses = set()
+        for key in keys:
+            hashed = self._hashed(key)
+            try:
+                os.unlink(self._path(hashed))
+            except FileNotFoundError:
+                misses.add(key)
+
+            self._index_remove(hashed)
+
+        return misses
+
+    def __del__(self):
+        if getattr(self, '_is_tmp', False):
+            shutil.rmtree(self.basedir)
+
+
+def _packed_cache_compactor(ref):
+    while True:
+        c = ref()
+        if c is None:
+            return
+
+        with c._cond:
+            c._cond.wait(timeout=c.compact_interval)
+            if c._closed:
+                return
+
+        c.compact()
+        del c
+
+
+class PackedDiskCache(BaseCache):
+    SEGMENT_PREFIX = 'segment-'
+    SEGMENT_SUFFIX = '.dat'
+    INDEX_FILENAME = 'index'
+    # Bytes copied by compact() between releases of the lock
+    COMPACT_BATCH_SIZE = 256 * 1024
+
+    # Record header: key length, value length and timestamp. A value length
+    # of _TOMBSTONE marks a deleted key.
+    _HEADER = struct.Struct('<HId')
+    _TOMBSTONE = 0xFFFFFFFF
+
+    def __init__(self, basedir=None, delta=-1, segment_size=64 * 1024 * 1024,
+                 compact_ratio=0.5, compact_interval=60):
+        """
+        Disk-based cache storing all entries into a few large append-only
+        segment files instead of one file per key.
+        Updates and deletions append new records, dead records are
+        reclaimed by compaction. Reads are served from mmap'ed segments.
+        The index is kept in memory, a basedir must be used by a single
+        process at a time.
+        Parameters:
+          basedir - Root path for cache. If None is suplied then a temporal
+                    dir will be used.
+          delta - Seconds needed before a entry is considered expired. Zero or
+                  negative values means that entries will never expire.
+          segment_size - Size in bytes after which a new segment is started.
+          compact_ratio - Minimum ratio of dead bytes for a segment to be
+                          compacted.
+          compact_interval - Seconds between background compactions. Zero or
+                             negative values disables background compaction.
+        """
+        self.basedir = basedir
+        self.delta = delta
+        self.segment_size = segment_size
+        self.compact_ratio = compact_ratio
+        self.compact_interval = compact_interval
+        self._is_tmp = False
+
+        if not self.basedir:
+            self.basedir = tempfile.mkdtemp()
+            self._is_tmp = True
+
+        os.makedirs(self.basedir, exist_ok=True)
+
+        # Maps keys to (segment, value offset, value length, timestamp)
+        self._index = {}
+        # Maps segments to [size, live bytes]
+        self._segments = {}
+        self._maps = {}
+        self._active = None
+        self._fh = None
+        self._lock = threading.RLock()
+        self._cond = threading.Condition(self._lock)
+        self._closed = False
+
+        self._load()
+
+        self._compactor = None
+        if self.compact_interval > 0:
+            self._compactor = threading.Thread(
+                target=_packed_cache_compactor, args=(weakref.ref(self),),
+                name='PackedDiskCache compactor', daemon=True)
+            self._compactor.start()
+
+        atexit.register(_close_cache, weakref.ref(self))
+
+    def _segment_path(self, segment):
+        return os.path.join(
+            self.basedir,
+            '{}{:08d}{}'.format(self.SEGMENT_PREFIX, segment,
+                                self.SEGMENT_SUFFIX))
+
+    def _record_size(self, key, length):
+        return self._HEADER.size + len(key.encode('utf-8')) + length
+
+    def _iter_records(self, buff, offset=0):
+        """
+        Yields (key, value offset, value length, timestamp, record end)
+        for each complete record in buff starting at offset.
+        """
+        hsize = self._HEADER.size
+        end = len(buff)
+
+        while offset + hsize <= end:
+            (klen, vlen, ts) = self._HEADER.unpack_from(buff, offset)
+            koffset = offset + hsize
+            voffset = koffset + klen
+            rend = voffset + (0 if vlen == self._TOMBSTONE else vlen)
+            if rend > end:
+                break
+
+            key = bytes(buff[koffset:voffset]).decode('utf-8')
+            yield (key, voffset, vlen, ts, rend)
+            offset = rend
+
+    def _load(self):
+        segments = []
+        for name in os.listdir(self.basedir):
+            if name.startswith(self.SEGMENT_PREFIX) and \
+               name.endswith(self.SEGMENT_SUFFIX):
+                segments.append(int(
+                    name[len(self.SEGMENT_PREFIX):-len(self.SEGMENT_SUFFIX)]))
+        segments.sort()
+
+        try:
+            with open(os.path.join(self.basedir, self.INDEX_FILENAME),
+                      'rb') as fh:
+                (index, scanned) = pickle.loads(fh.read())
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+            (index, scanned) = ({}, {})
+
+        if any(seg not in segments for seg in scanned):
+            # Some segment is gone, the saved index can't be trusted
+            (index, scanned) = ({}, {})
+
+        last_scanned = max(scanned) if scanned else -1
+        for seg in list(segments):
+            # Segments older than the saved index and not referenced by it
+            # are leftovers from an interrupted compaction
+            if seg < last_scanned and seg not in scanned:
+                os.unlink(self._segment_path(seg))
+                segments.remove(seg)
+
+        for seg in segments:
+            path = self._segment_path(seg)
+            with open(path, 'rb') as fh:
+                buff = fh.read()
+
+            good = scanned.get(seg, 0)
+            for (key, voffset, vlen, ts, rend) in \
+                    self._iter_records(buff, good):
+                if vlen == self._TOMBSTONE:
+                    index.pop(key, None)
+                else:
+                    index[key] = (seg, voffset, vlen, ts)
+                good = rend
+
+            # Drop torn records at the tail
+            if good < len(buff):
+                os.truncate(path, good)
+
+            self._segments[seg] = [good, 0]
+
+        for (key, (seg, voffset, vlen, ts)) in index.items():
+            self._segments[seg][1] += self._record_size(key, vlen)
+
+        self._index = index
+
+        if segments and self._segments[segments[-1]][0] < self.segment_size:
+            self._open_segment(segments[-1])
+        else:
+            self._open_segment(segments[-1] + 1 if segments else 0)
+
+    def _save_index(self):
+        with self._lock:
+            buff = pickle.dumps(
+                (self._index,
+                 {seg: info[0] for (seg, info) in self._segments.items()}),
+                protocol=pickle.HIGHEST_PROTOCOL)
+
+        (fd, tmp) = _mkstemp(dir=self.basedir,
+                             prefix=self.INDEX_FILENAME + '.')
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(buff)
+        os.replace(tmp, os.path.join(self.basedir, self.INDEX_FILENAME))
+
+    def _open_segment(self, segment):
+        if self._fh is not None:
+            self._fh.close()
+
+        self._active = segment
+        self._fh = open(self._segment_path(segment), 'ab')
+        self._segments.setdefault(segment, [0, 0])
+
+    def _map(self, segment, end):
+        mm = self._maps.get(segment)
+        if mm is None or len(mm) < end:
+            if mm is not None:
+                mm.close()
+
+            with open(self._segment_path(segment), 'rb') as fh:
+                mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[segment] = mm
+
+        return mm
+
+    def _unmap(self, segment):
+        mm = self._maps.pop(segment, None)
+        if mm is not None:
+            mm.close()
+
+    def _append(self, key, buff, timestamp):
+        """
+        Appends a record to the active segment and updates the index.
+        buff is None for tombstones. Must be called with the lock held.
+        """
+        kbuff = key.encode('utf-8')
+        vlen = self._TOMBSTONE if buff is None else len(buff)
+
+        info = self._segments[self._active]
+        offset = info[0]
+        self._fh.write(self._HEADER.pack(len(kbuff), vlen, timestamp))
+        self._fh.write(kbuff)
+        if buff is not None:
+            self._fh.write(buff)
+        self._fh.flush()
+
+        rsize = self._HEADER.size + len(kbuff) + (len(buff or b''))
+        info[0] += rsize
+
+        prev = self._index.pop(key, None)
+        if prev is not None:
+            self._segments[prev[0]][1] -= self._record_size(key, prev[2])
+
+        if buff is not None:
+            self._index[key] = (self._active,
+                                offset + self._HEADER.size + len(kbuff),
+                                len(buff), timestamp)
+            info[1] += rsize
+
+        if info[0] >= self.segment_size:
+            self._open_segment(self._active + 1)
+
+    @_instrumented_set
+    def set(self, key, value):
+        buff = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+        with self._lock:
+            if self._closed:
+                raise CacheIOError('Cache is closed')
+
+            self._append(key, buff, time.time())
+            self.metrics.bytes_written += len(buff)
+
+    @_instrumented_get
+    def get(self, key, delta=None):
+        with self._lock:
+            try:
+                (seg, offset, length, ts) = self._index[key]
+            except KeyError as e:
+                raise CacheKeyMissError(key) from e
+
+            delta = delta or self.delta
+            if delta >= 0 and time.time() - ts > delta:
+                self._append(key, None, time.time())
+                raise CacheKeyExpiredError(key)
+
+            try:
+                buff = self._map(seg, offset + length)[offset:offset + length]
+            except OSError as e:
+                raise CacheOSError() from e
+
+            self.metrics.bytes_read += length
+
+        try:
+            return pickle.loads(buff)
+        except (EOFError, pickle.UnpicklingError) as e:
+            raise CacheKeyError(key) from e
+
+    def delete(self, key):
+        with self._lock:
+            if key not in self._index:
+                raise CacheKeyMissError(key)
+
+            self._append(key, None, time.time())
+
+    def compact(self):
+        """
+        Rewrites live records from segments with too many dead bytes into
+        the active segment and removes them.
+        Expired entries are dropped in the process.
+        """
+        with self._lock:
+            candidates = [
+                seg for (seg, (size, live)) in self._segments.items()
+                if seg != self._active and
+                (size == 0 or (size - live) / size >= self.compact_ratio)]
+
+        if not candidates:
+            return
+
+        now = time.time()
+        for seg in sorted(candidates):
+            with self._lock:
+                if self._closed:
+                    return
+
+                size = self._segments[seg][0]
+                mm = self._map(seg, size) if size else b''
+                records = self._iter_records(mm)
+
+            # Records are copied in small batches, releasing the lock
+            # between them so reads and writes are not blocked for the
+            # whole segment
+            done = False
+            while not done:
+                with self._lock:
+                    if self._closed:
+                        return
+
+                    copied = 0
+                    for (key, voffset, vlen, ts, rend) in records:
+                        if self._index.get(key) != (seg, voffset, vlen, ts):
+                            continue
+
+                        if self.delta >= 0 and now - ts > self.delta:
+                            self._index.pop(key)
+                            self._segments[seg][1] -= \
+                                self._record_size(key, vlen)
+                            continue
+
+                        self._append(key, mm[voffset:voffset + vlen], ts)
+                        copied += vlen
+                        if copied >= self.COMPACT_BATCH_SIZE:
+                            break
+                    else:
+                        done = True
+                        self._unmap(seg)
+                        del self._segments[seg]
+
+        # Index must be saved before segments are removed, see _load
+        self._save_index()
+        for seg in candidates:
+            try:
+                os.unlink(self._segment_path(seg))
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        """
+        Returns a dict with cache counters and occupancy
+        """
+        ret = super().stats()
+        with self._lock:
+            size = sum(info[0] for info in self._segments.values())
+            live = sum(info[1] for info in self._segments.values())
+            ret.update({
+                'entries': len(self._index),
+                'segments': len(self._segments),
+                'size': size,
+                'dead': size - live,
+            })
+
+        return ret
+
+    def close(self):
+        """
+        Stops background compaction, saves index and releases files
+        """
+        with self._cond:
+            if self._closed:
+                return
+
+            self._closed = True
+            self._cond.notify()
+
+        if self._compactor is not None and \
+           self._compactor is not threading.current_thread():
+            self._compactor.join()
+
+        with self._lock:
+            self._fh.close()
+            for seg in list(self._maps):
+                self._unmap(seg)
+
+        if os.path.isdir(self.basedir):
+            self._save_index()
+
+    def __del__(self):
+        if getattr(self, '_is_tmp', False):
+            shutil.rmtree(self.basedir, ignore_errors=True)
+
+
+class SQLiteCache(BaseCache):
+    def __init__(self, path=None, delta=-1, vacuum_interval=300, echo=False):
+        """
+        Cache stored in a single SQLite database in WAL mode, it can be
+        shared by several processes.
+        Requires sqlalchemy.
+        Parameters:
+          path - Path to database file. If None is suplied then a temporal
+                 file will be used.
+          delta - Seconds needed before a entry is considered expired. Zero or
+                  negative values means that entries will never expire.
+          vacuum_interval - Minimum seconds between deletions of expired
+                            rows. They are triggered by writes.
+          echo - Log all SQL statements.
+        """
+        from appkit.db import sqlalchemyutils
+
+        self.path = path
+        self.delta = delta
+        self.vacuum_interval = vacuum_interval
+        self._is_tmp = False
+
+        if not self.path:
+            (fd, self.path) = tempfile.mkstemp(suffix='.sqlite')
+            os.close(fd)
+            self._is_tmp = True
+
+        self._sql = sqlalchemyutils.sqlalchemy.text
+        self._engine = sqlalchemyutils.create_engine(
+            'sqlite:///' + self.path, echo=echo,
+            pragmas={'journal_mode': 'WAL', 'synchronous': 'NORMAL'})
+        self._last_vacuum = time.time()
+
+        with self._engine.begin() as conn:
+            conn.execute(self._sql(
+                'CREATE TABLE IF NOT EXISTS cache ('
+                'key TEXT PRIMARY KEY, '
+                'value BLOB NOT NULL, '
+                'timestamp REAL NOT NULL, '
+                'expires REAL)'))
+            conn.execute(self._sql(
+                'CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires)'))
+
+    def _row(self, key, value, now):
+        return {
+            'key': key,
+            'value': pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL),
+            'timestamp': now,
+            'expires': now + self.delta if self.delta >= 0 else None,
+        }
+
+    def _fetch(self, conn, key, delta, now):
+        row = conn.execute(
+            self._sql('SELECT value, timestamp, expires FROM cache '
+                      'WHERE key = :key'),
+            {'key': key}).fetchone()
+
+        if row is None:
+            raise CacheKeyMissError(key)
+
+        if delta:
+            expired = delta >= 0 and now - row.timestamp > delta
+        else:
+            expired = row.expires is not None and now > row.expires
+
+        if expired:
+            raise CacheKeyExpiredError(key)
+
+        self.metrics.bytes_read += len(row.value)
+        try:
+            return pickle.loads(row.value)
+        except (EOFError, pickle.UnpicklingError) as e:
+            raise CacheKeyError(key) from e
+
+    @_instrumented_get
+    def get(self, key, delta=None):
+        with self._engine.begin() as conn:
+            return self._fetch(conn, key, delta, time.time())
+
+    def get_many(self, keys, delta=None):
+        """
+        Returns a tuple with a dict of found keys and their values and a set
+        of missing or expired keys. All keys are read in a single
+        transaction.
+        Parameters:
+          keys - Iterable of keys.
+          delta - Overrides cache delta.
+        """
+        now = time.time()
+        hits = {}
+        misses = set()
+
+        metrics = self.metrics
+        with self._engine.begin() as conn:
+            for key in keys:
+                try:
+                    hits[key] = self._fetch(conn, key, delta, now)
+                    metrics.hits += 1
+                except CacheKeyMissError:
+                    metrics.misses += 1
+                    misses.add(key)
+                except CacheKeyExpiredError:
+                    metrics.expirations += 1
+                    misses.add(key)
+                except CacheKeyError:
+                    metrics.errors += 1
+                    misses.add(key)
+
+        return (hits, misses)
+
+    @_instrumented_set
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def set_many(self, mapping):
+        """
+        Stores all key-value pairs from mapping in a single transaction.
+        """
+        now = time.time()
+        rows = [self._row(key, value, now) for (key, value) in mapping.items()]
+        if not rows:
+            return
+
+        self.metrics.bytes_written += sum(len(row['value']) for row in rows)
+
+        with self._engine.begin() as conn:
+            conn.execute(self._sql(
+                'INSERT OR REPLACE INTO cache '
+                '(key, value, timestamp, expires) '
+                'VALUES (:key, :value, :timestamp, :expires)'), rows)
+
+        if self.vacuum_interval >= 0 and \
+           now - self._last_vacuum >= self.vacuum_interval:
+            self.vacuum()
+
+    def delete(self, key):
+        if self.delete_many([key]):
+            raise CacheKeyMissError(key)
+
+    def delete_many(self, keys):
+        """
+        Deletes keys in a single transaction. Returns the set of keys not
+        found.
+        """
+        misses = set()
+        stmt = self._sql('DELETE FROM cache WHERE key = :key')
+        with self._engine.begin() as conn:
+            for key in keys:
+                if conn.execute(stmt, {'key': key}).rowcount == 0:
+                    misses.add(key)
+
+        return misses
+
+    def vacuum(self):
+        """
+        Deletes expired rows. Returns the number of deleted rows.
+        """
+        self._last_vacuum = time.time()
+        with self._engine.begin() as conn:
+            res = conn.execute(self._sql(
+                'DELETE FROM cache '
+                'WHERE expires IS NOT NULL AND expires < :now'),
+                {'now': self._last_vacuum})
+
+        return res.rowcount
+
+    def close(self):
+        self._engine.dispose()
+
+    def __del__(self):
+        if getattr(self, '_is_tmp', False):
+            self.close()
+            for suffix in ('', '-wal', '-shm'):
+                try:
+                    os.unlink(self.path + suffix)
+                except FileNotFoundError:
+                    pass
+
+
+class TieredCache(BaseCache):
+    def __init__(self, disk=None, memory=None, flush_interval=1.0,
+                 batch_size=64, max_pending=4096, logger=None):
+        """
+        Two-tier cache: a bounded memory tier in front of a disk tier.
+        Reads from disk are promoted to memory. Writes are stored in memory
+        immediately and written to disk in background, in batches; pending
+        writes for the same key are coalesced.
+        Parameters:
+          disk - Disk tier. A DiskCache on a temporal dir if None.
+          memory - Memory tier. A 1024 entries MemoryCache if None.
+          flush_interval - Maximum seconds a write waits before being
+                           flushed to disk.
+          batch_size - Maximum number of entries written in each batch.
+                       Reaching it wakes up the writer.
+          max_pending - Maximum number of entries waiting to be written,
+                        set blocks until the writer catches up.
+          logger - Logger for failed disk writes, by default
+                   appkit.loggertools' logger for 'appkit.cache'. Failed
+                   entries are kept only in the memory tier.
+        """
+        self.disk = disk if disk is not None else DiskCache()
+        self.memory = memory if memory is not None \
+            else MemoryCache(max_entries=1024)
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_pending = max(max_pending, batch_size)
+        self.logger = logger
+
+        self._pending = collections.OrderedDict()
+        # Entries taken from _pending and not yet stored on disk
+        self._inflight = {}
+        # Incremented on each set or delete, disk reads are not promoted to
+        # memory if it changes meanwhile
+        self._version = 0
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._writer = None
+        self._closed = False
+        self._write_errors = 0
+
+        atexit.register(_close_cache, weakref.ref(self))
+        finalizer = weakref.finalize(
+            self, _write_pending, self.disk, self._pending)
+        finalizer.atexit = False
+
+    @_instrumented_get
+    def get(self, key, delta=None):
+        try:
+            return self.memory.get(key, delta=delta)
+        except CacheKeyError:
+            pass
+
+        with self._cond:
+            value = self._pending.get(key, _UNDEF)
+            if value is _UNDEF:
+                value = self._inflight.get(key, _UNDEF)
+            if value is not _UNDEF:
+                return value
+
+            version = self._version
+
+        value = self.disk.get(key, delta=delta)
+
+        # Don't replace a newer value
+        with self._cond:
+            if self._version == version:
+                self.memory.set(key, value)
+
+        return value
+
+    @_instrumented_set
+    def set(self, key, value):
+        with self._cond:
+            # Wait for the writer, rewriting a pending key doesn't need room
+            self._cond.wait_for(
+                lambda: (self._closed or key in self._pending or
+                         len(self._pending) < self.max_pending))
+            if self._closed:
+                raise CacheIOError('Cache is closed')
+
+            if self._writer is None:
+                self._writer = threading.Thread(
+                    target=_tiered_cache_writer, args=(weakref.ref(self),),
+                    name='TieredCache writer', daemon=True)
+                self._writer.start()
+
+            self._version += 1
+            self.memory.set(key, value)
+            self._pending[key] = value
+            self._pending.move_to_end(key)
+
+            # Writer and blocked setters share the condition
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify_all()
+
+    def _take(self, n):
+        with self._cond:
+            n = min(n, len(self._pending))
+            ret = [self._pending.popitem(last=False) for x in range(n)]
+            self._inflight.update(ret)
+            self._cond.notify_all()
+            return ret
+
+    def _write(self, batch):
+        # A failed entry must not stop the writer or the rest of the batch
+        for (key, value) in batch:
+            try:
+                self.disk.set(key, value)
+
+            except Exception as e:
+                with self._cond:
+                    self._write_errors += 1
+
+                if self.logger is None:
+                    from appkit import loggertools
+                    self.logger = loggertools.getLogger('appkit.cache')
+
+                self.logger.error(
+                    "Cannot write {!r} to disk: {}".format(key, e))
+
+            finally:
+                with self._cond:
+                    self._inflight.pop(key, None)
+
+    def delete(self, key):
+        with self._cond:
+            self._version += 1
+            pending = self._pending.pop(key, _UNDEF) is not _UNDEF
+            self._cond.notify_all()
+
+        # Wait for a possible in-flight write of key
+        with self._write_lock:
+            found = not self.memory.delete_many([key])
+            found = not self.disk.delete_many([key]) or found or pending
+
+        if not found:
+            raise CacheKeyMissError(key)
+
+    def stats(self):
+        """
+        Returns a dict with cache counters, pending writes, failed disk
+        writes and the stats of each tier
+        """
+        ret = super().stats()
+        with self._cond:
+            ret['pending'] = len(self._pending)
+            ret['write_errors'] = self._write_errors
+
+        ret['memory'] = self.memory.stats()
+        ret['disk'] = self.disk.stats()
+        return ret
+
+    def flush(self):
+        """
+        Writes all pending entries to disk
+        """
+        with self._write_lock:
+            self._write(self._take(len(self._pending)))
+
+    def close(self):
+        """
+        Stops background writer and flushes pending entries
+        """
+        with self._cond:
+            if self._closed:
+                return
+
+            self._closed = True
+            self._cond.notify_all()
+
+        if self._writer is not None:
+            self._writer.join()
+
+        self.flush()
+
+
+class _Call:
+    __slots__ = ('event', 'result', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls: while a call for some key is running other
+    callers for the same key wait for it and share its result or
+    exception.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def in_flight(self, key):
+        with self._lock:
+            return key in self._calls
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        Calls fn(*args, **kwargs) unless a call for key is already running.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+
+        except BaseException as e:
+            call.error = e
+            raise
+
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+
+class CacheLoader:
+    def __init__(self, cache, loader, single_flight=None):
+        """
+        Read-through cache: misses are loaded with loader and stored into
+        cache. Concurrent loads of the same key are coalesced.
+        Stale entries (see grace parameter of MemoryCache and DiskCache)
+        are returned while they are reloaded in background.
+        Parameters:
+          cache - A BaseCache.
+          loader - A callable returning the value for a key.
+          single_flight - SingleFlight used to coalesce loads. It can be
+                          shared between loaders of the same keys.
+        """
+        self.cache = cache
+        self.loader = loader
+        self._flight = single_flight or SingleFlight()
+
+    def _load(self, key):
+        value = self.loader(key)
+        self.cache.set(key, value)
+        return value
+
+    def _refresh(self, key):
+        try:
+            self._flight.do(key, self._load, key)
+        except Exception:
+            # Stale value keeps being served until the grace period ends
+            pass
+
+    def refresh(self, key):
+        """
+        Reloads key in background, if it's not already being loaded.
+        """
+        if self._flight.in_flight(key):
+            return
+
+        threading.Thread(target=self._refresh, args=(key,),
+                         name='CacheLoader refresh', daemon=True).start()
+
+    def get(self, key):
+        try:
+            return self.cache.get(key)
+
+        except CacheKeyStaleError as e:
+            self.refresh(key)
+            return e.value
+
+        except CacheKeyError:
+            pass
+
+        return self._flight.do(key, self._load, key)
+
+
+def _archive_compression(path):
+    for (suffixes, compression) in (
+            (('.tar.gz', '.tgz'), 'gz'),
+            (('.tar.bz2', '.tbz2'), 'bz2'),
+            (('.tar.xz', '.txz'), 'xz')):
+        if path.endswith(suffixes):
+            return compression
+
+    return ''
+
+
+def _chunks(seq, n):
+    """
+    Splits seq in n chunks of similar size
+    """
+    size = max(1, -(-len(seq) // n))
+    return [seq[idx:idx + size] for idx in range(0, len(seq), size)]
+
+
+def _transfer_result(entries, size, t0):
+    elapsed = time.perf_counter() - t0
+    return {
+        'entries': entries,
+        'bytes': size,
+        'elapsed': elapsed,
+        'entries_per_second': entries / elapsed if elapsed else None,
+        'bytes_per_second': size / elapsed if elapsed else None,
+    }
+
+
+def _export_shard(basedir, cache_options, hashed_keys, path, compression):
+    c = DiskCache(basedir=basedir, **cache_options)
+    entries = 0
+    size = 0
+
+    with tarfile.open(path, mode='w:' + compression) as tar:
+        for hashed in hashed_keys:
+            entry = c.load_raw(hashed)
+            if entry is None:
+                continue
+
+            (mtime, buff) = entry
+            info = tarfile.TarInfo(hashed)
+            info.size = len(buff)
+            info.mtime = mtime
+            tar.addfile(info, io.BytesIO(buff))
+            entries += 1
+            size += len(buff)
+
+    return (entries, size)
+
+
+def export_disk_cache(basedir, path, jobs=None, cache_options=None):
+    """
+    Exports all valid entries of a DiskCache to a tar archive, compressed
+    according to path suffix (.tar.gz, .tar.bz2, .tar.xz).
+    Shards of the archive are built in parallel by a process pool and then
+    concatenated, import_disk_cache reads them as a single archive.
+    Returns a dict with number of entries, bytes and throughput.
+    Parameters:
+      basedir - DiskCache basedir.
+      path - Archive path.
+      jobs - Number of worker processes, number of CPUs if None.
+      cache_options - Additional DiskCache arguments, must be the same used
+                      by the cache users.
+    """
+    t0 = time.perf_counter()
+    cache_options = cache_options or {}
+    compression = _archive_compression(path)
+    jobs = jobs or os.cpu_count() or 1
+
+    hashed_keys = DiskCache(basedir=basedir, **cache_options).hashed_keys()
+    chunks = _chunks(hashed_keys, jobs)
+
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(path) or '.') \
+            as tmpdir:
+        shards = [os.path.join(tmpdir, 'shard-{}'.format(idx))
+                  for idx in range(len(chunks))]
+
+        with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+            results = list(executor.map(
+                _export_shard,
+                [basedir] * len(chunks), [cache_options] * len(chunks),
+                chunks, shards, [compression] * len(chunks)))
+
+        # Compressed streams and tar archives can be concatenated
+        with open(path, 'wb') as fh:
+            for shard in shards:
+                with open(shard, 'rb') as shard_fh:
+                    shutil.copyfileobj(shard_fh, fh, 1024 * 1024)
+
+            if not shards:
+                with tarfile.open(fileobj=fh, mode='w:' + compression):
+                    pass
+
+    return _transfer_result(sum(x[0] for x in results),
+                            sum(x[1] for x in results), t0)
+
+
+def _import_batch(basedir, cache_options, batch):
+    c = DiskCache(basedir=basedir, **dict(cache_options, shared=True))
+    dirs = set()
+    entries = 0
+    size = 0
+
+    for (hashed, mtime, buff) in batch:
+        try:
+            c.store_raw(hashed, buff, mtime=mtime, dirs=dirs)
+        except ValueError:
+            continue
+
+        entries += 1
+        size += len(buff)
+
+    return (entries, size)
+
+
+def import_disk_cache(basedir, path, jobs=None, cache_options=None,
+                      batch_size=256):
+    """
+    Imports entries from an archive created by export_disk_cache.
+    The archive is read sequentially while entries are written by a process
+    pool. Existing entries are replaced.
+    Returns a dict with number of entries, bytes and throughput.
+    Parameters:
+      basedir - DiskCache basedir.
+      path - Archive path.
+      jobs - Number of worker processes, number of CPUs if None.
+      cache_options - Additional DiskCache arguments.
+      batch_size - Number of entries sent to workers at once.
+    """
+    t0 = time.perf_counter()
+    cache_options = cache_options or {}
+    jobs = jobs or os.cpu_count() or 1
+    entries = 0
+    size = 0
+
+    with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+        pending = set()
+
+        def _submit(batch):
+            nonlocal entries, size, pending
+
+            # Bound memory used by batches waiting for a worker
+            while len(pending) >= jobs * 2:
+                (done, pending) = concurrent.futures.wait(
+                    pending,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+                for fut in done:
+                    entries += fut.result()[0]
+                    size += fut.result()[1]
+
+            pending.add(executor.submit(
+                _import_batch, basedir, cache_options, batch))
+
+        batch = []
+        with tarfile.open(path, mode='r:*', ignore_zeros=True) as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+
+                batch.append((member.name, member.mtime,
+                              tar.extractfile(member).read()))
+                if len(batch) >= batch_size:
+                    _submit(batch)
+                    batch = []
+
+        if batch:
+            _submit(batch)
+
+        for fut in concurrent.futures.as_completed(pending):
+            entries += fut.result()[0]
+            size += fut.result()[1]
+
+    return _transfer_result(entries, size, t0)
+
+
+# Maximum number of failed loads reported by prewarm_disk_cache
+_PREWARM_MAX_FAILURES = 10
+
+
+def _prewarm_batch(basedir, cache_options, loader, keys):
+    c = DiskCache(basedir=basedir, **dict(cache_options, shared=True))
+    (hits, misses) = c.get_many(keys)
+    loaded = 0
+    errors = 0
+    # Exceptions may not be picklable, send them back as strings
+    failures = []
+
+    for key in keys:
+        if key not in misses:
+            continue
+
+        try:
+            value = loader(key)
+        except Exception as e:
+            errors += 1
+            if len(failures) < _PREWARM_MAX_FAILURES:
+                failures.append(
+                    (key, '{}: {}'.format(type(e).__name__, e)))
+            continue
+
+        c.set(key, value)
+        loaded += 1
+
+    return (loaded, len(hits), errors, c.metrics.bytes_written, failures)
+
+
+def prewarm_disk_cache(basedir, keys, loader, jobs=None, cache_options=None,
+                       batch_size=16):
+    """
+    Loads missing keys into a DiskCache using a process pool.
+    Returns a dict with number of loaded entries, bytes written and
+    throughput plus the number of keys already cached and failed loads.
+    'failures' holds (key, error message) pairs for the first failed
+    loads.
+    Parameters:
+      basedir - DiskCache basedir.
+      keys - Iterable of keys.
+      loader - Picklable callable returning the value for a key, e.g. a
+               module level function.
+      jobs - Number of worker processes, number of CPUs if None.
+      cache_options - Additional DiskCache arguments.
+      batch_size - Number of keys sent to workers at once.
+    """
+    t0 = time.perf_counter()
+    cache_options = cache_options or {}
+    jobs = jobs or os.cpu_count() or 1
+    keys = list(keys)
+    batches = [keys[idx:idx + batch_size]
+               for idx in range(0, len(keys), batch_size)]
+
+    with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+        results = list(executor.map(
+            _prewarm_batch,
+            [basedir] * len(batches), [cache_options] * len(batches),
+            [loader] * len(batches), batches))
+
+    ret = _transfer_result(sum(x[0] for x in results),
+                           sum(x[3] for x in results), t0)
+    ret['cached'] = sum(x[1] for x in results)
+    ret['errors'] = sum(x[2] for x in results)
+    ret['failures'] = [failure for x in results for failure in x[4]]
+    ret['failures'] = ret['failures'][:_PREWARM_MAX_FAILURES]
+    return ret
+
+
+class StatsLogger:
+    def __init__(self, caches, interval=60, logger=None):
+        """
+        Periodically logs counters and latencies of some caches.
+        Parameters:
+          caches - A dict mapping names to caches.
+          interval - Seconds between reports.
+          logger - Logger to use, by default appkit.loggertools' logger for
+                   'appkit.cache'.
+        """
+        self.caches = caches
+        self.interval = interval
+        self.logger = logger
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def format(name, stats):
+        def _ms(x):
+            return '-' if x is None else '{:.2f}ms'.format(x * 1e3)
+
+        ratio = stats['hit_ratio']
+        return (
+            "{name}: hits={hits} misses={misses} expirations={expirations} "
+            "errors={errors} hit_ratio={ratio} read={read} written={written} "
+            "get p50/p99={get_p50}/{get_p99} "
+            "set p50/p99={set_p50}/{set_p99}").format(
+                name=name,
+                hits=stats['hits'],
+                misses=stats['misses'],
+                expirations=stats['expirations'],
+                errors=stats['errors'],
+                ratio='-' if ratio is None else '{:.2%}'.format(ratio),
+                read=stats['bytes_read'],
+                written=stats['bytes_written'],
+                get_p50=_ms(stats['get_latency']['p50']),
+                get_p99=_ms(stats['get_latency']['p99']),
+                set_p50=_ms(stats['set_latency']['p50']),
+                set_p99=_ms(stats['set_latency']['p99']))
+
+    def emit(self):
+        for (name, cache) in self.caches.items():
+            self.logger.info(self.format(name, cache.stats()))
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.emit()
+
+    def start(self):
+        if self.logger is None:
+            from appkit import loggertools
+            self.logger = loggertools.getLogger('appkit.cache')
+
+        self._thread = threading.Thread(
+            target=self._run, name='Cache stats logger', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+class AsyncBaseCache:
+    """
+    Abstract base class for caches used from asyncio code
+    """
+    @abc.abstractmethod
+    async def get(self, key, delta=None):
+        """
+        Returns the requested key from the cache.
+        Parameters:
+          key - Any hasheble object.
+          delta - Overrides cache delta, if supported by the implementation.
+        """
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    async def set(self, key, value):
+        """
+        Stores value into cache associated with key.
+        Parameters:
+          key - Any hasheble object.
+          value - Value to store
+        """
+        raise NotImplementedError()
+
+    async def delete(self, key):
+        raise NotImplementedError()
+
+    async def get_many(self, keys, delta=None):
+        hits = {}
+        misses = set()
+
+        for key in keys:
+            try:
+                hits[key] = await self.get(key, delta=delta)
+            except CacheKeyError:
+                misses.add(key)
+
+        return (hits, misses)
+
+    async def set_many(self, mapping):
+        for (key, value) in mapping.items():
+            await self.set(key, value)
+
+    def close(self):
+        pass
+
+
+class AsyncCacheAdapter(AsyncBaseCache):
+    def __init__(self, cache, max_workers=4, blocking=None):
+        """
+        Async interface for a BaseCache.
+        Blocking caches are run in a dedicated, bounded, thread pool so they
+        don't block the event loop nor compete with other users of the
+        loop's default executor.
+        Parameters:
+          cache - BaseCache to wrap.
+          max_workers - Number of I/O threads.
+          blocking - Whether cache does blocking I/O. If None it's True for
+                     all caches except MemoryCache and NullCache, which are
+                     called directly.
+        """
+        if blocking is None:
+            blocking = not isinstance(cache, (MemoryCache, NullCache))
+
+        self.cache = cache
+        self.blocking = blocking
+        self._executor = None
+
+        if self.blocking:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=max_workers,
+                thread_name_prefix=type(cache).__name__)
+
+    async def _call(self, fn, *args, **kwargs):
+        if not self.blocking:
+            return fn(*args, **kwargs)
+
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, functools.partial(fn, *args, **kwargs))
+
+    async def get(self, key, delta=None):
+        if delta is None:
+            return await self._call(self.cache.get, key)
+
+        return await self._call(self.cache.get, key, delta=delta)
+
+    async def set(self, key, value):
+        return await self._call(self.cache.set, key, value)
+
+    async def delete(self, key):
+        return await self._call(self.cache.delete, key)
+
+    async def get_many(self, keys, delta=None):
+        return await self._call(self.cache.get_many, list(keys), delta=delta)
+
+    async def set_many(self, mapping):
+        return await self._call(self.cache.set_many, dict(mapping))
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+        close = getattr(self.cache, 'close', None)
+        if close is not None:
+            close()
+
+
+class AsyncDiskCache(AsyncCacheAdapter):
+    def __init__(self, max_workers=4, **kwargs):
+        """
+        DiskCache with async interface. I/O is done in a bounded thread pool.
+        Parameters:
+          max_workers - Number of I/O threads.
+          kwargs - Passed to DiskCache.
+        """
+        super().__init__(DiskCache(**kwargs), max_workers=max_workers,
+                         blocking=True)
+
+
+class AsyncSingleFlight:
+    """
+    asyncio version of SingleFlight. Loads are shielded: cancelling a
+    waiter doesn't cancel the shared load.
+    """
+    def __init__(self):
+        self._futures = {}
+
+    def in_flight(self, key):
+        return key in self._futures
+
+    def _done(self, key, fut):
+        if self._futures.get(key) is fut:
+            del self._futures[key]
+
+    async def do(self, key, fn, *args, **kwargs):
+        """
+        Awaits fn(*args, **kwargs) unless a call for key is already running.
+        """
+        fut = self._futures.get(key)
+        if fut is None:
+            fut = asyncio.ensure_future(fn(*args, **kwargs))
+            self._futures[key] = fut
+            fut.add_done_callback(functools.partial(self._done, key))
+
+        return await asyncio.shield(fut)
+
+
+class AsyncCacheLoader:
+    def __init__(self, cache, loader, single_flight=None):
+        """
+        asyncio version of CacheLoader.
+        Parameters:
+          cache - An AsyncBaseCache.
+          loader - A coroutine function returning the value for a key.
+          single_flight - AsyncSingleFlight used to coalesce loads.
+        """
+        self.cache = cache
+        self.loader = loader
+        self._flight = single_flight or AsyncSingleFlight()
+        self._refreshes = set()
+
+    async def _load(self, key):
+        value = await self.loader(key)
+        await self.cache.set(key, value)
+        return value
+
+    async def _refresh(self, key):
+        try:
+            await self._flight.do(key, self._load, key)
+        except Exception:
+            # Stale value keeps being served until the grace period ends
+            pass
+
+    def refresh(self, key):
+        """
+        Reloads key in background, if it's not already being loaded.
+        """
+        if self._flight.in_flight(key):
+            return
+
+        # Keep a reference, the loop only keeps weak ones
+        task = asyncio.ensure_future(self._refresh(key))
+        self._refreshes.add(task)
+        task.add_done_callback(self._refreshes.discard)
+
+    async def get(self, key):
+        try:
+            return await self.cache.get(key)
+
+        except CacheKeyStaleError as e:
+            self.refresh(key)
+            return e.value
+
+        except CacheKeyError:
+            pass
+
+        return await self._flight.do(key, self._load, key)
+
+
+# Process-local tokens identifying arguments with no stable encoding by
+# identity, see _encode_arg. Maps id() to token, entries are removed when
+# the object is collected so, unlike ids, tokens are never reused.
+_object_tokens = {}
+_object_tokens_lock = threading.Lock()
+_object_token_counter = itertools.count()
+
+
+def _forget_object_token(key):
+    # Called from the garbage collector, maybe while _object_token holds
+    # the lock. dict.pop is atomic.
+    _object_tokens.pop(key, None)
+
+
+def _object_token(value):
+    key = id(value)
+    with _object_tokens_lock:
+        token = _object_tokens.get(key)
+        if token is None:
+            # Raises TypeError if value can't be weak-referenced
+            finalizer = weakref.finalize(value, _forget_object_token, key)
+            finalizer.atexit = False
+            token = _object_tokens[key] = next(_object_token_counter)
+
+    return token
+
+
+def _encode_arg(value, out, stable=True):
+    # Type tags avoid collisions like 1 vs '1' vs 1.0 vs True
+    typ = type(value)
+
+    if value is None or typ is bool:
+        out.append(repr(value).encode('ascii'))
+    elif typ is str:
+        buff = value.encode('utf-8', 'surrogatepass')
+        out.append(b's%d:' % len(buff))
+        out.append(buff)
+    elif typ is int:
+        out.append(b'i%d;' % value)
+    elif typ is float:
+        out.append(b'f' + value.hex().encode('ascii') + b';')
+    elif typ in (bytes, bytearray):
+        out.append(b'b%d:' % len(value))
+        out.append(bytes(value))
+    elif typ in (tuple, list):
+        out.append(b'(' if typ is tuple else b'[')
+        for x in value:
+            _encode_arg(x, out, stable)
+        out.append(b')')
+    elif typ is dict:
+        out.append(b'{')
+        for k in sorted(value, key=repr):
+            _encode_arg(k, out, stable)
+            _encode_arg(value[k], out, stable)
+        out.append(b'}')
+    elif typ in (set, frozenset):
+        out.append(b'<')
+        for x in sorted(value, key=repr):
+            _encode_arg(x, out, stable)
+        out.append(b'>')
+    else:
+        if not stable:
+            try:
+                out.append(b'o%d;' % _object_token(value))
+                return
+            except TypeError:
+                # Not weak-referenceable
+                pass
+
+        try:
+            buff = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            msg = "Can't hash value of type {type}, it can't be pickled"
+            msg = msg.format(type=typ.__qualname__)
+            raise TypeError(msg) from e
+
+        out.append(b'p%d:' % len(buff))
+        out.append(buff)
+
+
+def hash_args(args, kwargs, stable=True):
+    """
+    Returns a hash for the arguments of a call.
+    Builtin types are encoded directly, other objects are pickled unless
+    stable is False.
+    Parameters:
+      args - Tuple of positional arguments.
+      kwargs - Dict of keyword arguments.
+      stable - If True the hash is the same across processes and runs. If
+               False objects are identified by identity, which is cheaper
+               and supports objects that can't be pickled, but only valid
+               within the current process. Objects that can't be
+               weak-referenced are pickled anyway.
+    """
+    out = []
+    _encode_arg(args, out, stable)
+    if kwargs:
+        _encode_arg(kwargs, out, stable)
+
+    return hashlib.blake2b(b''.join(out), digest_size=16).hexdigest()
+
+
+class _CachedError:
+    """
+    Wraps an exception stored by cached's negative caching
+    """
+    __slots__ = ('error',)
+
+    def __init__(self, error):
+        self.error = error
+
+    def __getstate__(self):
+        return self.error
+
+    def __setstate__(self, state):
+        self.error = state
+
+
+def cached(cache=None, ttl=None, key=None, errors=()):
+    """
+    Memoization decorator for functions and coroutine functions.
+    Parameters:
+      cache - BaseCache or AsyncBaseCache where results are stored. A 1024
+              entries MemoryCache if None. AsyncBaseCache can only be used
+              with coroutine functions, BaseCache used with coroutine
+              functions is wrapped in an AsyncCacheAdapter.
+      ttl - Seconds before a result is considered expired, passed as delta
+            to the cache. None or zero uses the cache delta.
+      key - A callable taking the same arguments as the decorated function
+            and returning the cache key. By default the qualified name of
+            the function plus a hash of arguments, see hash_args. Hashes
+            are stable across processes, requiring arguments of
+            non-builtin types to be picklable, unless cache is a
+            MemoryCache or NullCache.
+      errors - Exception classes that are cached too (negative caching).
+               Cached exceptions are raised again on hits.
+    """
+    if cache is None:
+        cache = MemoryCache(max_entries=1024)
+
+    errors = tuple(errors)
+    get_kwargs = {'delta': ttl} if ttl else {}
+
+    # Results stored in process-local caches don't need stable keys
+    backend = cache.cache if isinstance(cache, AsyncCacheAdapter) else cache
+    stable = not isinstance(backend, (MemoryCache, NullCache))
+
+    def decorator(fn):
+        prefix = '{}.{}:'.format(fn.__module__, fn.__qualname__)
+
+        def _key(args, kwargs):
+            if key is not None:
+                return key(*args, **kwargs)
+
+            try:
+                return prefix + hash_args(args, kwargs, stable=stable)
+            except TypeError as e:
+                msg = "{name}: {error}, use the key argument of cached"
+                msg = msg.format(name=fn.__qualname__, error=e)
+                raise TypeError(msg) from e
+
+        def _unwrap(value):
+            if isinstance(value, _CachedError):
+                # Don't let the stored exception accumulate tracebacks
+                raise value.error.with_traceback(None)
+
+            return value
+
+        if inspect.iscoroutinefunction(fn):
+            # Keep blocking I/O out of the event loop
+            async_cache = cache if isinstance(cache, AsyncBaseCache) \
+                else AsyncCacheAdapter(cache)
+
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                k = _key(args, kwargs)
+                try:
+                    value = await async_cache.get(k, **get_kwargs)
+                except CacheKeyError:
+                    pass
+                else:
+                    return _unwrap(value)
+
+                try:
+                    value = await fn(*args, **kwargs)
+                except errors as e:
+                    value = _CachedError(e)
+
+                await async_cache.set(k, value)
+                return _unwrap(value)
+
+        else:
+            if isinstance(cache, AsyncBaseCache):
+                raise TypeError('AsyncBaseCache requires a coroutine '
+                                'function')
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                k = _key(args, kwargs)
+                try:
+                    value = cache.get(k, **get_kwargs)
+                except CacheKeyError:
+                    pass
+                else:
+                    return _unwrap(value)
+
+                try:
+                    value = fn(*args, **kwargs)
+                except errors as e:
+                    value = _CachedError(e)
+
+                cache.set(k, value)
+                return _unwrap(value)
+
+        wrapper.cache = cache
+        return wrapper
+
+    return decorator
+
+
+class CacheKeyError(KeyError):
+    """
+    Base class for cache errors
+    """
+    pass
+
+
+class CacheKeyMissError(CacheKeyError):
+    """
+    Requested key is missing in cache
+    """
+    pass
 
 
 class CacheKeyExpiredError(CacheKeyError):
@@ -164,6 +2935,16 @@ class CacheKeyExpiredError(CacheKeyError):
     pass
 
 
+class CacheKeyStaleError(CacheKeyExpiredError):
+    """
+    Requested key is expired but still in its grace period. Stale value is
+    available as the value attribute.
+    """
+    def __init__(self, key, value):
+        super().__init__(key)
+        self.value = value
+
+
 class CacheIOError(IOError):
     """
     Cache error related to I/O errors
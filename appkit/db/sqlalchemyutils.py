@@ -39,7 +39,16 @@ def _re_fn(regexp, other):
     return re.search(regexp, other, re.IGNORECASE) is not None
 
 
-def create_engine(uri='sqlite:///:memory:', echo=False):
+def create_engine(uri='sqlite:///:memory:', echo=False, pragmas=None):
+    """
+    Creates an engine for uri.
+    Parameters:
+      uri - Database URI.
+      echo - Log all statements.
+      pragmas - Additional sqlite pragmas to set on each new connection as a
+                dict, ej. {'journal_mode': 'WAL'}. Ignored for other
+                databases.
+    """
     engine = sqlalchemy.create_engine(uri, echo=echo)
 
     # @property
@@ -63,6 +72,8 @@ def create_engine(uri='sqlite:///:memory:', echo=False):
         def set_sqlite_pragma(conn, record):
             cursor = conn.cursor()
             cursor.execute("PRAGMA foreign_keys=ON")
+            for (name, value) in (pragmas or {}).items():
+                cursor.execute("PRAGMA {}={}".format(name, value))
             cursor.close()
 
     return engine
@@ -19,7 +19,6 @@
 
 
 import asyncio
-import functools
 import gzip
 import io
 import socket
@@ -34,6 +33,59 @@ from appkit import (
     cache,
     utils
 )
+from appkit.cache import AsyncSingleFlight
+
+
+def build_cache(name, enable_cache, cache_delta=-1, logger=None):
+    """
+    Builds cache for fetcher from its enable_cache option:
+      False - No cache
+      True or 'disk' - DiskCache under the user cache dir
+      'tiered' - TieredCache: MemoryCache in front of the same DiskCache
+      'memory' - MemoryCache
+      A BaseCache instance - Used as is
+    """
+    if not enable_cache:
+        return cache.NullCache()
+
+    if isinstance(enable_cache, cache.BaseCache):
+        return enable_cache
+
+    if enable_cache not in (True, 'disk', 'tiered', 'memory'):
+        raise ValueError(enable_cache)
+
+    if enable_cache == 'memory':
+        return cache.MemoryCache(delta=cache_delta)
+
+    cache_path = utils.user_path(utils.UserPathType.CACHE, name,
+                                 create=True, is_folder=True)
+    ret = cache.DiskCache(basedir=cache_path, delta=cache_delta)
+
+    if enable_cache == 'tiered':
+        ret = cache.TieredCache(
+            disk=ret,
+            memory=cache.MemoryCache(max_entries=1024, delta=cache_delta))
+
+    if logger:
+        msg = '{name} using cache {path}'
+        msg = msg.format(name=name, path=cache_path)
+        logger.debug(msg)
+
+    return ret
+
+
+def build_async_cache(name, enable_cache, cache_delta=-1, logger=None):
+    """
+    Like build_cache but returns a cache.AsyncBaseCache. Blocking caches
+    are run in their own I/O thread pool.
+    AsyncBaseCache instances are returned as is.
+    """
+    if isinstance(enable_cache, cache.AsyncBaseCache):
+        return enable_cache
+
+    return cache.AsyncCacheAdapter(
+        build_cache(name, enable_cache, cache_delta=cache_delta,
+                    logger=logger))
 
 
 class Fetcher:
@@ -97,23 +149,17 @@ class UrllibFetcher(BaseFetcher):
             self._headers['User-Agent'] = user_agent
 
         # Setup cache
-        if enable_cache:
-            cache_path = utils.user_path('cache', 'urllibfetcher',
-                                         create=True, is_folder=True)
-            self._cache = cache.Disk(basedir=cache_path,
-                                     delta=cache_delta)
-
-            msg = 'UrllibFetcher using cache {path}'
-            msg = msg.format(path=cache_path)
-            self._logger.debug(msg)
-        else:
-            self._cache = cache.NullCache()
+        self._cache = build_cache('urllibfetcher', enable_cache,
+                                  cache_delta=cache_delta,
+                                  logger=self._logger)
 
     def fetch(self, url, **opts):
-        buff = self._cache.get(url)
-        if buff:
+        try:
+            buff = self._cache.get(url)
             self._logger.debug("found in cache: {}".format(url))
             return buff
+        except cache.CacheKeyError:
+            pass
 
         headers = self._headers.copy()
         if 'headers' in opts:
@@ -159,28 +205,19 @@ class AIOHttpFetcher:
             self._headers['User-Agent'] = user_agent
 
         # Setup cache
-        if enable_cache:
-            cache_path = utils.user_path('cache', 'aiohttpfetcher',
-                                         create=True, is_folder=True)
-            self._cache = cache.DiskCache(basedir=cache_path,
-                                          delta=cache_delta)
-            msg = 'AIOHttpFetcher using cache {path}'
-            msg = msg.format(path=cache_path)
-            self._logger.debug(msg)
-
-        else:
-            self._cache = cache.NullCache()
+        self._cache = build_async_cache('aiohttpfetcher', enable_cache,
+                                        cache_delta=cache_delta,
+                                        logger=self._logger)
 
         self._loop = asyncio.get_event_loop()
 
     @asyncio.coroutine
     def fetch(self, url, **options):
-        buff = yield from self._loop.run_in_executor(
-            None,
-            functools.partial(self._cache.get, url)
-        )
-        if buff:
+        try:
+            buff = yield from self._cache.get(url)
             return buff
+        except cache.CacheKeyError:
+            pass
 
         opts = {'headers': self._headers}
         opts.update(opts)
@@ -190,10 +227,7 @@ class AIOHttpFetcher:
             buff = yield from resp.content.read()
             yield from resp.release()
 
-        yield from self._loop.run_in_executor(
-            None,
-            functools.partial(self._cache.set, url, buff)
-        )
+        yield from self._cache.set(url, buff)
 
         return buff
 
@@ -202,8 +236,11 @@ class AsyncFetcher:
     def __init__(self, logger=None, cache=None, max_requests=1,
                  **session_options):
         self._logger = logger
-        self._cache = cache
+        self._cache = build_async_cache('asyncfetcher', cache) \
+            if cache else None
         self._semaphore = asyncio.Semaphore(max_requests)
+        self._flight = AsyncSingleFlight()
+        self._refreshes = set()
         self._session_options = session_options
         self._session_options['cookie_jar'] = aiohttp.CookieJar()
 
@@ -225,11 +262,47 @@ class AsyncFetcher:
 
         if use_cache:
             try:
-                buff = self._cache.get(url)
+                buff = yield from self._cache.get(url)
                 return None, buff
+            except cache.CacheKeyStaleError as e:
+                # Serve stale content while it's fetched again
+                self._refresh(url, timeout, request_options)
+                return None, e.value
             except cache.CacheKeyError:
                 pass
 
+        # Concurrent fetches of the same url are coalesced, unless they
+        # use custom request options
+        if request_options:
+            ret = yield from self._fetch(url, use_cache, timeout,
+                                         request_options)
+        else:
+            ret = yield from self._flight.do(
+                url, self._fetch, url, use_cache, timeout, request_options)
+
+        return ret
+
+    def _refresh(self, url, timeout, request_options):
+        # Refreshes are coalesced by url, like fetch_full does, so they
+        # can't carry custom request options. Those are left to expire and
+        # fetched again in the foreground
+        if request_options or self._flight.in_flight(url):
+            return
+
+        task = asyncio.ensure_future(self._flight.do(
+            url, self._fetch, url, True, timeout, {}))
+        self._refreshes.add(task)
+        task.add_done_callback(self._refresh_done)
+
+    def _refresh_done(self, task):
+        self._refreshes.discard(task)
+        if not task.cancelled() and task.exception() and self._logger:
+            msg = "Error refreshing stale content: {error}"
+            msg = msg.format(error=task.exception())
+            self._logger.warning(msg)
+
+    @asyncio.coroutine
+    def _fetch(self, url, use_cache, timeout, request_options):
         with (yield from self._semaphore):
             with aiohttp.ClientSession(**self._session_options) as session:
                 with aiohttp.Timeout(timeout):
@@ -243,7 +316,7 @@ class AsyncFetcher:
                     yield from resp.release()
 
         if use_cache:
-            self._cache.set(url, buff)
+            yield from self._cache.set(url, buff)
 
         return resp, buff
 
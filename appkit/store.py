@@ -18,8 +18,22 @@
 # USA.
 
 
+import codecs
+import collections
+import collections.abc
 import copy
+import fnmatch
+import functools
+import itertools
 import json
+import marshal
+import mmap
+import os
+import re
+import struct
+import tempfile
+import threading
+from array import array
 
 UNDEFINED = object()
 
@@ -72,6 +86,215 @@ def flatten_dict(d):
     return ret
 
 
+class _JSONReader:
+    """
+    Incremental reader over a JSON text stream.
+    Keeps only the unconsumed part of the stream in memory.
+    """
+    WHITESPACE = re.compile(r'[ \t\n\r]*')
+    DELIMITER = re.compile(r'[,\]\} \t\n\r]')
+    DECODER = json.JSONDecoder()
+
+    def __init__(self, stream, chunk_size):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buff = ''
+        self.pos = 0
+        self._decoder = None
+
+    def _fill(self, size=None):
+        while True:
+            chunk = self.stream.read(size or self.chunk_size)
+            if not isinstance(chunk, bytes):
+                break
+
+            if self._decoder is None:
+                self._decoder = codecs.getincrementaldecoder('utf-8')()
+
+            final = not chunk
+            chunk = self._decoder.decode(chunk, final=final)
+
+            # A short read can end inside a multi-byte sequence and decode
+            # to nothing, that's not the end of the stream
+            if chunk or final:
+                break
+
+        if not chunk:
+            return False
+
+        self.buff = self.buff[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        while True:
+            self.pos = self.WHITESPACE.match(self.buff, self.pos).end()
+            if self.pos < len(self.buff):
+                return self.buff[self.pos]
+
+            if not self._fill():
+                return ''
+
+    def expect(self, c):
+        if self.peek() != c:
+            raise FormatError()
+
+        self.pos += 1
+
+    def value(self):
+        c = self.peek()
+        if c and c not in '"[':
+            # Numbers and literals aren't self-delimited, read until the
+            # value is complete
+            while (not self.DELIMITER.search(self.buff, self.pos) and
+                   self._fill()):
+                pass
+
+        while True:
+            try:
+                value, end = self.DECODER.raw_decode(self.buff, self.pos)
+            except json.decoder.JSONDecodeError as e:
+                # Value may be incomplete, grow buffer geometrically to
+                # avoid quadratic behaviour on big values
+                if self._fill(max(self.chunk_size, len(self.buff))):
+                    continue
+
+                raise FormatError() from e
+
+            self.pos = end
+            return value
+
+
+def _iterparse_object(reader, prefix):
+    reader.expect('{')
+    if reader.peek() == '}':
+        reader.pos += 1
+        return
+
+    while True:
+        if reader.peek() != '"':
+            raise FormatError()
+
+        key = prefix + reader.value()
+        reader.expect(':')
+
+        if reader.peek() == '{':
+            yield from _iterparse_object(reader, key + '.')
+        else:
+            yield (key, reader.value())
+
+        c = reader.peek()
+        reader.pos += 1
+        if c == '}':
+            return
+
+        if c != ',':
+            raise FormatError()
+
+
+def json_iterparse(stream, chunk_size=64 * 1024):
+    """
+    Generator function.
+    Parses a JSON object from stream incrementally, yielding the same
+    (key, value) pairs as flatten_dict(json.load(stream)) without loading
+    the whole document in memory.
+    Raises FormatError on invalid documents.
+    """
+    reader = _JSONReader(stream, chunk_size)
+    if reader.peek() != '{':
+        raise FormatError()
+
+    yield from _iterparse_object(reader, '')
+
+    if reader.peek() != '':
+        raise FormatError()
+
+
+def freeze(value):
+    """
+    Returns an immutable version of value: dicts are converted into store
+    nodes, lists and tuples into tuples and sets into frozensets.
+    """
+    if isinstance(value, dict):
+        return _Node((k, freeze(v)) for (k, v) in value.items())
+
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(x) for x in value)
+
+    if isinstance(value, (set, frozenset)):
+        return frozenset(freeze(x) for x in value)
+
+    return value
+
+
+def _nodes(value):
+    """
+    Returns a copy of dict value with nested dicts converted into store
+    nodes. Other values are stored as is.
+    """
+    return _Node((k, _nodes(v) if isinstance(v, dict) else v)
+                 for (k, v) in value.items())
+
+
+class _LazyValue:
+    """
+    Placeholder for a value stored in a snapshot file, see Store.load_snapshot
+    """
+    __slots__ = ('buff', 'offset', 'size')
+
+    def __init__(self, buff, offset, size):
+        self.buff = buff
+        self.offset = offset
+        self.size = size
+
+    def raw(self):
+        return self.buff[self.offset:self.offset + self.size]
+
+    def load(self):
+        return marshal.loads(self.raw())
+
+
+class _Node(dict):
+    """
+    Internal namespace of a Store.
+    Nodes marked as shared are visible to some FrozenDict view and must be
+    copied before any modification.
+    """
+    __slots__ = ('shared',)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.shared = False
+
+
+class FrozenDict(collections.abc.Mapping):
+    """
+    Read-only view over a Store namespace.
+    Nested namespaces are wrapped on access so the view can be handed out
+    without copying.
+    """
+    __slots__ = ('_d',)
+
+    def __init__(self, d):
+        self._d = d
+
+    def __getitem__(self, key):
+        v = self._d[key]
+        if isinstance(v, dict):
+            return FrozenDict(v)
+
+        return v
+
+    def __iter__(self):
+        return iter(self._d)
+
+    def __len__(self):
+        return len(self._d)
+
+    def __repr__(self):
+        return 'FrozenDict({!r})'.format(self._d)
+
+
 class TypeValidator:
     def __init__(self, type_map):
         self.type_map = type_map
@@ -80,18 +303,251 @@ class TypeValidator:
         if k in self.type_map:
             try:
                 return self.type_map[k](v)
-            except:
+            except (TypeError, ValueError):
                 pass
 
             raise ValidationError(k, v, 'Incompatible type')
 
         return v
 
+    def validate_many(self, data):
+        ret = dict(data)
+        for k in self.type_map.keys() & ret.keys():
+            ret[k] = self(k, ret[k])
+
+        return ret
+
+
+class _PatternNode:
+    # globs is the ordered list of (glob, regexp, child) for glob segments.
+    # Globs are indexed by their literal head or tail, as
+    # {length: {literal: [glob index]}}, globs without literal parts are
+    # listed in glob_others
+    __slots__ = ('children', 'globs', 'glob_heads', 'glob_tails',
+                 'glob_others', 'pattern', 'prefix')
+
+    def __init__(self):
+        self.children = {}
+        self.globs = []
+        self.glob_heads = {}
+        self.glob_tails = {}
+        self.glob_others = []
+        self.pattern = None
+        self.prefix = None
+
+    def add_glob(self, glob):
+        idx = len(self.globs)
+        child = _PatternNode()
+        self.globs.append((glob, re.compile(fnmatch.translate(glob)), child))
+
+        head = re.match(r'[^\*\?\[\]]*', glob).group(0)
+        tail = re.search(r'[^\*\?\[\]]*\Z', glob).group(0)
+        if len(head) >= len(tail) and head:
+            table = self.glob_heads.setdefault(len(head), {})
+            table.setdefault(head, []).append(idx)
+        elif tail:
+            table = self.glob_tails.setdefault(len(tail), {})
+            table.setdefault(tail, []).append(idx)
+        else:
+            self.glob_others.append(idx)
+
+        return child
+
+    def match_globs(self, part):
+        """
+        Yields children of globs matching part, in insertion order
+        """
+        idxs = list(self.glob_others)
+        for (length, table) in self.glob_heads.items():
+            idxs.extend(table.get(part[:length], ()))
+        for (length, table) in self.glob_tails.items():
+            if length <= len(part):
+                idxs.extend(table.get(part[-length:], ()))
+
+        if len(idxs) > 1:
+            idxs.sort()
+
+        for idx in idxs:
+            (glob, regexp, child) = self.globs[idx]
+            if regexp.match(part):
+                yield child
+
+
+class PatternValidator:
+    """
+    Validator dispatching keys to rules using exact keys, glob patterns or
+    namespace prefixes:
+      'a.b.c'  - Exact key
+      'a.*.c'  - Glob (fnmatch syntax), wildcards never match across dots
+      'a.b.**' - Any key under the 'a.b' namespace
+    Exact keys take precedence over globs and globs over prefixes; the
+    deepest prefix wins.
+
+    Patterns are compiled into a trie of key segments so dispatch cost
+    depends on key depth, not on the number of rules: glob segments are
+    indexed by their literal head or tail (as in 'ns.*_N'), only globs
+    without literal parts are tried one by one. Results are cached for the
+    CACHE_SIZE most recently dispatched keys and matches are counted per
+    pattern in the hits attribute.
+    Parameters:
+      rules - Mapping of pattern to callable. The callable gets the value and
+              must return it (maybe transformed) or raise TypeError or
+              ValueError.
+      strict - Raise ValidationError for keys without rule.
+    """
+    GLOB_CHARS = re.compile(r'[\*\?\[]')
+    CACHE_SIZE = 4096
+
+    def __init__(self, rules, strict=False):
+        self.rules = dict(rules)
+        self.strict = strict
+        self.hits = collections.Counter()
+
+        self._exact = {}
+        self._root = _PatternNode()
+        self._cache = collections.OrderedDict()
+
+        for pattern in self.rules:
+            self._compile(pattern)
+
+    def _compile(self, pattern):
+        if not self.GLOB_CHARS.search(pattern):
+            self._exact[pattern] = pattern
+            return
+
+        parts = pattern.split('.')
+        node = self._root
+
+        for (idx, part) in enumerate(parts):
+            if part == '**':
+                if idx != len(parts) - 1:
+                    raise ValueError(pattern)
+
+                node.prefix = pattern
+                return
+
+            if not self.GLOB_CHARS.search(part):
+                node = node.children.setdefault(part, _PatternNode())
+                continue
+
+            for (glob, regexp, child) in node.globs:
+                if glob == part:
+                    node = child
+                    break
+            else:
+                node = node.add_glob(part)
+
+        node.pattern = pattern
+
+    def _candidates(self, node, part):
+        child = node.children.get(part)
+        if child is not None:
+            yield child
+
+        yield from node.match_globs(part)
+
+    def _match_glob(self, node, parts, idx):
+        if idx == len(parts):
+            return node.pattern
+
+        for child in self._candidates(node, parts[idx]):
+            pattern = self._match_glob(child, parts, idx + 1)
+            if pattern is not None:
+                return pattern
+
+        return None
+
+    def _match_prefix(self, node, parts, idx):
+        best = (idx, node.prefix) if node.prefix is not None else None
+        if idx == len(parts) - 1:
+            return best
+
+        for child in self._candidates(node, parts[idx]):
+            m = self._match_prefix(child, parts, idx + 1)
+            if m is not None and (best is None or m[0] > best[0]):
+                best = m
+
+        return best
+
+    def dispatch(self, key):
+        """
+        Returns the pattern matching key or None
+        """
+        try:
+            pattern = self._cache[key]
+        except KeyError:
+            pass
+        else:
+            self._cache.move_to_end(key)
+            return pattern
+
+        pattern = self._exact.get(key)
+        if pattern is None:
+            parts = key.split('.')
+            pattern = self._match_glob(self._root, parts, 0)
+            if pattern is None:
+                m = self._match_prefix(self._root, parts, 0)
+                if m is not None:
+                    pattern = m[1]
+
+        self._cache[key] = pattern
+        if len(self._cache) > self.CACHE_SIZE:
+            self._cache.popitem(last=False)
+
+        return pattern
+
+    def __call__(self, k, v):
+        pattern = self.dispatch(k)
+
+        if pattern is None:
+            if self.strict:
+                raise ValidationError(k, v, 'No rule for key')
+
+            return v
+
+        self.hits[pattern] += 1
+        try:
+            return self.rules[pattern](v)
+        except (TypeError, ValueError) as e:
+            raise ValidationError(k, v, 'Incompatible type') from e
+
+    def validate_many(self, data):
+        return {k: self(k, v) for (k, v) in data.items()}
+
 
 class Store:
-    def __init__(self, items={}, validators=[]):
-        self._d = {}
+    DUMP_CHUNK_SIZE = 64 * 1024
+    LOAD_BATCH_SIZE = 1024
+
+    # Snapshot format:
+    # - Header: SNAPSHOT_MAGIC, marshal version, key count and key table
+    #   offset
+    # - Values: marshal-encoded values, one after other
+    # - Key table: marshal-encoded tuple of keys followed by offsets (count
+    #   + 1 items) of values as unsigned 64-bit integers
+    SNAPSHOT_MAGIC = b'APKS'
+    SNAPSHOT_HEADER = struct.Struct('<4sHQQ')
+
+    def __init__(self, items={}, validators=[], snapshots=False):
+        """
+        Key-value store using a namespace schema.
+        Parameters:
+          items - Initial data
+          validators - List of callables used to check and transform values
+                       before storing them.
+          snapshots - If True values returned by get are read-only
+                      snapshots (FrozenDict for namespaces, tuples for
+                      lists…) instead of deep copies. Namespaces are shared
+                      with the store and copied only when modified.
+        """
+        self._d = _Node()
+        self._index = {}
+        self._parts = {}
         self._validators = []
+        self._snapshots = snapshots
+        self._lazy = False
+        self._changes = None
+        self._subscribers = {}
 
         for validator in validators:
             self.add_validator(validator)
@@ -99,14 +555,16 @@ class Store:
         self.update(items)
 
     def _process_key(self, key):
-        if not isinstance(key, str):
-            raise IllegalKeyError(key)
+        if isinstance(key, str):
+            parts = self._parts.get(key)
+            if parts is not None:
+                return parts
 
-        parts = key.split('.')
-        if not all(parts):
-            raise IllegalKeyError(key)
+            parts = key.split('.')
+            if all(parts):
+                return parts
 
-        return parts
+        raise IllegalKeyError(key)
 
     def _process_value(self, key, value):
         for vfunc in self._validators:
@@ -114,117 +572,1176 @@ class Store:
 
         return value
 
-    def _get_subdict(self, key, create=False):
-        d = self._d
+    def _process_values(self, data):
+        """
+        Batch version of _process_value.
+        Validators implementing a validate_many(mapping) method are called
+        once with the whole mapping, the other ones are called for each key.
+        """
+        for vfunc in self._validators:
+            validate_many = getattr(vfunc, 'validate_many', None)
+            if validate_many is not None:
+                data = validate_many(data)
+            else:
+                data = {k: vfunc(k, v) for (k, v) in data.items()}
+
+        return data
+
+    def _index_subtree(self, prefix, d):
+        for (k, v) in d.items():
+            subkey = prefix + '.' + k
+            self._index[subkey] = v
+            if isinstance(v, dict):
+                self._index_subtree(subkey, v)
+
+    def _unindex_subtree(self, prefix, d):
+        for (k, v) in d.items():
+            subkey = prefix + '.' + k
+            self._index.pop(subkey, None)
+            self._parts.pop(subkey, None)
+            if isinstance(v, dict):
+                self._unindex_subtree(subkey, v)
 
+    def _get_subdict(self, key, create=False):
         parts = self._process_key(key)
-        for idx, p in enumerate(parts[:-1]):
-            if p not in d and create:
-                d[p] = {}
 
-            # Override existing values with dicts is allowed
-            # Subclass Store or use a validator if this behaviour needs to be
-            # changed
+        # Fast path: parent namespace is already indexed
+        if len(parts) == 1:
+            return parts[-1], self._d
+
+        parent = self._index.get(key[:-len(parts[-1]) - 1])
+        if isinstance(parent, dict):
+            return parts[-1], parent
+
+        d = self._d
+        for idx, p in enumerate(parts[:-1]):
             if p in d and not isinstance(d[p], dict):
-                d[p] = {}
+                if not create:
+                    raise KeyNotFoundError('.'.join(parts[:idx + 1]))
+
+                # Override existing values with dicts is allowed
+                # Subclass Store or use a validator if this behaviour needs
+                # to be changed
+                del d[p]
 
             if p not in d:
-                raise KeyNotFoundError('.'.join(parts[:idx]))
+                if not create:
+                    raise KeyNotFoundError('.'.join(parts[:idx]))
+
+                d[p] = _Node()
+                self._index['.'.join(parts[:idx + 1])] = d[p]
 
             d = d[p]
 
         return parts[-1], d
 
+    def _copy_node(self, node):
+        # Children of a shared node are reachable from the same views
+        for v in node.values():
+            if isinstance(v, _Node):
+                v.shared = True
+
+        return _Node(node)
+
+    def _get_subdict_cow(self, key):
+        """
+        Like _get_subdict(key, create=True) but copies shared namespaces
+        along the path instead of modifying them.
+        """
+        parts = self._process_key(key)
+
+        if self._d.shared:
+            self._d = self._copy_node(self._d)
+
+        d = self._d
+        for idx, p in enumerate(parts[:-1]):
+            child = d.get(p)
+            if not isinstance(child, dict):
+                child = _Node()
+            elif child.shared:
+                child = self._copy_node(child)
+            else:
+                d = child
+                continue
+
+            d[p] = child
+            self._index['.'.join(parts[:idx + 1])] = child
+            d = child
+
+        return parts[-1], d
+
     def empty(self):
-        self._d = {}
+        prev = self._d
+
+        self._lazy = False
+        self._d = _Node()
+        self._index = {}
+        self._parts = {}
+
+        if self._changes is not None or self._subscribers:
+            for (key, value) in prev.items():
+                self._notify(key, UNDEFINED, value)
 
     def replace(self, data):
+        prepared = self._prepare_many(flatten_dict(data))
         self.empty()
-        self.update(data)
+        self._apply_many(prepared)
 
     def update(self, data):
-        for (k, v) in flatten_dict(data).items():
-            self.set(k, v)
+        self.set_many(flatten_dict(data))
+
+    def _prepare_many(self, data):
+        # Check keys and values before touching anything so failures leave
+        # the store untouched
+        parts = [(k, self._process_key(k)) for k in data]
+        data = self._process_values(data)
+
+        return [(k, p, data[k]) for (k, p) in parts]
+
+    def _apply_many(self, prepared):
+        if self._snapshots:
+            for (key, parts, value) in prepared:
+                self._set(key, parts, value)
+            return
+
+        # Inlined version of _set. Flattened data keeps siblings together so
+        # the parent namespace is usually the same as in the previous key
+        index = self._index
+        key_parts = self._parts
+        last_ns, last_d = None, None
+        notify = self._changes is not None or self._subscribers
+
+        for (key, parts, value) in prepared:
+            key_parts[key] = parts
+
+            subkey = parts[-1]
+            if len(parts) == 1:
+                d = self._d
+            else:
+                ns = key[:-len(subkey) - 1]
+                if ns == last_ns:
+                    d = last_d
+                else:
+                    d = index.get(ns)
+                    if not isinstance(d, dict):
+                        overridden = notify and self._leaf_ancestor(parts)
+                        subkey, d = self._get_subdict(key, create=True)
+                        if overridden:
+                            self._notify(overridden[0],
+                                         index[overridden[0]],
+                                         overridden[1])
+                    last_ns, last_d = ns, d
+
+            prev = d.get(subkey)
+            if isinstance(prev, dict):
+                self._unindex_subtree(key, prev)
+                last_ns = None
+
+            if isinstance(value, dict):
+                value = _nodes(value)
+
+            d[subkey] = value
+            index[key] = value
+            if isinstance(value, dict):
+                self._index_subtree(key, value)
+                last_ns = None
+
+            if notify:
+                self._notify(key, value, prev)
+
+    def set_many(self, data):
+        """
+        Atomically sets all key-value pairs from the flat mapping data.
+        Validation is done in batch before any modification: if some key or
+        value is invalid the store is not modified.
+        """
+        self._apply_many(self._prepare_many(data))
 
     def dump(self, stream):
-        buff = json.dumps(self.get(None), sort_keys=True, indent=4)
-        stream.write(buff)
+        self._resolve_all()
+
+        # Encode incrementally, writing in DUMP_CHUNK_SIZE pieces
+        encoder = json.JSONEncoder(sort_keys=True, indent=4)
+
+        buff = []
+        size = 0
+        for chunk in encoder.iterencode(self._d):
+            buff.append(chunk)
+            size += len(chunk)
+            if size >= self.DUMP_CHUNK_SIZE:
+                stream.write(''.join(buff))
+                buff = []
+                size = 0
+
+        stream.write(''.join(buff))
+
+    def load(self, stream, streaming=False):
+        """
+        Loads JSON data from stream.
+        In streaming mode the document is parsed incrementally and stored in
+        batches of LOAD_BATCH_SIZE keys. Memory usage doesn't depend on
+        document size but loading is not atomic: if some key fails, previous
+        batches are kept.
+        """
+        if streaming:
+            it = json_iterparse(stream)
+            while True:
+                batch = dict(itertools.islice(it, self.LOAD_BATCH_SIZE))
+                if not batch:
+                    break
+
+                self.set_many(batch)
+
+            return
 
-    def load(self, stream):
         try:
             data = flatten_dict(json.loads(stream.read()))
         except json.decoder.JSONDecodeError as e:
             raise FormatError() from e
 
-        for (k, v) in data.items():
-            self.set(k, v)
+        self.set_many(data)
+
+    def dump_snapshot(self, path):
+        """
+        Writes store contents into path using the binary snapshot format.
+        The file is replaced atomically. Values must be supported by the
+        marshal module.
+        Empty namespaces are not saved.
+        """
+        keys = []
+        offsets = array('Q', [self.SNAPSHOT_HEADER.size])
+
+        fh = tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(os.path.abspath(path)), delete=False)
+        try:
+            fh.seek(self.SNAPSHOT_HEADER.size)
+            for (key, value) in flatten_dict(self._d).items():
+                if isinstance(value, _LazyValue):
+                    # Not decoded yet, copy raw data
+                    buff = value.raw()
+                else:
+                    buff = marshal.dumps(value)
+
+                fh.write(buff)
+                keys.append(key)
+                offsets.append(offsets[-1] + len(buff))
+
+            fh.write(marshal.dumps(tuple(keys)))
+            fh.write(offsets.tobytes())
+
+            fh.seek(0)
+            fh.write(self.SNAPSHOT_HEADER.pack(
+                self.SNAPSHOT_MAGIC, marshal.version, len(keys), offsets[-1]))
+            fh.close()
+            os.replace(fh.name, path)
+
+        except BaseException:
+            fh.close()
+            os.unlink(fh.name)
+            raise
+
+    def load_snapshot(self, path):
+        """
+        Loads data from a snapshot file created with dump_snapshot.
+        The file is memory-mapped and only the key table is decoded, values
+        are decoded on first access. Validators are not applied.
+        """
+        with open(path, 'rb') as fh:
+            try:
+                buff = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError as e:
+                raise FormatError() from e
+
+        try:
+            (magic, version, count, table_offset) = \
+                self.SNAPSHOT_HEADER.unpack_from(buff)
+        except struct.error as e:
+            raise FormatError() from e
+
+        if magic != self.SNAPSHOT_MAGIC or version != marshal.version:
+            raise FormatError()
+
+        try:
+            keys = marshal.loads(memoryview(buff)[table_offset:])
+        except (EOFError, ValueError, TypeError) as e:
+            raise FormatError() from e
+
+        offsets = array('Q')
+        offsets_size = (count + 1) * offsets.itemsize
+        offsets.frombytes(buff[len(buff) - offsets_size:])
+
+        if len(keys) != count:
+            raise FormatError()
+
+        self._apply_many([
+            (key, self._process_key(key),
+             _LazyValue(buff, offsets[idx], offsets[idx + 1] - offsets[idx]))
+            for (idx, key) in enumerate(keys)])
+        self._lazy = self._lazy or count > 0
+
+    def _resolve(self, key, value):
+        value = value.load()
+        if self._snapshots:
+            value = freeze(value)
+            subkey, d = self._get_subdict_cow(key)
+        else:
+            subkey, d = self._get_subdict(key)
+
+        d[subkey] = value
+        self._index[key] = value
+        return value
+
+    def _resolve_all(self):
+        """
+        Decodes all pending values from snapshot files
+        """
+        if not self._lazy:
+            return
+
+        for (key, value) in list(self._index.items()):
+            if isinstance(value, _LazyValue):
+                self._resolve(key, value)
+
+        self._lazy = False
+
+    def _notify(self, key, value, prev):
+        if self._changes is not None:
+            self._changes.add(key)
+
+        if self._subscribers:
+            self._dispatch(key, value, prev)
+
+    def _dispatch(self, key, value, prev):
+        if isinstance(value, _LazyValue):
+            value = self._resolve(key, value)
+
+        if self._snapshots:
+            value = self._snapshot(value)
+
+        # Subscribers for key and its parent namespaces…
+        ns = key
+        while True:
+            for fn in self._subscribers.get(ns, ()):
+                fn(key, value)
+
+            idx = ns.rfind('.')
+            if idx < 0:
+                break
+            ns = ns[:idx]
+
+        for fn in self._subscribers.get(None, ()):
+            fn(key, value)
+
+        # …and for namespaces removed with key
+        if isinstance(prev, dict):
+            prefix = key + '.'
+            for (ns, fns) in list(self._subscribers.items()):
+                if ns is not None and ns.startswith(prefix):
+                    for fn in fns:
+                        fn(key, value)
+
+    def subscribe(self, namespace, fn):
+        """
+        Calls fn(key, value) after each change on namespace or its children.
+        A None namespace subscribes to all changes.
+        For deleted keys value is UNDEFINED. Values are not copied and must
+        not be modified.
+        """
+        self._subscribers.setdefault(namespace, []).append(fn)
+
+    def unsubscribe(self, namespace, fn):
+        fns = self._subscribers.get(namespace, [])
+        fns.remove(fn)
+        if not fns:
+            del self._subscribers[namespace]
+
+    def changes(self):
+        """
+        Returns the set of keys modified or deleted since the last
+        checkpoint. Changes are not tracked until checkpoint is called for
+        the first time.
+        """
+        if self._changes is None:
+            return frozenset()
+
+        return frozenset(self._changes)
+
+    def checkpoint(self):
+        """
+        Starts a new change tracking period.
+        Returns the set of keys modified since the previous checkpoint.
+        """
+        ret = self.changes()
+        self._changes = set()
+        return ret
+
+    def write_journal(self, stream):
+        """
+        Checkpoints and appends to stream one JSON line for each key changed
+        since the previous checkpoint. Returns the number of records
+        written.
+        Journal is meant to be replayed over the last full dump (see
+        replay_journal); to compact it dump the store and truncate the
+        journal.
+        """
+        keys = sorted(self.checkpoint())
+
+        for key in keys:
+            value = self._index.get(key, UNDEFINED)
+            if value is UNDEFINED:
+                record = {'key': key, 'deleted': True}
+            else:
+                if isinstance(value, _LazyValue):
+                    value = self._resolve(key, value)
+                elif isinstance(value, dict) and self._lazy:
+                    self._resolve_all()
+                    value = self._index[key]
+
+                record = {'key': key, 'value': value}
+
+            stream.write(json.dumps(record, sort_keys=True) + '\n')
+
+        return len(keys)
+
+    def replay_journal(self, stream):
+        """
+        Applies records from a journal written by write_journal.
+        """
+        for line in stream:
+            try:
+                record = json.loads(line)
+                key = record['key']
+            except (ValueError, TypeError, KeyError) as e:
+                raise FormatError() from e
+
+            if record.get('deleted', False):
+                if self.has_key(key):
+                    self.delete(key)
+            else:
+                self.set(key, record.get('value'))
 
     def load_arguments(self, args):
-        for (k, v) in vars(args).items():
-            self.set(k, v)
+        self.set_many(vars(args))
 
     def add_validator(self, fn):
         self._validators.append(fn)
 
     def set(self, key, value):
-        subkey, d = self._get_subdict(key, create=True)
-        v = self._process_value(key, value)
+        parts = self._process_key(key)
+        self._set(key, parts, self._process_value(key, value))
+
+    def _set(self, key, parts, v):
+        self._parts[key] = parts
+
+        notify = self._changes is not None or self._subscribers
+        overridden = notify and self._leaf_ancestor(parts)
+
+        if self._snapshots:
+            v = freeze(v)
+            subkey, d = self._get_subdict_cow(key)
+        else:
+            # Keep a private copy of namespaces, changes to the caller's dict
+            # would bypass the index
+            if isinstance(v, dict):
+                v = _nodes(v)
+            subkey, d = self._get_subdict(key, create=True)
+
+        prev = d.get(subkey)
+        if isinstance(prev, dict):
+            self._unindex_subtree(key, prev)
+
         d[subkey] = v
+        self._index[key] = v
+        if isinstance(v, dict):
+            self._index_subtree(key, v)
+
+        if notify:
+            if overridden:
+                self._notify(overridden[0], self._index[overridden[0]],
+                             overridden[1])
+            self._notify(key, v, prev)
+
+    def _leaf_ancestor(self, parts):
+        """
+        Returns the (namespace, value) pair for the leaf that would be
+        replaced by a namespace when setting the key with parts, or None
+        """
+        for idx in range(1, len(parts)):
+            ns = '.'.join(parts[:idx])
+            v = self._index.get(ns, UNDEFINED)
+            if v is UNDEFINED:
+                return None
+
+            if not isinstance(v, dict):
+                return (ns, v)
+
+        return None
+
+    def _snapshot(self, value):
+        if isinstance(value, _Node):
+            value.shared = True
+            return FrozenDict(value)
+
+        return value
 
     def get(self, key, default=UNDEFINED):
         if key is None:
-            return self._d
+            self._resolve_all()
+            if self._snapshots:
+                return self._snapshot(self._d)
+
+            # A copy, changes to the live tree would bypass the index
+            return copy.deepcopy(self._d)
 
         try:
-            subkey, d = self._get_subdict(key, create=False)
-            return copy.deepcopy(d[subkey])
+            value = self._index[key]
 
-        except (KeyNotFoundError, KeyError) as e:
-            if default != UNDEFINED:
-                return copy.deepcopy(default)
-            else:
+        except (KeyError, TypeError) as e:
+            self._process_key(key)
+
+            if default is UNDEFINED:
                 raise KeyNotFoundError(key) from e
 
+            return default if self._snapshots else copy.deepcopy(default)
+
+        if isinstance(value, _LazyValue):
+            value = self._resolve(key, value)
+        elif self._lazy and isinstance(value, dict):
+            self._resolve_all()
+            value = self._index[key]
+
+        if self._snapshots:
+            return self._snapshot(value)
+
+        return copy.deepcopy(value)
+
     def delete(self, key):
-        subkey, d = self._get_subdict(key)
-        try:
-            del(d[subkey])
-            return
-        except KeyError:
-            pass  # Mask real exception
+        if key not in self:
+            raise KeyNotFoundError(key)
+
+        if self._snapshots:
+            subkey, d = self._get_subdict_cow(key)
+        else:
+            subkey, d = self._get_subdict(key)
+
+        v = d.pop(subkey)
+        del self._index[key]
+        self._parts.pop(key, None)
+        if isinstance(v, dict):
+            self._unindex_subtree(key, v)
 
-        raise KeyNotFoundError(key)
+        if self._changes is not None or self._subscribers:
+            self._notify(key, UNDEFINED, v)
 
     def children(self, key=None):
         if key is None:
             return list(self._d.keys())
 
-        subkey, d = self._get_subdict(key)
         try:
-            return list(d[subkey].keys())
-        except KeyError:
+            return list(self._index[key].keys())
+        except (KeyError, AttributeError):
+            self._process_key(key)
             raise KeyNotFoundError(key)
 
     def all_keys(self):
+        self._resolve_all()
         return flatten_dict(self._d)
 
+    def _iter_leaves(self, prefix):
+        """
+        Generator function.
+        Yields (key, internal value) pairs for leaves under prefix walking
+        the tree, without building intermediate structures.
+        """
+        if prefix is None:
+            base, node = '', self._d
+        else:
+            try:
+                node = self._index.get(prefix, UNDEFINED)
+            except TypeError:
+                node = UNDEFINED
+
+            if node is UNDEFINED:
+                self._process_key(prefix)
+                return
+
+            if not isinstance(node, dict):
+                yield (prefix, node)
+                return
+
+            base = prefix + '.'
+
+        # In snapshot mode writers will copy the namespace instead of
+        # modifying it while we iterate
+        if self._snapshots and isinstance(node, _Node):
+            node.shared = True
+
+        stack = [(base, iter(node.items()))]
+        while stack:
+            (base, it) = stack[-1]
+            for (k, v) in it:
+                if isinstance(v, dict):
+                    stack.append((base + k + '.', iter(v.items())))
+                    break
+
+                yield (base + k, v)
+            else:
+                stack.pop()
+
+    def iter_items(self, prefix=None):
+        """
+        Generator function.
+        Yields (key, value) pairs for all keys under prefix namespace (or the
+        whole store if prefix is None). Values are returned like in get.
+        Without snapshots the store must not be modified during iteration.
+        """
+        for (key, value) in self._iter_leaves(prefix):
+            if isinstance(value, _LazyValue):
+                value = self._resolve(key, value)
+
+            yield (key, value if self._snapshots else copy.deepcopy(value))
+
+    def iter_keys(self, prefix=None):
+        """
+        Generator function.
+        Yields all keys under prefix namespace (or the whole store if prefix
+        is None).
+        """
+        for (key, value) in self._iter_leaves(prefix):
+            yield key
+
+    def count(self, prefix=None):
+        """
+        Returns the number of keys under prefix namespace (or the whole store
+        if prefix is None).
+        """
+        if prefix is None:
+            node = self._d
+        else:
+            try:
+                node = self._index.get(prefix, UNDEFINED)
+            except TypeError:
+                node = UNDEFINED
+
+            if node is UNDEFINED:
+                self._process_key(prefix)
+                return 0
+
+            if not isinstance(node, dict):
+                return 1
+
+        ret = 0
+        stack = [node]
+        while stack:
+            for v in stack.pop().values():
+                if isinstance(v, dict):
+                    stack.append(v)
+                else:
+                    ret += 1
+
+        return ret
+
     def has_key(self, key):
         try:
-            subkey, d = self._get_subdict(key)
-        except KeyNotFoundError:
-            return False
+            if key in self._index:
+                return True
+        except TypeError:
+            pass
 
-        return subkey in d
+        self._process_key(key)
+        return False
 
     def has_namespace(self, ns):
         try:
-            subns, d = self._get_subdict(ns)
-        except KeyNotFoundError:
-            return False
+            if isinstance(self._index.get(ns), dict):
+                return True
+        except TypeError:
+            pass
 
-        return subns in d and isinstance(d[subns], dict)
+        self._process_key(ns)
+        return False
 
     __contains__ = has_key
     __setitem__ = get
     __setitem__ = set
     __delitem__ = delete
+
+
+class ConcurrentStore(Store):
+    """
+    Store safe for concurrent use from several threads.
+
+    Namespaces are never modified once published: writers copy the path to
+    the modified key and swap the root, so readers don't take any lock and
+    always see a consistent (maybe slightly outdated) tree. Writers on the
+    same top-level namespace are serialized by a per-namespace lock; the
+    root swap and index update use a short global lock. Bulk operations
+    (set_many, update, load...) are published with a single swap.
+
+    Values are returned as read-only snapshots like in
+    Store(snapshots=True).
+    """
+    def __init__(self, items={}, validators=[]):
+        self._publish_lock = threading.Lock()
+        self._ns_locks = {}
+        self._ns_locks_lock = threading.Lock()
+
+        super().__init__(items=items, validators=validators, snapshots=True)
+        self._d.shared = True
+
+    def _ns_lock(self, ns):
+        with self._ns_locks_lock:
+            try:
+                return self._ns_locks[ns]
+            except KeyError:
+                lock = self._ns_locks[ns] = threading.RLock()
+                return lock
+
+    def _replace(self, key, parts, value, track=True):
+        """
+        Publishes a new tree with value stored at key (or key deleted if
+        value is UNDEFINED). Caller must hold the lock for parts[0].
+        Returns the previous value of key.
+        """
+        # Build private copies of the path below the top-level namespace
+        nodes = []
+        if len(parts) == 1:
+            top = value
+        else:
+            prev_top = self._d.get(parts[0])
+            top = _Node(prev_top) if isinstance(prev_top, dict) else _Node()
+            nodes.append((parts[0], top))
+
+            d = top
+            for idx in range(1, len(parts) - 1):
+                child = d.get(parts[idx])
+                child = _Node(child) if isinstance(child, dict) else _Node()
+                d[parts[idx]] = child
+                nodes.append(('.'.join(parts[:idx + 1]), child))
+                d = child
+
+            prev = d.get(parts[-1], UNDEFINED)
+            if value is UNDEFINED:
+                d.pop(parts[-1], None)
+            else:
+                d[parts[-1]] = value
+
+        for (ns, node) in nodes:
+            node.shared = True
+
+        with self._publish_lock:
+            root = _Node(self._d)
+            root.shared = True
+            if len(parts) == 1:
+                prev = root.get(key, UNDEFINED)
+
+            if top is UNDEFINED:
+                root.pop(key, None)
+            else:
+                root[parts[0]] = top
+
+            self._d = root
+
+            if isinstance(prev, dict):
+                self._unindex_subtree(key, prev)
+
+            for (ns, node) in nodes:
+                self._index[ns] = node
+
+            if value is UNDEFINED:
+                self._index.pop(key, None)
+                self._parts.pop(key, None)
+            else:
+                self._index[key] = value
+                self._parts[key] = parts
+                if isinstance(value, dict):
+                    self._index_subtree(key, value)
+
+            if track and self._changes is not None:
+                self._changes.add(key)
+
+        return prev
+
+    def _set(self, key, parts, v):
+        v = freeze(v)
+        if isinstance(v, _Node):
+            v.shared = True
+
+        with self._ns_lock(parts[0]):
+            overridden = self._leaf_ancestor(parts)
+            prev = self._replace(key, parts, v)
+
+            if overridden:
+                self._notify(overridden[0], self._index[overridden[0]],
+                             overridden[1])
+            if self._subscribers:
+                self._dispatch(key, v, prev)
+
+    def _apply_many(self, prepared):
+        # Batched version of _set: every node in the affected paths is copied
+        # at most once and the whole batch is published with a single root
+        # swap, so readers see all of it or none of it
+        if not prepared:
+            return
+
+        names = sorted({parts[0] for (key, parts, value) in prepared})
+        locks = [self._ns_lock(name) for name in names]
+        for lock in locks:
+            lock.acquire()
+
+        try:
+            tops = {}
+            private = {}
+            ops = []
+
+            def own(node):
+                if id(node) not in private:
+                    node = _Node(node) if isinstance(node, dict) else _Node()
+                    private[id(node)] = node
+                return node
+
+            for (key, parts, value) in prepared:
+                value = freeze(value)
+                if isinstance(value, _Node):
+                    value.shared = True
+
+                nodes = []
+                overridden = None
+                if len(parts) == 1:
+                    prev = tops.get(key, self._d.get(key, UNDEFINED))
+                    tops[key] = value
+
+                else:
+                    top = tops.get(parts[0], self._d.get(parts[0],
+                                                         UNDEFINED))
+                    if top is not UNDEFINED and not isinstance(top, dict):
+                        overridden = (parts[0], top)
+                    top = tops[parts[0]] = own(top)
+                    nodes.append((parts[0], top))
+
+                    d = top
+                    for idx in range(1, len(parts) - 1):
+                        child = d.get(parts[idx], UNDEFINED)
+                        ns = '.'.join(parts[:idx + 1])
+                        if overridden is None and child is not UNDEFINED \
+                                and not isinstance(child, dict):
+                            overridden = (ns, child)
+                        child = d[parts[idx]] = own(child)
+                        nodes.append((ns, child))
+                        d = child
+
+                    prev = d.get(parts[-1], UNDEFINED)
+                    d[parts[-1]] = value
+
+                ops.append((key, parts, value, prev, nodes, overridden))
+
+            for node in private.values():
+                node.shared = True
+
+            with self._publish_lock:
+                root = _Node(self._d)
+                root.shared = True
+                root.update(tops)
+                self._d = root
+
+                for (key, parts, value, prev, nodes, overridden) in ops:
+                    if isinstance(prev, dict):
+                        self._unindex_subtree(key, prev)
+
+                    for (ns, node) in nodes:
+                        self._index[ns] = node
+
+                    self._index[key] = value
+                    self._parts[key] = parts
+                    if isinstance(value, dict):
+                        self._index_subtree(key, value)
+
+                    if self._changes is not None:
+                        self._changes.add(key)
+
+            for (key, parts, value, prev, nodes, overridden) in ops:
+                if overridden:
+                    self._notify(overridden[0], dict(nodes)[overridden[0]],
+                                 overridden[1])
+                if self._subscribers:
+                    self._dispatch(key, value, prev)
+
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    def delete(self, key):
+        parts = self._process_key(key)
+
+        with self._ns_lock(parts[0]):
+            if key not in self:
+                raise KeyNotFoundError(key)
+
+            prev = self._replace(key, parts, UNDEFINED)
+            if self._subscribers:
+                self._dispatch(key, UNDEFINED, prev)
+
+    def empty(self):
+        # Same order as _apply_many to avoid deadlocks
+        with self._ns_locks_lock:
+            locks = [lock for (ns, lock) in sorted(self._ns_locks.items())]
+
+        for lock in locks:
+            lock.acquire()
+
+        try:
+            with self._publish_lock:
+                prev = self._d
+                self._lazy = False
+                self._d = _Node()
+                self._d.shared = True
+                self._index = {}
+                self._parts = {}
+                if self._changes is not None:
+                    self._changes.update(prev.keys())
+
+            if self._subscribers:
+                for (key, value) in prev.items():
+                    self._dispatch(key, UNDEFINED, value)
+
+        finally:
+            for lock in locks:
+                lock.release()
+
+    def _resolve(self, key, value):
+        lazy = value
+        value = freeze(lazy.load())
+        parts = self._process_key(key)
+
+        with self._ns_lock(parts[0]):
+            if self._index.get(key) is lazy:
+                self._replace(key, parts, value, track=False)
+
+        return value
+
+    def checkpoint(self):
+        with self._publish_lock:
+            return super().checkpoint()
+
+
+class OverlayStore:
+    """
+    Read view over a stack of Store layers (defaults, configuration files,
+    command line…). Later layers take precedence; results are the same as
+    updating a single store with each layer in order.
+
+    Layers are kept separate: reads are resolved through a key -> layer
+    index which is updated incrementally from layer change notifications,
+    so modifying, adding or removing a layer costs O(affected keys).
+    """
+    def __init__(self, layers=()):
+        self._layers = []
+        self._callbacks = []
+        self._owners = Store()
+
+        for layer in layers:
+            self.add_layer(layer)
+
+    @property
+    def layers(self):
+        return list(self._layers)
+
+    def add_layer(self, layer=None):
+        """
+        Adds layer (or a new empty Store) on top of the existing layers.
+        Returns the added layer.
+        """
+        if layer is None:
+            layer = Store()
+
+        callback = functools.partial(self._on_change, layer)
+        layer.subscribe(None, callback)
+        self._layers.append(layer)
+        self._callbacks.append(callback)
+
+        self._refresh_layer(layer)
+        return layer
+
+    def remove_layer(self, layer):
+        for (idx, x) in enumerate(self._layers):
+            if x is layer:
+                break
+        else:
+            raise ValueError(layer)
+
+        layer.unsubscribe(None, self._callbacks[idx])
+        del self._layers[idx]
+        del self._callbacks[idx]
+
+        self._refresh_layer(layer)
+
+    def _refresh_layer(self, layer):
+        # Only the layer's own leaves can change visibility (and the keys
+        # they shadow or unshadow), namespaces are expanded at most once
+        keys = set()
+        expanded = set()
+        for key in layer.iter_keys():
+            key = self._shadowing_ancestor(key)
+            if key not in expanded:
+                expanded.add(key)
+                keys.update(self._expand(key))
+
+        self._refresh(keys)
+
+    def _on_change(self, layer, key, value):
+        self._refresh(self._affected_keys(key))
+
+    def _affected_keys(self, key):
+        """
+        Returns leaf keys which visibility may change after a change in key
+        """
+        return self._expand(self._shadowing_ancestor(key))
+
+    def _shadowing_ancestor(self, key):
+        # A leaf ancestor (in any layer or visible before the change)
+        # shadows key and its siblings, start from there
+        stores = [self._owners] + self._layers
+
+        parts = key.split('.')
+        for idx in range(1, len(parts)):
+            ns = '.'.join(parts[:idx])
+            if any(self._is_leaf(store, ns) for store in stores):
+                return ns
+
+        return key
+
+    def _expand(self, key):
+        ret = set([key])
+        for store in [self._owners] + self._layers:
+            node = store._index.get(key)
+            if isinstance(node, dict):
+                ret.update(key + '.' + k for k in flatten_dict(node))
+
+        return ret
+
+    @staticmethod
+    def _is_leaf(store, key):
+        value = store._index.get(key, UNDEFINED)
+        return value is not UNDEFINED and not isinstance(value, dict)
+
+    @classmethod
+    def _has_leaves(cls, node):
+        return any(not isinstance(v, dict) or cls._has_leaves(v)
+                   for v in node.values())
+
+    def _find_owner(self, key):
+        parts = key.split('.')
+        ancestors = ['.'.join(parts[:idx]) for idx in range(1, len(parts))]
+
+        for layer in reversed(self._layers):
+            value = layer._index.get(key, UNDEFINED)
+            if value is not UNDEFINED:
+                if not isinstance(value, dict):
+                    return layer
+
+                # Namespaces without leaves are ignored by update, they
+                # don't shadow lower layers
+                if self._has_leaves(value):
+                    return None
+
+                continue
+
+            if any(self._is_leaf(layer, ns) for ns in ancestors):
+                return None
+
+        return None
+
+    def _refresh(self, keys):
+        # Process removals first, setting a key can replace a shadowed
+        # leaf ancestor
+        updates = []
+        for key in keys:
+            owner = self._find_owner(key)
+            if owner is not None:
+                updates.append((key, owner))
+
+            elif self._is_leaf(self._owners, key):
+                self._owners.delete(key)
+
+                # Prune empty namespaces
+                parts = key.split('.')
+                for idx in range(len(parts) - 1, 0, -1):
+                    ns = '.'.join(parts[:idx])
+                    if self._owners._index.get(ns):
+                        break
+                    self._owners.delete(ns)
+
+        for (key, owner) in updates:
+            if self._owners._index.get(key) is not owner:
+                self._owners.set(key, owner)
+
+    def get(self, key, default=UNDEFINED):
+        node = self._owners._index.get(key, UNDEFINED) \
+            if key is not None else self._owners._d
+
+        if node is UNDEFINED:
+            if key is not None:
+                self._owners._process_key(key)
+
+            if default is UNDEFINED:
+                raise KeyNotFoundError(key)
+
+            return default
+
+        if not isinstance(node, dict):
+            return node.get(key)
+
+        prefix = key + '.' if key is not None else ''
+        ret = {}
+        for (subkey, owner) in flatten_dict(node).items():
+            parts = subkey.split('.')
+            d = ret
+            for p in parts[:-1]:
+                d = d.setdefault(p, {})
+            d[parts[-1]] = owner.get(prefix + subkey)
+
+        return ret
+
+    def set(self, key, value):
+        """
+        Sets key in the top layer
+        """
+        self._layers[-1].set(key, value)
+
+    def delete(self, key):
+        """
+        Deletes key from all layers
+        """
+        if not self.has_key(key):
+            raise KeyNotFoundError(key)
+
+        for layer in self._layers:
+            if layer.has_key(key):
+                layer.delete(key)
+
+    def children(self, key=None):
+        return self._owners.children(key)
+
+    def all_keys(self):
+        return {k: self.get(k) for k in self._owners.all_keys()}
+
+    def iter_items(self, prefix=None):
+        for (key, owner) in self._owners._iter_leaves(prefix):
+            yield (key, owner.get(key))
+
+    def iter_keys(self, prefix=None):
+        return self._owners.iter_keys(prefix)
+
+    def count(self, prefix=None):
+        return self._owners.count(prefix)
+
+    def has_key(self, key):
+        return self._owners.has_key(key)
+
+    def has_namespace(self, ns):
+        return self._owners.has_namespace(ns)
+
+    __contains__ = has_key
+    __getitem__ = get
+    __setitem__ = set
+    __delitem__ = delete
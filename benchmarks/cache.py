@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2015 Luis López <luis@cuarentaydos.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+"""
+Cache micro-benchmarks.
+Run with: python -m benchmarks.cache [corpus directory]
+"""
+
+import asyncio
+import hashlib
+import os
+import random
+import sys
+import tempfile
+import time
+
+from appkit import cache
+
+
+_WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+          'eiusmod tempor incididunt ut labore et dolore magna aliqua').split()
+
+
+def synthetic_pages(n=500, seed=0):
+    """
+    Generates HTML-like pages of 10-100KB, similar in redundancy to fetched
+    pages
+    """
+    rnd = random.Random(seed)
+    pages = []
+
+    for i in range(n):
+        rows = []
+        for j in range(rnd.randint(50, 500)):
+            rows.append(
+                '<tr class="row"><td><a href="/item/{id}">{text}</a></td>'
+                '<td>{size}</td></tr>'.format(
+                    id=rnd.randint(0, 10 ** 6),
+                    text=' '.join(rnd.choice(_WORDS) for x in range(8)),
+                    size=rnd.randint(0, 10 ** 9)))
+
+        page = ('<html><head><title>Page {}</title></head><body><table>{}'
+                '</table></body></html>').format(i, '\n'.join(rows))
+        pages.append(page.encode('utf-8'))
+
+    return pages
+
+
+def load_corpus(path):
+    """
+    Loads all files under path as pages
+    """
+    pages = []
+    for (dirpath, dirnames, filenames) in os.walk(path):
+        for name in filenames:
+            with open(os.path.join(dirpath, name), 'rb') as fh:
+                pages.append(fh.read())
+
+    return pages
+
+
+def disk_usage(path):
+    return sum(
+        os.path.getsize(os.path.join(dirpath, name))
+        for (dirpath, dirnames, filenames) in os.walk(path)
+        for name in filenames)
+
+
+STRATEGIES = [
+    ('pickle (default protocol)',
+     dict(serializer=cache.PickleSerializer(protocol=None))),
+    ('pickle (highest protocol)',
+     dict(serializer=cache.PickleSerializer())),
+    ('raw', dict(serializer=cache.RawSerializer())),
+    ('raw + zlib', dict(serializer=cache.RawSerializer(),
+                        codec=cache.ZlibCodec())),
+    ('raw + lzma', dict(serializer=cache.RawSerializer(),
+                        codec=cache.LZMACodec())),
+]
+
+
+def bench_serializers(pages):
+    """
+    Bytes written and time spent writing and reading pages for each
+    serialization strategy
+    """
+    raw_size = sum(len(x) for x in pages)
+    print("{n} pages, {size:.1f} MiB".format(
+        n=len(pages), size=raw_size / 2 ** 20))
+
+    for (name, kwargs) in STRATEGIES:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            c = cache.DiskCache(basedir=tmpdir, **kwargs)
+
+            t0 = time.perf_counter()
+            for (idx, page) in enumerate(pages):
+                c.set(str(idx), page)
+            t1 = time.perf_counter()
+            for idx in range(len(pages)):
+                c.get(str(idx))
+            t2 = time.perf_counter()
+
+            written = disk_usage(tmpdir)
+
+        print("{name:28} {mib:8.1f} MiB ({ratio:5.1f}%)  "
+              "set {set:6.2f} ms/page  get {get:6.2f} ms/page".format(
+                  name=name,
+                  mib=written / 2 ** 20,
+                  ratio=written / raw_size * 100,
+                  set=(t1 - t0) / len(pages) * 1e3,
+                  get=(t2 - t1) / len(pages) * 1e3))
+
+
+def bench_zero_copy(sizes=(16 * 1024, 256 * 1024, 4 * 1024 * 1024),
+                    total=64 * 1024 * 1024):
+    """
+    Time to get and hash raw bytes values, copying them or through mmap
+    """
+    for size in sizes:
+        n = max(1, total // size)
+        value = os.urandom(size)
+
+        for zero_copy in (False, True):
+            c = cache.DiskCache(serializer=cache.RawSerializer(),
+                                zero_copy=zero_copy)
+            for idx in range(n):
+                c.set(str(idx), value)
+
+            t0 = time.perf_counter()
+            for idx in range(n):
+                hashlib.sha1(c.get(str(idx))).digest()
+            elapsed = time.perf_counter() - t0
+
+            print("get + sha1 ({size} KiB, zero_copy={zero_copy}): "
+                  "{usec:.1f} µs/call".format(
+                      size=size // 1024, zero_copy=zero_copy,
+                      usec=elapsed / n * 1e6))
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class _SlowDiskCache(cache.DiskCache):
+    """
+    DiskCache with an added per operation delay, simulating a slow or cold
+    disk
+    """
+    def __init__(self, io_latency=0, **kwargs):
+        super().__init__(**kwargs)
+        self.io_latency = io_latency
+
+    def get(self, key, delta=None):
+        time.sleep(self.io_latency)
+        return super().get(key, delta=delta)
+
+    def set(self, key, value):
+        time.sleep(self.io_latency)
+        return super().set(key, value)
+
+
+def bench_async_fetches(concurrency=500, hit_ratio=0.8, page_size=64 * 1024,
+                        network_latency=0.05, io_latency=0):
+    """
+    Latency of concurrent fetches going through a disk cache, in the way
+    the async fetchers use it: a lookup and, on a miss, a simulated network
+    request followed by a store.
+    Compares blocking the loop with the sync cache, using the loop default
+    executor and using AsyncDiskCache.
+    """
+    print("{n} concurrent fetches, io latency {io:.1f} ms".format(
+        n=concurrency, io=io_latency * 1e3))
+
+    page = os.urandom(page_size)
+    n_hits = int(concurrency * hit_ratio)
+
+    async def run(get, set_):
+        # All fetches are issued at once, latency is measured from that
+        # moment so time spent waiting for a blocked loop is accounted
+        t0 = time.perf_counter()
+        stalls = []
+        done = False
+
+        async def fetch(key):
+            try:
+                await get(key)
+            except cache.CacheKeyError:
+                await asyncio.sleep(network_latency)
+                await set_(key, page)
+            return time.perf_counter() - t0
+
+        async def ticker():
+            while not done:
+                t = time.perf_counter()
+                await asyncio.sleep(0.001)
+                stalls.append(time.perf_counter() - t - 0.001)
+
+        tick = asyncio.ensure_future(ticker())
+        latencies = await asyncio.gather(
+            *[fetch(str(i)) for i in range(concurrency)])
+        done = True
+        await tick
+
+        return (latencies, max(stalls))
+
+    def report(name, result):
+        (latencies, stall) = result
+        print("{name:22} p50 {p50:6.1f} ms  p99 {p99:6.1f} ms  "
+              "max loop stall {stall:6.1f} ms".format(
+                  name=name,
+                  p50=_percentile(latencies, 50) * 1e3,
+                  p99=_percentile(latencies, 99) * 1e3,
+                  stall=stall * 1e3))
+
+    def prepare(c):
+        for idx in range(n_hits):
+            c.set(str(idx), page)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        c = _SlowDiskCache(basedir=os.path.join(tmpdir, 'sync'),
+                           io_latency=io_latency)
+        prepare(c)
+
+        async def sync_get(key):
+            return c.get(key)
+
+        async def sync_set(key, value):
+            return c.set(key, value)
+
+        report('sync (blocking loop)', asyncio.run(run(sync_get, sync_set)))
+
+        c = _SlowDiskCache(basedir=os.path.join(tmpdir, 'executor'),
+                           io_latency=io_latency)
+        prepare(c)
+
+        async def executor_get(key):
+            return await asyncio.get_running_loop().run_in_executor(
+                None, c.get, key)
+
+        async def executor_set(key, value):
+            return await asyncio.get_running_loop().run_in_executor(
+                None, c.set, key, value)
+
+        report('default executor',
+               asyncio.run(run(executor_get, executor_set)))
+
+        c = cache.AsyncCacheAdapter(
+            _SlowDiskCache(basedir=os.path.join(tmpdir, 'async'),
+                           io_latency=io_latency),
+            max_workers=16)
+        prepare(c.cache)
+        report('AsyncCacheAdapter', asyncio.run(run(c.get, c.set)))
+        c.close()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        corpus = load_corpus(sys.argv[1])
+    else:
+        corpus = synthetic_pages()
+
+    bench_serializers(corpus)
+    bench_zero_copy()
+    bench_async_fetches()
+    bench_async_fetches(io_latency=0.001)
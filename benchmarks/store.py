@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2015 Luis López <luis@cuarentaydos.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+"""
+Store micro-benchmarks.
+Run with: python -m benchmarks.store
+"""
+
+import os
+import tempfile
+import threading
+import time
+import timeit
+
+from appkit import store
+
+
+def build_store(n, cls=store.Store, **kwargs):
+    s = cls(**kwargs)
+    for i in range(n):
+        s.set('ns.group{}.key{}'.format(i % 100, i), i)
+
+    return s
+
+
+def bench_get_subtree(n=10000, number=100):
+    """
+    Compare get() of a namespace with n keys using deep copies (default)
+    and read-only snapshots.
+    """
+    for snapshots in (False, True):
+        s = build_store(n, snapshots=snapshots)
+        elapsed = timeit.timeit(lambda: s.get('ns'), number=number)
+        print("get subtree ({n} keys, snapshots={snapshots}): "
+              "{usec:.1f} µs/call".format(
+                  n=n, snapshots=snapshots, usec=elapsed / number * 1e6))
+
+
+def bench_set_after_get(n=10000, number=1000):
+    """
+    Cost of writes into a namespace while readers hold snapshots of it
+    """
+    for snapshots in (False, True):
+        s = build_store(n, snapshots=snapshots)
+
+        def _run():
+            s.get('ns')
+            s.set('ns.group0.key0', 1)
+
+        elapsed = timeit.timeit(_run, number=number)
+        print("get + set ({n} keys, snapshots={snapshots}): "
+              "{usec:.1f} µs/call".format(
+                  n=n, snapshots=snapshots, usec=elapsed / number * 1e6))
+
+
+def bench_snapshot_vs_json(n=200000, lookups=100):
+    """
+    Cold start: load a persisted store and read some keys from it
+    """
+    s = build_store(n)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        json_path = os.path.join(tmpdir, 'store.json')
+        snapshot_path = os.path.join(tmpdir, 'store.snapshot')
+
+        with open(json_path, 'w') as fh:
+            s.dump(fh)
+        s.dump_snapshot(snapshot_path)
+
+        def _lookups(s2):
+            for i in range(lookups):
+                s2.get('ns.group{}.key{}'.format(i % 100, i))
+
+        def _json():
+            s2 = store.Store()
+            with open(json_path) as fh:
+                s2.load(fh)
+            _lookups(s2)
+
+        def _snapshot():
+            s2 = store.Store()
+            s2.load_snapshot(snapshot_path)
+            _lookups(s2)
+
+        for (name, fn, path) in [('json', _json, json_path),
+                                 ('snapshot', _snapshot, snapshot_path)]:
+            t0 = time.perf_counter()
+            fn()
+            elapsed = time.perf_counter() - t0
+            print("cold start {name} ({n} keys, {size} bytes): "
+                  "{ms:.1f} ms".format(
+                      name=name, n=n, size=os.path.getsize(path),
+                      ms=elapsed * 1000))
+
+
+class _LockedStore:
+    """
+    Store wrapped in a global lock, the usual way to share it between
+    threads
+    """
+    def __init__(self, s):
+        self._s = s
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._s.get(key)
+
+    def set(self, key, value):
+        with self._lock:
+            return self._s.set(key, value)
+
+
+def bench_threaded_reads(n=10000, reads=20000, thread_counts=(1, 2, 4, 8)):
+    """
+    Read throughput with a concurrent writer: Store behind a global lock vs
+    ConcurrentStore
+    """
+    candidates = [
+        ('locked Store', lambda: _LockedStore(build_store(n))),
+        ('ConcurrentStore', lambda: build_store(n, cls=store.ConcurrentStore))
+    ]
+
+    for (name, factory) in candidates:
+        s = factory()
+
+        for n_threads in thread_counts:
+            stop = threading.Event()
+
+            def _writer():
+                i = 0
+                while not stop.is_set():
+                    s.set('ns.group0.key0', i)
+                    i += 1
+                    time.sleep(0.0001)
+
+            def _reader():
+                for i in range(reads):
+                    s.get('ns.group{}.key{}'.format(i % 100, i % n))
+
+            writer = threading.Thread(target=_writer)
+            readers = [threading.Thread(target=_reader)
+                       for x in range(n_threads)]
+
+            writer.start()
+            t0 = time.perf_counter()
+            for t in readers:
+                t.start()
+            for t in readers:
+                t.join()
+            elapsed = time.perf_counter() - t0
+            stop.set()
+            writer.join()
+
+            print("threaded reads ({name}, {threads} threads): "
+                  "{rate:.0f} reads/s".format(
+                      name=name, threads=n_threads,
+                      rate=reads * n_threads / elapsed))
+
+
+if __name__ == '__main__':
+    bench_get_subtree()
+    bench_set_after_get()
+    bench_snapshot_vs_json()
+    bench_threaded_reads()
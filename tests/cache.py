@@ -0,0 +1,1222 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2015 Luis López <luis@cuarentaydos.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+
+import asyncio
+import gc
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import weakref
+
+from appkit import cache
+
+
+try:
+    import sqlalchemy
+except ImportError:
+    sqlalchemy = None
+
+
+def _upper_loader(key):
+    if key == 'fail':
+        raise ValueError(key)
+
+    return key.upper()
+
+
+class NullCacheTest(unittest.TestCase):
+    def test_many(self):
+        c = cache.NullCache()
+        c.set_many({'a': 1})
+
+        self.assertEqual(c.get_many(['a', 'b']), ({}, set(['a', 'b'])))
+        self.assertEqual(c.delete_many(['a']), set(['a']))
+
+
+class MemoryCacheTest(unittest.TestCase):
+    def test_many(self):
+        c = cache.MemoryCache()
+        c.set_many({'a': 1, 'b': 2})
+
+        self.assertEqual(c.get_many(['a', 'c']), ({'a': 1}, set(['c'])))
+        self.assertEqual(c.delete_many(['a', 'c']), set(['c']))
+        self.assertEqual(len(c), 1)
+
+    def test_get_set(self):
+        c = cache.MemoryCache()
+        c.set('x', b'foo')
+        self.assertEqual(c.get('x'), b'foo')
+
+        with self.assertRaises(cache.CacheKeyMissError):
+            c.get('y')
+
+        c.delete('x')
+        with self.assertRaises(cache.CacheKeyMissError):
+            c.get('x')
+
+    def test_lru(self):
+        c = cache.MemoryCache(max_entries=2)
+        c.set('a', 1)
+        c.set('b', 2)
+        c.get('a')
+        c.set('c', 3)
+
+        self.assertTrue('a' in c)
+        self.assertFalse('b' in c)
+        self.assertTrue('c' in c)
+        self.assertEqual(c.stats()['evictions'], 1)
+
+    def test_lfu(self):
+        c = cache.MemoryCache(max_entries=2, policy=cache.MemoryCache.LFU)
+        c.set('a', 1)
+        c.set('b', 2)
+        c.get('a')
+        c.get('a')
+        c.get('b')
+        c.set('c', 3)
+        self.assertEqual(set(c._entries), set(['a', 'c']))
+
+        # New entries start with the lowest frequency
+        c.set('d', 4)
+        self.assertEqual(set(c._entries), set(['a', 'd']))
+
+    def test_max_size(self):
+        c = cache.MemoryCache(max_size=10)
+        c.set('a', b'x' * 4)
+        c.set('b', b'x' * 4)
+        c.set('c', b'x' * 4)
+        self.assertEqual(set(c._entries), set(['b', 'c']))
+        self.assertEqual(c.stats()['size'], 8)
+
+        # Too big to be cached
+        c.set('d', b'x' * 11)
+        self.assertFalse('d' in c)
+
+        c.set('b', b'x')
+        self.assertEqual(c.stats()['size'], 5)
+
+    def test_expiration(self):
+        c = cache.MemoryCache(delta=10)
+        c.set('a', 1)
+        self.assertEqual(c.get('a'), 1)
+
+        c._entries['a'] = (1, 0, time.time() - 20)
+        with self.assertRaises(cache.CacheKeyExpiredError):
+            c.get('a')
+        self.assertFalse('a' in c)
+
+    def test_stats(self):
+        c = cache.MemoryCache()
+        c.set('a', 1)
+        c.get('a')
+        with self.assertRaises(cache.CacheKeyMissError):
+            c.get('b')
+
+        stats = c.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['entries'], 1)
+
+
+def _shared_worker(basedir, n):
+    # Writes and reads the same keys as other workers, values must be
+    # always complete
+    c = cache.DiskCache(basedir=basedir, shared=True)
+    errors = 0
+    for i in range(n):
+        key = 'key{}'.format(i % 10)
+        c.set(key, [os.getpid()] * 1000)
+        try:
+            value = c.get(key)
+            if len(value) != 1000:
+                errors += 1
+        except cache.CacheKeyError:
+            errors += 1
+
+    return errors
+
+
+def _crashing_worker(basedir, n):
+    # Writes entries and exits without closing the cache
+    c = cache.DiskCache(basedir=basedir, max_entries=100)
+    for i in range(n):
+        c.set(i, i)
+
+    os._exit(0)
+
+
+class DiskCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.basedir)
+
+    def test_max_entries(self):
+        c = cache.DiskCache(basedir=self.basedir, max_entries=2)
+        c.set('a', 1)
+        c.set('b', 2)
+        c.get('a')
+        c.set('c', 3)
+        c.sweep()
+
+        self.assertEqual(c.get('a'), 1)
+        self.assertEqual(c.get('c'), 3)
+        with self.assertRaises(cache.CacheKeyMissError):
+            c.get('b')
+        self.assertEqual(c.stats()['entries'], 2)
+        self.assertEqual(c.stats()['evictions'], 1)
+        c.close()
+
+    def test_sweep_expirations(self):
+        c = cache.DiskCache(basedir=self.basedir, delta=0.01)
+        c.set('a', 1)
+        c.set('b', 2)
+        time.sleep(0.05)
+        c.sweep()
+
+        # Sweeping is not a lookup
+        stats = c.stats()
+        self.assertEqual(stats['entries'], 0)
+        self.assertEqual(stats['sweep_expirations'], 2)
+        self.assertEqual(stats['expirations'], 0)
+        self.assertIsNone(stats['hit_ratio'])
+        c.close()
+
+    def test_max_size(self):
+        c = cache.DiskCache(basedir=self.basedir, max_size=300)
+        for i in range(5):
+            c.set(str(i), b'x' * 100)
+        c.sweep()
+
+        stats = c.stats()
+        self.assertEqual(stats['entries'], 2)
+        self.assertTrue(stats['size'] <= 300)
+        c.close()
+
+    def test_background_sweep(self):
+        c = cache.DiskCache(basedir=self.basedir, max_entries=1,
+                            sweep_interval=0.05)
+        c.set('a', 1)
+        c.set('b', 2)
+        time.sleep(0.2)
+
+        with self.assertRaises(cache.CacheKeyMissError):
+            c.get('a')
+        c.close()
+
+    def test_persistent_index(self):
+        c = cache.DiskCache(basedir=self.basedir, max_entries=10)
+        c.set('a', 1)
+        c.set('b', 2)
+        c.get('a')
+        c.close()
+
+        c = cache.DiskCache(basedir=self.basedir, max_entries=1)
+        c.sweep()
+        self.assertEqual(c.get('a'), 1)
+        with self.assertRaises(cache.CacheKeyMissError):
+            c.get('b')
+        c.close()
+
+    def test_many(self):
+        c = cache.DiskCache(basedir=self.basedir, max_entries=10)
+        c.set_many({'a': 1, 'b': 2, 'c': 3})
+
+        (hits, misses) = c.get_many(['a', 'b', 'x'])
+        self.assertEqual(hits, {'a': 1, 'b': 2})
+        self.assertEqual(misses, set(['x']))
+
+        self.assertEqual(c.delete_many(['a', 'x']), set(['x']))
+        with self.assertRaises(cache.CacheKeyMissError):
+            c.get('a')
+        self.assertEqual(c.stats()['entries'], 2)
+        c.close()
+
+    def test_get_many_expired(self):
+        c = cache.DiskCache(basedir=self.basedir, delta=0.05)
+        c.set('a', 1)
+        time.sleep(0.1)
+
+        self.assertEqual(c.get_many(['a']), ({}, set(['a'])))
+        with self.assertRaises(cache.CacheKeyMissError):
+            c.get('a')
+
+    def test_serializers(self):
+        for serializer in (cache.RawSerializer(), cache.JSONSerializer(),
+                           cache.PickleSerializer()):
+            c = cache.DiskCache(basedir=self.basedir, serializer=serializer)
+            if isinstance(serializer, cache.RawSerializer):
+                value = b'foo'
+            else:
+                value = {'a': [1, 2]}
+
+            c.set('x', value)
+            self.assertEqual(c.get('x'), value)
+
+        c = cache.DiskCache(basedir=self.basedir,
+                            serializer=cache.RawSerializer())
+        with self.assertRaises(TypeError):
+            c.set('x', 'str')
+
+    def test_codecs(self):
+        for codec in (cache.ZlibCodec(), cache.LZMACodec()):
+            c = cache.DiskCache(basedir=self.basedir,
+                                serializer=cache.RawSerializer(),
+                                codec=codec, codec_threshold=100)
+            c.set('small', b'x' * 10)
+            c.set('big', b'x' * 1000)
+
+            self.assertEqual(c.get('small'), b'x' * 10)
+            self.assertEqual(c.get('big'), b'x' * 1000)
+            self.assertTrue(
+                os.path.getsize(c._on_disk_path('big')) < 1000)
+
+    def test_zero_copy(self):
+        c = cache.DiskCache(basedir=self.basedir, zero_copy=True)
+        c.set('a', b'foo')
+        c.set('empty', b'')
+
+        view = c.get('a')
+        self.assertTrue(isinstance(view, memoryview))
+        self.assertEqual(view, b'foo')
+        self.assertEqual(c.get('empty'), b'')
+
+        # Views survive updates and deletions
+        c.set('a', b'bar')
+        self.assertEqual(view, b'foo')
+        self.assertEqual(c.get('a'), b'bar')
+        c.delete('a')
+        self.assertEqual(view, b'foo')
+
+        with self.assertRaises(ValueError):
+            cache.DiskCache(basedir=self.basedir, zero_copy=True,
+                            codec=cache.ZlibCodec())
+
+    def test_keys(self):
+        c = cache.DiskCache(basedir=self.basedir)
+        c.set('a', 1)
+        c.set(b'a', 2)
+        c.set(('a', 1), 3)
+
+        self.assertEqual(c.get('a'), 1)
+        self.assertEqual(c.get(b'a'), 2)
+        self.assertEqual(c.get(('a', 1)), 3)
+
+    def test_hashfunc_and_fanout(self):
+        c = cache.DiskCache(basedir=self.basedir,
+                            hashfunc=cache.sha1_hashfunc, fanout=3)
+        c.set('a', 1)
+
+        hashed = cache.sha1_hashfunc('a')
+        self.assertEqual(
+            c._on_disk_path('a'),
+            os.path.join(self.basedir, hashed[0:2], hashed[2:4],
+                         hashed[4:6], hashed))
+        self.assertTrue(os.path.exists(c._on_disk_path('a')))
+
+        c = cache.DiskCache(basedir=self.basedir, fanout=0)
+        c.set('a', 1)
+        self.assertEqual(os.path.dirname(c._on_disk_path('a')),
+                         self.basedir)
+
+    def test_torn_entries(self):
+        c = cache.DiskCache(basedir=self.basedir)
+        c.set('a', b'x' * 100)
+        c.set('b', b'x' * 100)
+
+        path = c._on_disk_path('a')
+        os.truncate(path, os.path.getsize(path) - 1)
+        with self.assertRaises(cache.CacheKeyError):
+            c.get('a')
+        self.assertFalse(os.path.exists(path))
+
+        path = c._on_disk_path('b')
+        with open(path, 'r+b') as fh:
+            fh.seek(-1, os.SEEK_END)
+            fh.write(b'y')
+        self.assertEqual(c.get_many(['b']), ({}, set(['b'])))
+        self.assertEqual(c.stats()['errors'], 1)
+
+    def test_leftover_temp_files(self):
+        c = cache.DiskCache(basedir=self.basedir)
+        c.set('a', 1)
+
+        dname = os.path.dirname(c._on_disk_path('a'))
+        old = os.path.join(dname, c._TMP_PREFIX + 'old')
+        new = os.path.join(dname, c._TMP_PREFIX + 'new')
+        for path in (old, new):
+            with open(path, 'wb') as fh:
+                fh.write(b'x')
+        os.utime(old, (0, 0))
+
+        index_tmp = os.path.join(self.basedir, c.INDEX_FILENAME + '.old')
+        with open(index_tmp, 'wb') as fh:
+            fh.write(b'x')
+        os.utime(index_tmp, (0, 0))
+
+        self.assertEqual(c.stats()['entries'], 1)
+        self.assertFalse(os.path.exists(old))
+        self.assertTrue(os.path.exists(new))
+        self.assertFalse(os.path.exists(index_tmp))
+
+    def test_file_mode(self):
+        c = cache.DiskCache(basedir=self.basedir, max_entries=10)
+        c.set('a', 1)
+        c.close()
+
+        # Same permissions as files created by open()
+        for path in (c._on_disk_path('a'),
+                     os.path.join(self.basedir, c.INDEX_FILENAME)):
+            self.assertEqual(os.stat(path).st_mode & 0o777,
+                             cache._FILE_MODE)
+
+    def test_unclean_close(self):
+        c = cache.DiskCache(basedir=self.basedir, max_entries=100)
+        c.set('a', 1)
+        c.close()
+
+        proc = multiprocessing.Process(target=_crashing_worker,
+                                       args=(self.basedir, 50))
+        proc.start()
+        proc.join()
+
+        # Index saved by the first close() misses the worker entries
+        c = cache.DiskCache(basedir=self.basedir, max_entries=5)
+        c.sweep()
+        self.assertEqual(c.stats()['entries'], 5)
+        self.assertEqual(len(c.hashed_keys()), 5)
+        c.close()
+
+        c = cache.DiskCache(basedir=self.basedir, max_entries=5)
+        self.assertEqual(c.stats()['entries'], 5)
+        c.close()
+
+    def test_shared(self):
+        with multiprocessing.Pool(4) as pool:
+            errors = pool.starmap(_shared_worker, [(self.basedir, 200)] * 4)
+
+        self.assertEqual(errors, [0] * 4)
+
+        c = cache.DiskCache(basedir=self.basedir, shared=True,
+                            max_entries=5)
+        c.sweep()
+        self.assertEqual(c.stats()['entries'], 5)
+        c.close()
+
+    def test_stats_without_index(self):
+        c = cache.DiskCache(basedir=self.basedir)
+        c.set('a', 1)
+        c.set('b', 2)
+
+        self.assertEqual(c.stats()['entries'], 2)
+
+
+class PackedDiskCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.basedir)
+
+    def test_basic(self):
+        c = cache.PackedDiskCache(basedir=self.basedir)
+        c.set('a', 1)
+        c.set('b', {'x': [1, 2]})
+        c.set('a', 3)
+
+        self.assertEqual(c.get('a'), 3)
+        self.assertEqual(c.get('b'), {'x': [1, 2]})
+        with self.assertRaises(cache.CacheKeyMissError):
+            c.get('c')
+
+        c.delete('b')
+        with self.assertRaises(cache.CacheKeyMissError):
+            c.get('b')
+        c.close()
+
+    def test_reopen(self):
+        c = cache.PackedDiskCache(basedir=self.basedir, segment_size=64)
+        for i in range(10):
+            c.set(str(i), i)
+        c.delete('3')
+        c.close()
+
+        # Writes after the index was saved are recovered from segment tails
+        c = cache.PackedDiskCache(basedir=self.basedir, segment_size=64)
+        c.set('4', 'four')
+        c._fh.flush()
+
+        c2 = cache.PackedDiskCache(basedir=self.basedir, segment_size=64)
+        self.assertEqual(c2.get('4'), 'four')
+        self.assertEqual(c2.get('9'), 9)
+        with self.assertRaises(cache.CacheKeyMissError):
+            c2.get('3')
+        c.close()
+        c2.close()
+
+    def test_rebuild_index(self):
+        c = cache.PackedDiskCache(basedir=self.basedir)
+        c.set('a', 1)
+        c.set('b', 2)
+        c.delete('a')
+        c.close()
+        os.unlink(os.path.join(self.basedir, c.INDEX_FILENAME))
+
+        c = cache.PackedDiskCache(basedir=self.basedir)
+        self.assertEqual(c.get('b'), 2)
+        with self.assertRaises(cache.CacheKeyMissError):
+            c.get('a')
+        c.close()
+
+    def test_compact(self):
+        c = cache.PackedDiskCache(basedir=self.basedir, segment_size=256,
+                                  compact_interval=0)
+        for i in range(50):
+            c.set('key', i)
+        c.set('other', 'x')
+
+        before = c.stats()
+        c.compact()
+        after = c.stats()
+
+        self.assertTrue(after['segments'] < before['segments'])
+        self.assertTrue(after['size'] < before['size'])
+        self.assertEqual(c.get('key'), 49)
+        self.assertEqual(c.get('other'), 'x')
+        c.close()
+
+        c = cache.PackedDiskCache(basedir=self.basedir)
+        self.assertEqual(c.get('key'), 49)
+        c.close()
+
+    def test_compact_batches(self):
+        class CountingLock:
+            def __init__(self, lock):
+                self.lock = lock
+                self.count = 0
+
+            def __enter__(self):
+                self.lock.acquire()
+                self.count += 1
+
+            def __exit__(self, *exc):
+                self.lock.release()
+
+        c = cache.PackedDiskCache(basedir=self.basedir, segment_size=512,
+                                  compact_ratio=0.1, compact_interval=0)
+        c.COMPACT_BATCH_SIZE = 1
+        for i in range(100):
+            c.set(str(i), i)
+        for i in range(0, 100, 2):
+            c.delete(str(i))
+        c.set('x', 'x')
+
+        before = c.stats()
+        c._lock = CountingLock(c._lock)
+        c.compact()
+
+        # Lock is released after each copied record
+        self.assertTrue(c._lock.count > 30)
+        self.assertTrue(c.stats()['segments'] < before['segments'])
+        self.assertEqual(c.stats()['entries'], 51)
+        for i in range(1, 100, 2):
+            self.assertEqual(c.get(str(i)), i)
+        c.close()
+
+    def test_expiration(self):
+        c = cache.PackedDiskCache(basedir=self.basedir, delta=0.05)
+        c.set('a', 1)
+        time.sleep(0.1)
+
+        with self.assertRaises(cache.CacheKeyExpiredError):
+            c.get('a')
+        c.close()
+
+
+@unittest.skipIf(sqlalchemy is None, 'sqlalchemy not available')
+class SQLiteCacheTest(unittest.TestCase):
+    def setUp(self):
+        (fd, self.path) = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+
+    def tearDown(self):
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.path + suffix):
+                os.unlink(self.path + suffix)
+
+    def test_basic(self):
+        c = cache.SQLiteCache(self.path)
+        c.set('a', 1)
+        c.set('a', {'x': 2})
+
+        self.assertEqual(c.get('a'), {'x': 2})
+        with self.assertRaises(cache.CacheKeyMissError):
+            c.get('b')
+
+        c.delete('a')
+        with self.assertRaises(cache.CacheKeyMissError):
+            c.get('a')
+        c.close()
+
+    def test_many(self):
+        c = cache.SQLiteCache(self.path)
+        c.set_many({'a': 1, 'b': 2})
+
+        (hits, misses) = c.get_many(['a', 'b', 'c'])
+        self.assertEqual(hits, {'a': 1, 'b': 2})
+        self.assertEqual(misses, set(['c']))
+        c.close()
+
+    def test_shared(self):
+        c1 = cache.SQLiteCache(self.path)
+        c2 = cache.SQLiteCache(self.path)
+        c1.set('a', 1)
+
+        self.assertEqual(c2.get('a'), 1)
+        c1.close()
+        c2.close()
+
+    def test_vacuum(self):
+        c = cache.SQLiteCache(self.path, delta=0.05)
+        c.set_many({'a': 1, 'b': 2})
+        time.sleep(0.1)
+
+        with self.assertRaises(cache.CacheKeyExpiredError):
+            c.get('a')
+        self.assertEqual(c.vacuum(), 2)
+        with self.assertRaises(cache.CacheKeyMissError):
+            c.get('a')
+        c.close()
+
+
+class AsyncCacheAdapterTest(unittest.TestCase):
+    def test_disk(self):
+        c = cache.AsyncDiskCache(max_workers=2)
+
+        async def run():
+            await c.set('a', 1)
+            await asyncio.gather(*[c.set(str(i), i) for i in range(20)])
+            self.assertEqual(await c.get('a'), 1)
+            with self.assertRaises(cache.CacheKeyMissError):
+                await c.get('b')
+            return await c.get_many(['a', '5', 'b'])
+
+        self.assertEqual(asyncio.run(run()), ({'a': 1, '5': 5}, set(['b'])))
+        c.close()
+
+    def test_non_blocking(self):
+        c = cache.AsyncCacheAdapter(cache.MemoryCache())
+        self.assertFalse(c.blocking)
+
+        async def run():
+            await c.set('a', 1)
+            return await c.get('a')
+
+        self.assertEqual(asyncio.run(run()), 1)
+
+
+class StaleWhileRevalidateTest(unittest.TestCase):
+    def test_memory_grace(self):
+        c = cache.MemoryCache(delta=0.05, grace=10)
+        c.set('a', 1)
+        time.sleep(0.1)
+
+        with self.assertRaises(cache.CacheKeyStaleError) as cm:
+            c.get('a')
+        self.assertEqual(cm.exception.value, 1)
+        self.assertTrue(isinstance(cm.exception, cache.CacheKeyExpiredError))
+
+    def test_disk_grace(self):
+        c = cache.DiskCache(delta=0.05, grace=0.1)
+        c.set('a', 1)
+        time.sleep(0.1)
+
+        with self.assertRaises(cache.CacheKeyStaleError) as cm:
+            c.get('a')
+        self.assertEqual(cm.exception.value, 1)
+        self.assertEqual(c.get_many(['a']), ({}, set(['a'])))
+
+        time.sleep(0.1)
+        with self.assertRaises(cache.CacheKeyExpiredError) as cm:
+            c.get('a')
+        self.assertFalse(isinstance(cm.exception, cache.CacheKeyStaleError))
+
+    def test_single_flight(self):
+        flight = cache.SingleFlight()
+        calls = []
+        started = threading.Event()
+
+        def load():
+            calls.append(1)
+            started.set()
+            time.sleep(0.1)
+            return 'x'
+
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(flight.do('k', load)))
+            for x in range(5)]
+        threads[0].start()
+        started.wait()
+        for t in threads[1:]:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(calls, [1])
+        self.assertEqual(results, ['x'] * 5)
+
+    def test_single_flight_error(self):
+        flight = cache.SingleFlight()
+
+        def load():
+            raise ValueError()
+
+        with self.assertRaises(ValueError):
+            flight.do('k', load)
+        self.assertFalse(flight.in_flight('k'))
+
+    def test_loader(self):
+        c = cache.MemoryCache(delta=0.2, grace=10)
+        loads = []
+
+        def loader(key):
+            loads.append(key)
+            return len(loads)
+
+        loader = cache.CacheLoader(c, loader)
+        self.assertEqual(loader.get('a'), 1)
+        self.assertEqual(loader.get('a'), 1)
+        time.sleep(0.25)
+
+        # Stale value is served and refreshed in background
+        self.assertEqual(loader.get('a'), 1)
+        time.sleep(0.05)
+        self.assertEqual(loader.get('a'), 2)
+        self.assertEqual(loads, ['a', 'a'])
+
+    def test_async_loader(self):
+        loads = []
+
+        async def loader(key):
+            loads.append(key)
+            await asyncio.sleep(0.05)
+            return key.upper()
+
+        c = cache.AsyncCacheAdapter(cache.MemoryCache())
+        loader = cache.AsyncCacheLoader(c, loader)
+
+        async def run():
+            return await asyncio.gather(*[loader.get('a') for x in range(10)])
+
+        self.assertEqual(asyncio.run(run()), ['A'] * 10)
+        self.assertEqual(loads, ['a'])
+
+
+class CachedTest(unittest.TestCase):
+    def test_hash_args(self):
+        h = cache.hash_args
+        self.assertEqual(h((1, 'a'), {'x': [1, 2]}),
+                         h((1, 'a'), {'x': [1, 2]}))
+        self.assertEqual(h((), {'a': 1, 'b': 2}), h((), {'b': 2, 'a': 1}))
+        self.assertNotEqual(h((1,), {}), h(('1',), {}))
+        self.assertNotEqual(h((1,), {}), h((1.0,), {}))
+        self.assertNotEqual(h((1,), {}), h((True,), {}))
+        self.assertNotEqual(h(('ab', 'c'), {}), h(('a', 'bc'), {}))
+
+    def test_hash_args_unstable(self):
+        class Equal:
+            def __eq__(self, other):
+                return True
+
+            def __hash__(self):
+                return 0
+
+        h = cache.hash_args
+        (a, b) = (Equal(), Equal())
+
+        # Objects are identified by identity, not by equality
+        self.assertEqual(h((a,), {}, stable=False), h((a,), {}, stable=False))
+        self.assertNotEqual(h((a,), {}, stable=False),
+                            h((b,), {}, stable=False))
+
+        # Values that can't be weak-referenced are pickled
+        self.assertEqual(h((object(),), {}, stable=False),
+                         h((object(),), {}, stable=True))
+
+    def test_sync(self):
+        calls = []
+
+        @cache.cached()
+        def f(x, y=1):
+            calls.append((x, y))
+            return x + y
+
+        self.assertEqual(f(1), 2)
+        self.assertEqual(f(1), 2)
+        self.assertEqual(f(1, y=2), 3)
+        self.assertEqual(calls, [(1, 1), (1, 2)])
+
+    def test_custom_key_and_ttl(self):
+        c = cache.MemoryCache()
+        calls = []
+
+        @cache.cached(cache=c, ttl=0.05, key=lambda x: 'f:' + x)
+        def f(x):
+            calls.append(x)
+            return x.upper()
+
+        self.assertEqual(f('a'), 'A')
+        self.assertEqual(c.get('f:a'), 'A')
+        time.sleep(0.1)
+        self.assertEqual(f('a'), 'A')
+        self.assertEqual(calls, ['a', 'a'])
+
+    def test_errors(self):
+        calls = []
+
+        @cache.cached(cache=cache.DiskCache(), errors=(ValueError,))
+        def f(x):
+            calls.append(x)
+            if x < 0:
+                raise ValueError(x)
+            if x == 0:
+                raise TypeError(x)
+            return x
+
+        for i in range(2):
+            with self.assertRaises(ValueError):
+                f(-1)
+            with self.assertRaises(TypeError):
+                f(0)
+        self.assertEqual(calls, [-1, 0, 0])
+
+    def test_coroutine(self):
+        calls = []
+
+        async def f(x):
+            calls.append(x)
+            return x * 2
+
+        for c in (cache.MemoryCache(),
+                  cache.AsyncCacheAdapter(cache.DiskCache())):
+            del calls[:]
+            g = cache.cached(cache=c)(f)
+
+            async def run():
+                return [await g(1), await g(1), await g(2)]
+
+            self.assertEqual(asyncio.run(run()), [2, 2, 4])
+            self.assertEqual(calls, [1, 2])
+
+        with self.assertRaises(TypeError):
+            cache.cached(cache=c)(lambda x: x)
+
+
+    def test_method(self):
+        class Counter:
+            def __init__(self):
+                self.lock = threading.Lock()
+                self.calls = 0
+
+            @cache.cached()
+            def get(self, fn):
+                self.calls += 1
+                return fn(self.calls)
+
+        a = Counter()
+        self.assertEqual(a.get(str), '1')
+        self.assertEqual(a.get(str), '1')
+        self.assertEqual(a.get(lambda x: x), 2)
+
+        # Objects are never confused, even if one reuses the address of a
+        # dead one
+        for i in range(10):
+            self.assertEqual(Counter().get(str), '1')
+
+    def test_unpicklable_stable(self):
+        calls = []
+
+        @cache.cached(cache=cache.DiskCache())
+        def f(x):
+            calls.append(x)
+
+        with self.assertRaises(TypeError) as cm:
+            f(threading.Lock())
+        self.assertIn('key argument', str(cm.exception))
+        self.assertEqual(calls, [])
+
+    def test_coroutine_blocking_cache(self):
+        threads = []
+
+        class RecordingDiskCache(cache.DiskCache):
+            def get(self, key, delta=None):
+                threads.append(threading.current_thread())
+                return super().get(key, delta=delta)
+
+        @cache.cached(cache=RecordingDiskCache())
+        async def f(x):
+            return x * 2
+
+        async def run():
+            return [await f(1), await f(1)]
+
+        self.assertEqual(asyncio.run(run()), [2, 2])
+        self.assertEqual(len(threads), 2)
+        self.assertNotIn(threading.current_thread(), threads)
+
+
+class MetricsTest(unittest.TestCase):
+    def test_histogram(self):
+        h = cache.LatencyHistogram()
+        for x in range(99):
+            h.add(0.000003)
+        h.add(0.01)
+
+        snapshot = h.snapshot()
+        self.assertEqual(snapshot['count'], 100)
+        self.assertEqual(snapshot['p50'], 4e-6)
+        self.assertTrue(snapshot['p99'] <= 4e-6)
+        self.assertEqual(h.percentile(100), 2 ** 14 / 1e6)
+
+    def test_disk(self):
+        c = cache.DiskCache(delta=0.05)
+        c.set('a', b'x' * 100)
+        c.get('a')
+        with self.assertRaises(cache.CacheKeyMissError):
+            c.get('b')
+        c.get_many(['a', 'b'])
+
+        stats = c.stats()
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['hit_ratio'], 0.5)
+        self.assertTrue(stats['bytes_written'] > 100)
+        self.assertEqual(stats['bytes_read'], 2 * stats['bytes_written'])
+        self.assertEqual(stats['get_latency']['count'], 2)
+        self.assertEqual(stats['set_latency']['count'], 1)
+
+        time.sleep(0.1)
+        with self.assertRaises(cache.CacheKeyExpiredError):
+            c.get('a')
+        self.assertEqual(c.stats()['expirations'], 1)
+
+    def test_errors(self):
+        c = cache.DiskCache(serializer=cache.RawSerializer())
+        with self.assertRaises(TypeError):
+            c.set('a', 'str')
+
+        self.assertEqual(c.stats()['errors'], 1)
+
+    def test_stats_logger(self):
+        records = []
+
+        class Logger:
+            def info(self, msg):
+                records.append(msg)
+
+        c = cache.MemoryCache()
+        c.set('a', 1)
+        c.get('a')
+
+        logger = cache.StatsLogger({'mem': c}, interval=0.05,
+                                   logger=Logger())
+        logger.start()
+        time.sleep(0.12)
+        logger.stop()
+
+        self.assertTrue(records)
+        self.assertTrue(records[0].startswith('mem: hits=1 misses=0'))
+
+
+class _HookedCache(cache.MemoryCache):
+    """
+    MemoryCache calling get_hook/set_hook before reading or writing
+    """
+    get_hook = None
+    set_hook = None
+
+    def get(self, key, delta=None):
+        if self.get_hook:
+            self.get_hook(key)
+        return super().get(key, delta=delta)
+
+    def set(self, key, value):
+        if self.set_hook:
+            self.set_hook(key)
+        super().set(key, value)
+
+
+class TieredCacheTest(unittest.TestCase):
+    def test_write_behind(self):
+        disk = cache.DiskCache()
+        c = cache.TieredCache(disk=disk, flush_interval=60)
+
+        c.set('a', 1)
+        c.set('a', 2)
+        self.assertEqual(c.get('a'), 2)
+        with self.assertRaises(cache.CacheKeyMissError):
+            disk.get('a')
+
+        c.flush()
+        self.assertEqual(disk.get('a'), 2)
+        c.close()
+
+    def test_get_while_flushing(self):
+        disk = _HookedCache()
+        disk.set('a', 'old')
+        c = cache.TieredCache(disk=disk, memory=cache.MemoryCache(
+            max_entries=1), flush_interval=60)
+
+        c.set('a', 'new')
+        c.set('b', 'x')
+
+        # 'a' is evicted from memory and not yet on disk
+        seen = []
+        disk.set_hook = lambda key: seen.append(c.get('a'))
+        c.flush()
+        disk.set_hook = None
+
+        self.assertEqual(seen, ['new', 'new'])
+        self.assertEqual(c.get('a'), 'new')
+        self.assertEqual(disk.get('a'), 'new')
+        c.close()
+
+    def test_no_stale_promotion(self):
+        disk = _HookedCache()
+        disk.set('a', 'old')
+        c = cache.TieredCache(disk=disk, flush_interval=60)
+
+        def hook(key):
+            disk.get_hook = None
+            c.set('a', 'new')
+
+        # set() runs while get() reads the previous value from disk
+        disk.get_hook = hook
+        self.assertEqual(c.get('a'), 'old')
+        self.assertEqual(c.get('a'), 'new')
+
+        c.flush()
+        self.assertEqual(c.get('a'), 'new')
+        c.close()
+
+    def test_background_flush(self):
+        disk = cache.DiskCache()
+        c = cache.TieredCache(disk=disk, flush_interval=0.01)
+
+        for i in range(10):
+            c.set('a', i)
+        time.sleep(0.2)
+
+        self.assertEqual(disk.get('a'), 9)
+        c.close()
+
+    def test_write_errors(self):
+        class Logger:
+            def __init__(self):
+                self.messages = []
+
+            def error(self, msg):
+                self.messages.append(msg)
+
+        def hook(key):
+            if key == 'b':
+                raise cache.CacheIOError()
+
+        disk = _HookedCache()
+        disk.set_hook = hook
+        logger = Logger()
+        c = cache.TieredCache(disk=disk, flush_interval=0.01, logger=logger)
+
+        for key in 'abc':
+            c.set(key, key)
+        time.sleep(0.2)
+
+        # Writer survives a failed entry
+        c.set('d', 'd')
+        time.sleep(0.2)
+
+        self.assertEqual(disk.get('a'), 'a')
+        self.assertEqual(disk.get('c'), 'c')
+        self.assertEqual(disk.get('d'), 'd')
+        self.assertFalse('b' in disk)
+        self.assertEqual(c.get('b'), 'b')
+        self.assertEqual(c.stats()['write_errors'], 1)
+        self.assertEqual(len(logger.messages), 1)
+        c.close()
+
+    def test_max_pending(self):
+        disk = _HookedCache()
+        release = threading.Event()
+        disk.set_hook = lambda key: release.wait()
+        c = cache.TieredCache(disk=disk, flush_interval=60, batch_size=2,
+                              max_pending=2)
+
+        for key in 'abcd':
+            c.set(key, key)
+
+        # Writer is blocked writing a and b, pending queue is full
+        t = threading.Thread(target=c.set, args=('e', 'e'))
+        t.start()
+        t.join(0.2)
+        self.assertTrue(t.is_alive())
+
+        # Rewriting a pending key doesn't block
+        c.set('c', 'x')
+
+        release.set()
+        t.join()
+        c.close()
+        self.assertEqual(disk.get('c'), 'x')
+        self.assertEqual(disk.get('e'), 'e')
+
+    def test_collected(self):
+        disk = cache.DiskCache()
+        c = cache.TieredCache(disk=disk, flush_interval=0.01)
+        c.set('a', 1)
+        writer = c._writer
+        ref = weakref.ref(c)
+
+        del c
+        gc.collect()
+        writer.join(1)
+
+        self.assertIsNone(ref())
+        self.assertFalse(writer.is_alive())
+        self.assertEqual(disk.get('a'), 1)
+
+    def test_batch_size(self):
+        disk = cache.DiskCache()
+        c = cache.TieredCache(disk=disk, flush_interval=60, batch_size=4)
+
+        for i in range(4):
+            c.set(str(i), i)
+        time.sleep(0.2)
+
+        self.assertEqual(disk.get('3'), 3)
+        c.close()
+
+    def test_promotion(self):
+        disk = cache.DiskCache()
+        disk.set('a', 1)
+        c = cache.TieredCache(disk=disk)
+
+        self.assertEqual(c.get('a'), 1)
+        self.assertTrue('a' in c.memory)
+
+        with self.assertRaises(cache.CacheKeyMissError):
+            c.get('b')
+
+    def test_pending_read(self):
+        memory = cache.MemoryCache(max_entries=1)
+        c = cache.TieredCache(memory=memory, flush_interval=60)
+        c.set('a', 1)
+        c.set('b', 2)
+
+        self.assertFalse('a' in memory)
+        self.assertEqual(c.get('a'), 1)
+
+    def test_delete(self):
+        disk = cache.DiskCache()
+        c = cache.TieredCache(disk=disk, flush_interval=60)
+        c.set('a', 1)
+        c.flush()
+        c.set('b', 2)
+        c.delete('a')
+        c.delete('b')
+
+        self.assertEqual(c.get_many(['a', 'b']), ({}, set(['a', 'b'])))
+        with self.assertRaises(cache.CacheKeyMissError):
+            c.delete('a')
+        c.close()
+
+    def test_close(self):
+        disk = cache.DiskCache()
+        c = cache.TieredCache(disk=disk, flush_interval=60)
+        c.set('a', 1)
+        c.close()
+
+        self.assertEqual(disk.get('a'), 1)
+        with self.assertRaises(cache.CacheIOError):
+            c.set('a', 2)
+
+
+class ArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmpdir, 'src')
+        self.dst = os.path.join(self.tmpdir, 'dst')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_export_import(self):
+        src = cache.DiskCache(basedir=self.src)
+        src.set_many({'k{}'.format(i): i for i in range(50)})
+        src.set('expired', 1)
+        os.utime(src._on_disk_path('expired'), (0, 0))
+
+        for ext in ('.tar', '.tar.gz', '.tar.xz'):
+            path = os.path.join(self.tmpdir, 'export' + ext)
+            ret = cache.export_disk_cache(self.src, path, jobs=3)
+            self.assertEqual(ret['entries'], 51)
+
+            ret = cache.import_disk_cache(self.dst, path, jobs=2,
+                                          batch_size=7)
+            self.assertEqual(ret['entries'], 51)
+
+            dst = cache.DiskCache(basedir=self.dst, delta=3600)
+            self.assertEqual(
+                dst.get_many(['k0', 'k49', 'expired', 'missing']),
+                ({'k0': 0, 'k49': 49}, set(['expired', 'missing'])))
+            shutil.rmtree(self.dst)
+
+    def test_export_empty(self):
+        path = os.path.join(self.tmpdir, 'export.tar.gz')
+        ret = cache.export_disk_cache(self.src, path, jobs=2)
+        self.assertEqual(ret['entries'], 0)
+
+        ret = cache.import_disk_cache(self.dst, path)
+        self.assertEqual(ret['entries'], 0)
+
+    def test_prewarm(self):
+        c = cache.DiskCache(basedir=self.src)
+        c.set('a', 'cached')
+
+        ret = cache.prewarm_disk_cache(self.src, ['a', 'b', 'c', 'fail'],
+                                       _upper_loader, jobs=2, batch_size=1)
+        self.assertEqual(ret['entries'], 2)
+        self.assertEqual(ret['cached'], 1)
+        self.assertEqual(ret['errors'], 1)
+        self.assertEqual(ret['failures'], [('fail', 'ValueError: fail')])
+
+        c = cache.DiskCache(basedir=self.src)
+        self.assertEqual(c.get_many(['a', 'b', 'c']),
+                         ({'a': 'cached', 'b': 'B', 'c': 'C'}, set()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -18,9 +18,14 @@
 # USA.
 
 
+import io
+import json
+import os
+import tempfile
+import threading
 import unittest
 
-from ldotcommons import store
+from appkit import store
 
 
 class SelectorInterfaceTest(unittest.TestCase):
@@ -63,6 +68,36 @@ class SelectorInterfaceTest(unittest.TestCase):
             set(s.all_keys()),
             set(['x', 'y.a', 'y.b']))
 
+    def test_iter(self):
+        s = store.Store()
+        s.update({'x': 1, 'y': {'a': 2, 'b': {'c': [3]}}, 'z': {}})
+
+        self.assertEqual(dict(s.iter_items()), s.all_keys())
+        self.assertEqual(dict(s.iter_items('y')), {'y.a': 2, 'y.b.c': [3]})
+        self.assertEqual(set(s.iter_keys('y')), set(['y.a', 'y.b.c']))
+        self.assertEqual(list(s.iter_keys('x')), ['x'])
+        self.assertEqual(list(s.iter_keys('foo')), [])
+        self.assertEqual(s.count(), 3)
+        self.assertEqual(s.count('y'), 2)
+        self.assertEqual(s.count('y.a'), 1)
+        self.assertEqual(s.count('foo'), 0)
+
+        # Values are copies
+        dict(s.iter_items('y.b'))['y.b.c'].append(4)
+        self.assertEqual(s.get('y.b.c'), [3])
+
+        with self.assertRaises(store.IllegalKeyError):
+            list(s.iter_keys('y.'))
+
+    def test_iter_snapshot(self):
+        s = store.Store(snapshots=True)
+        s.update({'y': {'a': 1, 'b': 2}})
+
+        it = s.iter_items('y')
+        self.assertEqual(next(it), ('y.a', 1))
+        s.set('y.c', 3)
+        self.assertEqual(list(it), [('y.b', 2)])
+
     def test_has_key(self):
         s = store.Store()
         s.set('x', 1)
@@ -190,6 +225,140 @@ class SelectorInterfaceTest(unittest.TestCase):
         with self.assertRaises(store.ValidationError):
             s.set('int', 'a')
 
+    def test_update_is_atomic(self):
+        s = store.Store(validators=[store.TypeValidator({'a.int': int})])
+        s.set('a.int', 1)
+
+        with self.assertRaises(store.ValidationError):
+            s.update({'a': {'int': 'x'}, 'b': 2})
+        self.assertEqual(s.get(None), {'a': {'int': 1}})
+
+        with self.assertRaises(store.IllegalKeyError):
+            s.update({'b': 2, 'c': {'': 3}})
+        self.assertEqual(s.get(None), {'a': {'int': 1}})
+
+        with self.assertRaises(store.ValidationError):
+            s.replace({'a': {'int': 'x'}})
+        self.assertEqual(s.get(None), {'a': {'int': 1}})
+
+    def test_set_many_overrides(self):
+        s = store.Store()
+        s.set_many({'a.b': 1, 'a': 2, 'a.c': 3, 'x.y': 1, 'x': {'z': 2}})
+
+        self.assertEqual(s.get(None), {'a': {'c': 3}, 'x': {'z': 2}})
+        self.assertFalse(s.has_key('a.b'))
+        self.assertFalse(s.has_key('x.y'))
+
+    def test_batch_validator(self):
+        calls = []
+
+        class BatchValidator:
+            def __call__(self, k, v):
+                raise AssertionError('Not called in batch mode')
+
+            def validate_many(self, data):
+                calls.append(data)
+                return {k: v * 2 for (k, v) in data.items()}
+
+        s = store.Store()
+        s.add_validator(BatchValidator())
+        s.update({'x': 1, 'y': {'z': 2}})
+
+        self.assertEqual(calls, [{'x': 1, 'y.z': 2}])
+        self.assertEqual(s.get(None), {'x': 2, 'y': {'z': 4}})
+
+    def test_load(self):
+        s = store.Store(validators=[store.TypeValidator({'a.b': int})])
+        s.load(io.StringIO('{"a": {"b": "1", "c": [1, 2]}, "d": null}'))
+
+        self.assertEqual(s.get('a.b'), 1)
+        self.assertEqual(s.get('a.c'), [1, 2])
+        self.assertEqual(s.get('d'), None)
+
+        with self.assertRaises(store.FormatError):
+            s.load(io.StringIO('{"a": '))
+
+    def test_dump(self):
+        s = store.Store()
+        s.update({'a': {'b': [1, 2], 'c': 'x'}, 'd': None})
+
+        buff = io.StringIO()
+        s.dump(buff)
+        self.assertEqual(
+            buff.getvalue(),
+            json.dumps(s.get(None), sort_keys=True, indent=4))
+
+    def test_load_streaming(self):
+        buff = io.StringIO()
+        s = store.Store()
+        s.update({'a': {'b': [1, {'c': 2}], 'c': 'x"y'}, 'd': None, 'e': {}})
+        s.dump(buff)
+
+        buff.seek(0)
+        s2 = store.Store()
+        s2.load(buff, streaming=True)
+        self.assertEqual(s2.get(None), {'a': {'b': [1, {'c': 2}], 'c': 'x"y'},
+                                        'd': None})
+
+        with self.assertRaises(store.FormatError):
+            s2.load(io.StringIO('{"a": 1, "b": }'), streaming=True)
+
+    def test_json_iterparse(self):
+        doc = json.dumps({
+            'a': {'b': [1, 2.5, {'x': 'y'}], 'c': {'d': -1.5e10, 'e': {}}},
+            'f': True, 'g': None, 'h': 'ñ\\"', 'i': '😀😀'
+        }, ensure_ascii=False)
+        expected = list(store.flatten_dict(json.loads(doc)).items())
+
+        for chunk_size in range(1, 10):
+            self.assertEqual(
+                list(store.json_iterparse(io.StringIO(doc), chunk_size)),
+                expected)
+            self.assertEqual(
+                list(store.json_iterparse(io.BytesIO(doc.encode('utf-8')),
+                                          chunk_size)),
+                expected)
+
+        for doc in ['', '[]', '{"a":}', '{"a":1,}', '{"a":1}x', '{"a":1']:
+            with self.assertRaises(store.FormatError):
+                list(store.json_iterparse(io.StringIO(doc), 2))
+
+    def test_snapshot(self):
+        s = store.Store()
+        s.update({'a': {'b': [1, 2], 'c': 'x'}, 'd': None, 'e': {'f': 1.5}})
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'snapshot')
+            s.dump_snapshot(path)
+
+            s2 = store.Store()
+            s2.load_snapshot(path)
+            self.assertEqual(s2.get('a.b'), [1, 2])
+            self.assertEqual(s2.get('e'), {'f': 1.5})
+            self.assertEqual(s2.get(None), s.get(None))
+
+            # Dump a store with pending values
+            s3 = store.Store()
+            s3.load_snapshot(path)
+            s3.set('a.c', 'y')
+            s3.dump_snapshot(path)
+
+            s4 = store.Store(snapshots=True)
+            s4.load_snapshot(path)
+            self.assertEqual(s4.get('a'), {'b': (1, 2), 'c': 'y'})
+            self.assertEqual(s4.get('d'), None)
+
+    def test_snapshot_format_error(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'snapshot')
+
+            for buff in [b'', b'{"a": 1}', b'APKS' + b'\0' * 18]:
+                with open(path, 'wb') as fh:
+                    fh.write(buff)
+
+                with self.assertRaises(store.FormatError):
+                    store.Store().load_snapshot(path)
+
     def test_illegal_keys(self):
         s = store.Store()
 
@@ -208,10 +377,568 @@ class SelectorInterfaceTest(unittest.TestCase):
         with self.assertRaises(store.IllegalKeyError):
             s.set('x..a', 1)
 
+    def test_override_leaf_with_namespace(self):
+        s = store.Store()
+        s.set('a', 1)
+        s.set('a.b', 2)
+
+        self.assertTrue(s.has_namespace('a'))
+        self.assertEqual(s.get('a'), {'b': 2})
+        self.assertEqual(s.get(None), {'a': {'b': 2}})
+
+    def test_override_namespace_with_leaf(self):
+        s = store.Store()
+        s.set('a.b.c', 1)
+        s.set('a', 2)
+
+        self.assertFalse(s.has_key('a.b'))
+        self.assertFalse(s.has_key('a.b.c'))
+        self.assertEqual(s.get('a'), 2)
+        with self.assertRaises(store.KeyNotFoundError):
+            s.get('a.b.c')
+
+    def test_set_dict_value(self):
+        s = store.Store()
+        s.set('a', {'b': {'c': 1}})
+
+        self.assertEqual(s.get('a.b.c'), 1)
+        self.assertTrue(s.has_namespace('a.b'))
+        self.assertEqual(set(s.children('a.b')), set(['c']))
+
+    def test_external_changes(self):
+        value = {'b': 1}
+        s = store.Store()
+        s.set('a', value)
+        value['c'] = 2
+
+        d = s.get(None)
+        d['a']['d'] = 3
+
+        self.assertEqual(s.get('a'), {'b': 1})
+        self.assertFalse(s.has_key('a.c'))
+        self.assertFalse(s.has_key('a.d'))
+
+    def test_delete_namespace(self):
+        s = store.Store()
+        s.set('a.b.c', 1)
+        s.set('a.d', 2)
+        s.delete('a.b')
+
+        self.assertFalse('a.b' in s)
+        self.assertFalse('a.b.c' in s)
+        self.assertTrue('a.d' in s)
+        with self.assertRaises(store.KeyNotFoundError):
+            s.delete('a.b.c')
+
     def test_dottet_value(self):
         s = store.Store()
         s.set('a.b', 'c.d')
         self.assertEqual(s.get('a.b'), 'c.d')
 
+
+class PatternValidatorTest(unittest.TestCase):
+    def test_dispatch(self):
+        v = store.PatternValidator({
+            'a.b.c': int,
+            'a.*.c': float,
+            'a.b*.d': float,
+            'a.**': str,
+            'a.b.**': bool,
+            '**': list,
+        })
+
+        self.assertEqual(v.dispatch('a.b.c'), 'a.b.c')
+        self.assertEqual(v.dispatch('a.x.c'), 'a.*.c')
+        self.assertEqual(v.dispatch('a.bx.d'), 'a.b*.d')
+        self.assertEqual(v.dispatch('a.x.d'), 'a.**')
+        self.assertEqual(v.dispatch('a.b.x.y'), 'a.b.**')
+        self.assertEqual(v.dispatch('a'), '**')
+        self.assertEqual(v.dispatch('x.y'), '**')
+
+    def test_overlapping_globs(self):
+        # Globs indexed by head, tail or none are tried in rule order
+        v = store.PatternValidator({
+            'a.x*.c': int,
+            'a.*y.d': int,
+            'a.?.*': int,
+            'a.x*y.e': int,
+        })
+
+        self.assertEqual(v.dispatch('a.xy.c'), 'a.x*.c')
+        self.assertEqual(v.dispatch('a.xy.d'), 'a.*y.d')
+        self.assertEqual(v.dispatch('a.xy.e'), 'a.x*y.e')
+        self.assertEqual(v.dispatch('a.y.e'), 'a.?.*')
+        self.assertEqual(v.dispatch('a.x.c'), 'a.x*.c')
+        self.assertEqual(v.dispatch('a.zz.c'), None)
+
+    def test_cache_size(self):
+        v = store.PatternValidator({'a.*': int})
+        v.CACHE_SIZE = 10
+        for i in range(100):
+            self.assertEqual(v.dispatch('a.{}'.format(i)), 'a.*')
+
+        self.assertEqual(len(v._cache), 10)
+
+    def test_no_match(self):
+        v = store.PatternValidator({'a.*': int})
+        self.assertEqual(v.dispatch('a'), None)
+        self.assertEqual(v.dispatch('a.b.c'), None)
+        self.assertEqual(v('b', 'x'), 'x')
+
+        v = store.PatternValidator({'a.*': int}, strict=True)
+        with self.assertRaises(store.ValidationError):
+            v('b', 'x')
+
+    def test_validate(self):
+        s = store.Store(validators=[
+            store.PatternValidator({'net.*.timeout': int, 'net.**': str})
+        ])
+        s.set('net.http.timeout', '10')
+        s.update({'net': {'ftp': {'timeout': 5.5, 'host': 1}}})
+
+        self.assertEqual(s.get('net.http.timeout'), 10)
+        self.assertEqual(s.get('net.ftp.timeout'), 5)
+        self.assertEqual(s.get('net.ftp.host'), '1')
+
+        with self.assertRaises(store.ValidationError):
+            s.set('net.http.timeout', 'x')
+
+    def test_hits(self):
+        v = store.PatternValidator({'a.*': int, 'b': int})
+        v('a.x', 1)
+        v('a.y', 1)
+        v('a.x', 1)
+        v('c', 1)
+
+        self.assertEqual(v.hits, {'a.*': 3})
+
+
+class ChangesTest(unittest.TestCase):
+    def test_changes(self):
+        s = store.Store({'a': {'b': 1}, 'c': 2})
+        self.assertEqual(s.changes(), set())
+
+        self.assertEqual(s.checkpoint(), set())
+        s.set('a.b', 2)
+        s.update({'d': {'e': 1}})
+        s.delete('c')
+        self.assertEqual(s.changes(), set(['a.b', 'd.e', 'c']))
+
+        self.assertEqual(s.checkpoint(), set(['a.b', 'd.e', 'c']))
+        self.assertEqual(s.changes(), set())
+
+        s.empty()
+        self.assertEqual(s.checkpoint(), set(['a', 'd']))
+
+        s.set('x', 1)
+        s.checkpoint()
+        s.set('x.y', 1)
+        self.assertEqual(s.checkpoint(), set(['x', 'x.y']))
+
+    def test_subscribe(self):
+        calls = []
+
+        def callback(key, value):
+            calls.append((key, value))
+
+        s = store.Store({'a': {'b': {'c': 1}}, 'x': 1})
+        s.subscribe('a.b', callback)
+
+        s.set('a.b.c', 2)
+        s.set('a.b.d', 3)
+        s.set('a.e', 4)
+        s.set('x', 5)
+        s.delete('a.b.d')
+        s.set('a', 6)
+        self.assertEqual(calls, [
+            ('a.b.c', 2),
+            ('a.b.d', 3),
+            ('a.b.d', store.UNDEFINED),
+            ('a', 6)
+        ])
+
+        s.unsubscribe('a.b', callback)
+        s.set('a.b.c', 1)
+        self.assertEqual(len(calls), 4)
+
+    def test_subscribe_all(self):
+        calls = []
+        s = store.Store()
+        s.subscribe(None, lambda k, v: calls.append(k))
+        s.update({'a': {'b': 1}, 'c': 2})
+
+        self.assertEqual(calls, ['a.b', 'c'])
+
+    def test_journal(self):
+        s = store.Store({'a': {'b': 1, 'c': 2}, 'd': 3})
+        base = io.StringIO()
+        s.dump(base)
+
+        journal = io.StringIO()
+        s.checkpoint()
+        s.set('a.b', 10)
+        s.delete('d')
+        self.assertEqual(s.write_journal(journal), 2)
+
+        s.set('d.e', 5)
+        s.delete('a')
+        s.set('a.x', [1])
+        self.assertEqual(s.write_journal(journal), 3)
+        self.assertEqual(s.write_journal(journal), 0)
+
+        base.seek(0)
+        journal.seek(0)
+        s2 = store.Store()
+        s2.load(base)
+        s2.replay_journal(journal)
+        self.assertEqual(s2.get(None), s.get(None))
+
+
+class OverlayStoreTest(unittest.TestCase):
+    def assertSameAsUpdate(self, overlay):
+        s = store.Store()
+        for layer in overlay.layers:
+            s.update(layer.get(None))
+
+        self.assertEqual(overlay.get(None), s.get(None))
+        self.assertEqual(overlay.all_keys(), s.all_keys())
+        for key in s.all_keys():
+            self.assertEqual(overlay.get(key), s.get(key))
+
+    def test_layers(self):
+        defaults = store.Store({'a': {'b': 1, 'c': 2}, 'x': 1})
+        config = store.Store({'a': {'b': 3}, 'y': {'z': 1}})
+        overlay = store.OverlayStore([defaults, config])
+
+        self.assertEqual(overlay.get('a.b'), 3)
+        self.assertEqual(overlay.get('a.c'), 2)
+        self.assertEqual(overlay.get('a'), {'b': 3, 'c': 2})
+        self.assertEqual(overlay.get('foo', None), None)
+        self.assertTrue(overlay.has_namespace('y'))
+        self.assertEqual(set(overlay.children('a')), set(['b', 'c']))
+        self.assertSameAsUpdate(overlay)
+
+        with self.assertRaises(store.KeyNotFoundError):
+            overlay.get('foo')
+
+    def test_layer_changes(self):
+        defaults = store.Store({'a': {'b': 1, 'c': 2}, 'x': 1})
+        config = store.Store()
+        overlay = store.OverlayStore([defaults, config])
+
+        config.set('a.b', 3)
+        self.assertEqual(overlay.get('a.b'), 3)
+
+        config.delete('a.b')
+        self.assertEqual(overlay.get('a.b'), 1)
+
+        # Shadow namespace with a leaf and back
+        config.set('a', 5)
+        self.assertEqual(overlay.get('a'), 5)
+        self.assertFalse(overlay.has_key('a.b'))
+        self.assertSameAsUpdate(overlay)
+
+        config.set('a.d', 6)
+        self.assertEqual(overlay.get('a'), {'b': 1, 'c': 2, 'd': 6})
+        self.assertSameAsUpdate(overlay)
+
+        config.empty()
+        self.assertSameAsUpdate(overlay)
+
+        defaults.set('x.y', 1)
+        self.assertEqual(overlay.get('x'), {'y': 1})
+        self.assertSameAsUpdate(overlay)
+
+    def test_shadowed_leaf_override(self):
+        bottom = store.Store({'a': {'x': 1}})
+        middle = store.Store({'a': 1})
+        top = store.Store({'a': {'b': 2}})
+        overlay = store.OverlayStore([bottom, middle, top])
+        self.assertEqual(overlay.get('a'), {'b': 2})
+
+        # Leaf in middle layer is implicitly replaced with a namespace
+        middle.set('a.c', 3)
+        self.assertEqual(overlay.get('a'), {'x': 1, 'b': 2, 'c': 3})
+        self.assertSameAsUpdate(overlay)
+
+    def test_empty_namespace(self):
+        defaults = store.Store({'timeout': 4, 'a': {'b': 1}})
+        cli = store.Store()
+        overlay = store.OverlayStore([defaults, cli])
+
+        cli.set('timeout.x', 1)
+        cli.delete('timeout.x')
+        self.assertEqual(overlay.get('timeout'), 4)
+        self.assertSameAsUpdate(overlay)
+
+        cli.set('a', {'c': {}})
+        self.assertEqual(overlay.get('a'), {'b': 1})
+        self.assertSameAsUpdate(overlay)
+
+        cli.set('timeout.y.z', 2)
+        self.assertFalse(overlay.has_key('timeout.x'))
+        self.assertEqual(overlay.get('timeout'), {'y': {'z': 2}})
+        self.assertSameAsUpdate(overlay)
+
+    def test_add_remove_layers(self):
+        defaults = store.Store({'a': {'b': 1, 'c': 2}, 'x': 1})
+        overlay = store.OverlayStore([defaults])
+
+        override = overlay.add_layer(store.Store({'x': {'y': 2}}))
+        self.assertEqual(overlay.get('x.y'), 2)
+        self.assertSameAsUpdate(overlay)
+
+        cli = overlay.add_layer()
+        cli.set('a.b', 'cli')
+        self.assertEqual(overlay.get('a.b'), 'cli')
+
+        overlay.remove_layer(override)
+        self.assertEqual(overlay.get('x'), 1)
+        self.assertFalse(overlay.has_namespace('x'))
+        self.assertSameAsUpdate(overlay)
+
+        override.set('x', 3)
+        self.assertEqual(overlay.get('x'), 1)
+
+    def test_add_remove_shadowing_layers(self):
+        defaults = store.Store({'a': {'b': 1, 'c': {'d': 2}}, 'x': 1})
+        overlay = store.OverlayStore([defaults])
+
+        layers = [
+            store.Store({'a': {'c': 3}}),
+            store.Store({'a': 4, 'x': {'y': 5}}),
+            store.Store({'a': {'c': {'e': 6}, 'f': 7}}),
+        ]
+        for layer in layers:
+            overlay.add_layer(layer)
+            self.assertSameAsUpdate(overlay)
+
+        self.assertEqual(overlay.get('a'), {'c': {'e': 6}, 'f': 7})
+        for layer in layers:
+            overlay.remove_layer(layer)
+            self.assertSameAsUpdate(overlay)
+
+        self.assertEqual(overlay.get(None), defaults.get(None))
+
+    def test_iter(self):
+        overlay = store.OverlayStore([
+            store.Store({'a': {'b': 1, 'c': 2}}),
+            store.Store({'a': {'b': 3}, 'x': 1})])
+
+        self.assertEqual(dict(overlay.iter_items('a')),
+                         {'a.b': 3, 'a.c': 2})
+        self.assertEqual(set(overlay.iter_keys()), set(['a.b', 'a.c', 'x']))
+        self.assertEqual(overlay.count(), 3)
+
+    def test_set_delete(self):
+        defaults = store.Store({'a': 1})
+        overlay = store.OverlayStore([defaults, store.Store()])
+
+        overlay.set('a', 2)
+        self.assertEqual(overlay.get('a'), 2)
+        self.assertEqual(defaults.get('a'), 1)
+
+        overlay.delete('a')
+        self.assertFalse('a' in overlay)
+
+
+class SnapshotsTest(unittest.TestCase):
+    def test_get_returns_frozen_views(self):
+        s = store.Store(snapshots=True)
+        s.set('a.b.c', [1, 2])
+
+        ns = s.get('a')
+        self.assertEqual(ns, {'b': {'c': (1, 2)}})
+        self.assertTrue(isinstance(ns['b'], store.FrozenDict))
+        self.assertEqual(s.get('a.b.c'), (1, 2))
+        with self.assertRaises(TypeError):
+            ns['x'] = 1
+
+    def test_views_are_not_affected_by_writes(self):
+        s = store.Store(snapshots=True)
+        s.set('a.b.c', 1)
+        s.set('a.d', 2)
+
+        root = s.get(None)
+        ns = s.get('a')
+        s.set('a.b.c', 3)
+        s.set('a.b.e', 4)
+        s.delete('a.d')
+
+        self.assertEqual(ns, {'b': {'c': 1}, 'd': 2})
+        self.assertEqual(root, {'a': {'b': {'c': 1}, 'd': 2}})
+        self.assertEqual(s.get('a'), {'b': {'c': 3, 'e': 4}})
+        self.assertEqual(s.get('a.b.c'), 3)
+
+    def test_unshared_namespaces_are_not_copied(self):
+        s = store.Store(snapshots=True)
+        s.set('a.b', 1)
+        s.set('x.y', 1)
+
+        s.get('a')
+        x = s._index['x']
+        s.set('x.z', 2)
+        s.set('a.c', 2)
+
+        self.assertTrue(s._index['x'] is x)
+        self.assertEqual(s.get('a'), {'b': 1, 'c': 2})
+
+    def test_default_is_not_copied(self):
+        s = store.Store(snapshots=True)
+        default = {'x': 1}
+
+        self.assertTrue(s.get('foo', default=default) is default)
+
+
+class ConcurrentStoreTest(unittest.TestCase):
+    def test_interface(self):
+        s = store.ConcurrentStore({'a': {'b': 1}})
+        s.set('a.c.d', [1])
+        s.set('x', 2)
+
+        view = s.get('a')
+        s.delete('a.b')
+        s.set('a.c', 3)
+
+        self.assertEqual(view, {'b': 1, 'c': {'d': (1,)}})
+        self.assertEqual(s.get(None), {'a': {'c': 3}, 'x': 2})
+        self.assertFalse(s.has_key('a.c.d'))
+        self.assertEqual(set(s.children('a')), set(['c']))
+
+        s.empty()
+        self.assertEqual(s.get(None), {})
+
+    def test_snapshot(self):
+        s = store.ConcurrentStore({'a': {'b': 1}})
+        s.checkpoint()
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'snapshot')
+            s.dump_snapshot(path)
+            s.empty()
+            s.checkpoint()
+
+            s.load_snapshot(path)
+            self.assertEqual(s.get('a.b'), 1)
+            self.assertEqual(s.get(None), {'a': {'b': 1}})
+            self.assertEqual(s.checkpoint(), set(['a.b']))
+
+    def test_set_many(self):
+        data = {
+            'a': {'b': 1, 'c': {'d': 2}},
+            'x': 1,
+        }
+        batch = {
+            'a.b.c': 3,
+            'a.c.e': 4,
+            'a.c': {'f': 5},
+            'a.c.g': 6,
+            'x.y': 7,
+            'z': {'w': 8},
+        }
+
+        calls = []
+        s = store.ConcurrentStore(data)
+        s.subscribe(None, lambda k, v: calls.append(k))
+        s.checkpoint()
+        view = s.get(None)
+        s.set_many(batch)
+
+        expected = store.Store(data)
+        expected.set_many(batch)
+
+        self.assertEqual(view, data)
+        self.assertEqual(s.get(None), expected.get(None))
+        self.assertEqual(s.count(), expected.count())
+        self.assertEqual(s.get('a.c'), {'f': 5, 'g': 6})
+        self.assertFalse(s.has_key('a.c.d'))
+        self.assertFalse(s.has_key('a.c.e'))
+        self.assertEqual(s.checkpoint(), set(batch) | set(['a.b', 'x']))
+        self.assertEqual(
+            set(calls), set(batch) | set(['a.b', 'x']))
+
+    def test_set_many_atomic(self):
+        n_keys = 100
+        n_batches = 50
+        errors = []
+
+        s = store.ConcurrentStore()
+
+        def writer():
+            try:
+                for i in range(n_batches):
+                    s.set_many({'ns{}.key{}'.format(x, y): i
+                                for x in range(4) for y in range(n_keys)})
+            except Exception as e:
+                errors.append(e)
+
+        def reader():
+            try:
+                for i in range(n_batches):
+                    root = s.get(None)
+                    values = set(v for d in root.values() for v in d.values())
+                    self.assertTrue(len(values) <= 1)
+            except Exception as e:
+                errors.append(e)
+
+        threads = (
+            [threading.Thread(target=writer)] +
+            [threading.Thread(target=reader) for x in range(4)])
+
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(s.children('ns0')), n_keys)
+
+    def test_threads(self):
+        n_writers = 4
+        n_readers = 4
+        n_keys = 200
+        errors = []
+
+        s = store.ConcurrentStore()
+
+        def writer(ns):
+            try:
+                for i in range(n_keys):
+                    s.set('{}.key{}'.format(ns, i), i)
+                    s.set('{}.last'.format(ns), i)
+            except Exception as e:
+                errors.append(e)
+
+        def reader():
+            try:
+                for i in range(n_keys):
+                    root = s.get(None)
+                    for (ns, d) in root.items():
+                        # Namespaces are consistent: keyN is set before last
+                        last = d.get('last')
+                        if last is not None:
+                            self.assertTrue('key{}'.format(last) in d)
+
+                    s.get('ns0.key0', None)
+            except Exception as e:
+                errors.append(e)
+
+        threads = (
+            [threading.Thread(target=writer, args=('ns{}'.format(x),))
+             for x in range(n_writers)] +
+            [threading.Thread(target=reader) for x in range(n_readers)])
+
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+        for x in range(n_writers):
+            ns = 'ns{}'.format(x)
+            self.assertEqual(s.get(ns + '.last'), n_keys - 1)
+            self.assertEqual(len(s.children(ns)), n_keys + 1)
+
+
 if __name__ == '__main__':
     unittest.main()